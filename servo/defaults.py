@@ -9,21 +9,9 @@ import settings
 import local_settings
 from decimal import Decimal
 
-from django.db import connection
-from django.core.cache import cache
-
 def _get(key):
-    cached = cache.get('defaults', {})
-    
-    if not cached.get(key):
-        cursor = connection.cursor()
-        cursor.execute("SELECT key, value FROM servo_configuration")
-        for r in cursor.fetchall():
-            cached[r[0]] = r[1]
-
-        cache.set('defaults', cached)
-
-    return cached.get(key)
+    from servo.models.common import Configuration
+    return Configuration.conf(key)
 
 def country():
     return local_settings.INSTALL_COUNTRY
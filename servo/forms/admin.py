@@ -588,6 +588,4 @@ class SettingsForm(BaseForm):
             field.save()
             config[k] = v
 
-        cache.set('config', config)
-
         return config
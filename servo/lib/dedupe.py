@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Finding duplicate customers.
+
+Customers are compared by normalized copies of their email, phone
+and name that are stored in indexed columns. Only customers that share
+a blocking key (same email, same phone or same name and ZIP code) are
+ever compared, so finding the candidates is a few index joins instead
+of comparing every customer with every other.
+"""
+
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+import phonenumbers
+
+
+# columns that must all be equal (and not empty) for two customers
+# to be compared at all
+BLOCKING_KEYS = (
+    ('email_normalized',),
+    ('phone_normalized',),
+    ('name_normalized', 'zip_code',),
+)
+
+# how much each matching property counts towards the score of a pair
+WEIGHTS = {
+    'name': 0.5,
+    'email': 0.3,
+    'phone': 0.3,
+    'address': 0.1,
+}
+
+# names less similar than this count as different people
+NAME_SIMILARITY = 0.85
+
+MIN_SCORE = 0.8
+
+# phone numbers shorter than this are too short to tell people apart
+MIN_PHONE_DIGITS = 6
+
+
+def normalize_phone(phone, country=None):
+    """
+    Returns phone in E.164 format, or just its digits if
+    it's not a valid number of country
+    """
+    if not phone:
+        return u''
+
+    try:
+        n = phonenumbers.parse(phone, country or None)
+        if phonenumbers.is_possible_number(n):
+            fmt = phonenumbers.PhoneNumberFormat.E164
+            return phonenumbers.format_number(n, fmt)
+    except phonenumbers.NumberParseException:
+        pass
+
+    digits = re.sub(r'\D', '', phone)
+
+    if len(digits) < MIN_PHONE_DIGITS:
+        return u''
+
+    return digits[:32]
+
+
+def normalize_email(email):
+    return (email or u'').strip().lower()[:254]
+
+
+def normalize_name(name):
+    """
+    Returns name lowercased, without accents or punctuation
+    and its words in order, so that "Doe, John" and "John Doe" match
+    """
+    name = unicodedata.normalize('NFKD', unicode(name or u''))
+    name = u''.join([c for c in name if not unicodedata.combining(c)])
+    words = re.findall(r'\w+', name.lower(), re.UNICODE)
+    return u' '.join(sorted(words))[:255]
+
+
+def score(a, b):
+    """
+    Returns how likely it is (0-1) that customers a and b are the same.
+    a and b are dicts of the normalized columns, ZIP code and city.
+    """
+    def same(key):
+        return bool(a[key]) and a[key] == b[key]
+
+    result = 0.0
+
+    if same('name_normalized'):
+        result += WEIGHTS['name']
+    elif a['name_normalized'] and b['name_normalized']:
+        ratio = SequenceMatcher(None, a['name_normalized'], b['name_normalized']).ratio()
+        if ratio >= NAME_SIMILARITY:
+            result += WEIGHTS['name'] * ratio
+
+    if same('email_normalized'):
+        result += WEIGHTS['email']
+
+    if same('phone_normalized'):
+        result += WEIGHTS['phone']
+
+    if same('zip_code') or same('city'):
+        result += WEIGHTS['address']
+
+    return min(result, 1.0)
+
+
+def group_pairs(pairs):
+    """
+    Returns the {source: target} merges of these duplicate pairs.
+    Chains of duplicates (A-B, B-C) all merge into the oldest customer,
+    so that no customer is both merged and merged into.
+    """
+    parents = {}
+
+    def find(pk):
+        root = pk
+        while parents.get(root, root) != root:
+            root = parents[root]
+        # point the whole chain straight at the root
+        while pk != root:
+            parents[pk], pk = root, parents[pk]
+        return root
+
+    for a, b in pairs:
+        a, b = find(a), find(b)
+        if a != b:
+            parents[max(a, b)] = min(a, b)
+
+    return dict([(pk, find(pk)) for pk in parents if find(pk) != pk])
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming exports of querysets and raw queries.
+Rows are fetched and written in chunks so that memory use
+stays the same no matter how many rows there are.
+"""
+
+import csv
+from tempfile import TemporaryFile
+
+from django.db import connection, transaction
+from django.http import StreamingHttpResponse
+
+
+CHUNK_SIZE = 2000
+
+
+def iterate(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Iterates through queryset in primary key order one chunk at a time.
+    QuerySet.iterator() would still load all the rows into the
+    database driver.
+    """
+    last_pk = None
+    queryset = queryset.order_by('pk')
+
+    while True:
+        chunk = queryset
+
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+
+        rows = list(chunk[:chunk_size])
+
+        for row in rows:
+            yield row
+
+        if len(rows) < chunk_size:
+            break
+
+        last_pk = rows[-1].pk
+
+
+def iterate_sql(sql, args=None, chunk_size=CHUNK_SIZE):
+    """
+    Iterates through the results of a raw query with a server-side cursor
+    """
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name='servo_export')
+        cursor.itersize = chunk_size
+        cursor.execute(sql, args)
+
+        try:
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+
+class Column(object):
+    """
+    An export column. value is either a dotted attribute path
+    or a callable that takes the row
+    """
+    def __init__(self, title, value):
+        self.title = title
+        self.value = value
+
+    def get(self, obj):
+        if callable(self.value):
+            return self.value(obj)
+
+        for attr in self.value.split('.'):
+            if obj is None:
+                break
+            obj = getattr(obj, attr)
+
+        return obj
+
+
+class Export(object):
+    """
+    Columns of data exported from rows
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def get_header(self):
+        return [c.title for c in self.columns]
+
+    def __iter__(self):
+        for obj in self.rows:
+            yield [c.get(obj) for c in self.columns]
+
+
+def to_text(value):
+    if value is None:
+        return u''
+    return unicode(value)
+
+
+class TSVWriter(object):
+    content_type = 'text/plain; charset=utf-8'
+    extension = 'txt'
+
+    def clean(self, value):
+        return to_text(value).replace('\t', ' ').replace('\n', ' ')
+
+    def write(self, export):
+        yield u"\t".join(export.get_header()).encode('utf-8') + "\n"
+
+        for row in export:
+            row = [self.clean(v) for v in row]
+            yield u"\t".join(row).encode('utf-8') + "\n"
+
+
+class Echo(object):
+    """
+    A file-like object that just returns what is written to it
+    """
+    def write(self, value):
+        return value
+
+
+class CSVWriter(object):
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def write(self, export):
+        writer = csv.writer(Echo())
+        yield writer.writerow([to_text(v).encode('utf-8') for v in export.get_header()])
+
+        for row in export:
+            yield writer.writerow([to_text(v).encode('utf-8') for v in row])
+
+
+class XLSXWriter(object):
+    """
+    Writes the workbook to a temporary file (openpyxl's write-only
+    mode doesn't keep the rows in memory) and streams that
+    """
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    extension = 'xlsx'
+
+    def clean(self, value):
+        if value is None or isinstance(value, (int, long, float, basestring)):
+            return value
+        return to_text(value)
+
+    def write(self, export):
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(export.get_header())
+
+        for row in export:
+            sheet.append([self.clean(v) for v in row])
+
+        with TemporaryFile() as fh:
+            workbook.save(fh)
+            fh.seek(0)
+
+            for chunk in iter(lambda: fh.read(64*1024), ''):
+                yield chunk
+
+
+WRITERS = {
+    'txt': TSVWriter,
+    'tsv': TSVWriter,
+    'csv': CSVWriter,
+    'xlsx': XLSXWriter,
+}
+
+
+def send_export(export, filename, format='txt'):
+    """
+    Sends export as a file in format (txt, csv or xlsx)
+    """
+    try:
+        writer = WRITERS[format]()
+    except KeyError:
+        raise ValueError('Invalid export format: %s' % format)
+
+    response = StreamingHttpResponse(writer.write(export),
+                                     content_type=writer.content_type)
+    filename = '%s.%s' % (filename, writer.extension)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text and trigram search of notes, customers, products and devices.
+
+A searchable model has a search_vector column and these attributes:
+- SEARCH_VECTOR: the (field, weight) pairs that go into the vector
+- SEARCH_TRIGRAMS: identifiers (serial numbers, part numbers...) that
+  also match partially, through their pg_trgm indexes
+- SEARCH_HEADLINE: the field that results highlight, if any
+
+The vector is written together with the row whenever it is saved.
+Rows written with raw SQL are refreshed with update_vectors().
+"""
+
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.db import connection, models
+from django.utils.html import escape
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import pre_save, post_save
+
+
+# Postgres text search configurations of the install languages
+CONFIGS = {
+    'da': 'danish',
+    'en': 'english',
+    'fi': 'finnish',
+    'nl': 'dutch',
+    'sv': 'swedish',
+}
+
+CHUNK_SIZE = 5000
+
+# ts_headline doesn't escape, so matches are marked with these
+# and turned into HTML after the headline has been escaped
+START_SEL, STOP_SEL = '[[[', ']]]'
+HEADLINE_OPTIONS = 'StartSel="%s", StopSel="%s", MaxFragments=2' % (START_SEL, STOP_SEL)
+
+
+class TSVectorField(models.Field):
+    description = 'PostgreSQL text search vector'
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super(TSVectorField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        return 'tsvector'
+
+
+def get_config():
+    """
+    Returns the text search configuration of the install locale
+    """
+    language = getattr(settings, 'INSTALL_LOCALE', 'en')[:2]
+    return CONFIGS.get(language, 'simple')
+
+
+def get_terms(query):
+    """
+    Returns query as a tsquery of word prefixes, so that
+    partially typed words match too
+    """
+    words = re.findall(r'\w+', query, re.UNICODE)
+    return u' & '.join([u'%s:*' % w for w in words])
+
+
+def get_vector_sql(fields, values):
+    """
+    Returns the SQL of a search vector of these (field, weight) pairs.
+    values is the SQL of each field.
+    """
+    config = get_config()
+    sql = "setweight(to_tsvector('%s', COALESCE(%s, '')), '%s')"
+    return ' || '.join([sql % (config, v, w[1]) for v, w in zip(values, fields)])
+
+
+def get_column_sql(model, field):
+    qn = connection.ops.quote_name
+    column = model._meta.get_field(field).column
+    return '%s.%s' % (qn(model._meta.db_table), qn(column))
+
+
+def update_vectors(model, ids=None, fields=None):
+    """
+    Recomputes the search vectors of these rows of model (all if ids
+    is None) in one statement. Returns the number of rows updated.
+    fields defaults to the SEARCH_VECTOR of model.
+    """
+    fields = fields or model.SEARCH_VECTOR
+    columns = [get_column_sql(model, f) for f, w in fields]
+    sql = 'UPDATE %s SET search_vector = %s' % (
+        connection.ops.quote_name(model._meta.db_table),
+        get_vector_sql(fields, columns)
+    )
+    params = []
+
+    if ids is not None:
+        if not ids:
+            return 0
+        sql += ' WHERE id = ANY(%s)'
+        params.append(list(ids))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.rowcount
+
+
+def reindex(model, chunk_size=CHUNK_SIZE, fields=None):
+    """
+    Recomputes all the search vectors of model one chunk of rows
+    at a time, to keep the transactions short.
+    Migrations pass the fields, historical models don't have SEARCH_VECTOR.
+    """
+    count, last_pk = 0, 0
+    ids = model.objects.order_by('pk').values_list('pk', flat=True)
+
+    while True:
+        chunk = list(ids.filter(pk__gt=last_pk)[:chunk_size])
+
+        if not chunk:
+            break
+
+        count += update_vectors(model, chunk, fields)
+        last_pk = chunk[-1]
+
+    return count
+
+
+def search(queryset, query):
+    """
+    Returns the rows of queryset matching query, best matches first.
+    The rows get a rank and, if the model has a SEARCH_HEADLINE,
+    a headline of the matching parts of that field.
+    """
+    model = queryset.model
+    terms = get_terms(query)
+    tsquery = "to_tsquery('%s', %%s)" % get_config()
+    vector = get_column_sql(model, 'search_vector')
+
+    where, params = [], []
+    rank, rank_params = [], []
+
+    if terms:
+        where.append('%s @@ %s' % (vector, tsquery))
+        params.append(terms)
+        rank.append('ts_rank(%s, %s)' % (vector, tsquery))
+        rank_params.append(terms)
+
+    pattern = re.sub(r'([\\%_])', r'\\\1', query.strip())
+
+    for field in model.SEARCH_TRIGRAMS:
+        if not pattern:
+            break
+
+        column = get_column_sql(model, field)
+        where.append('UPPER(%s::text) LIKE UPPER(%%s)' % column)
+        params.append(u'%%%s%%' % pattern)
+        rank.append('similarity(%s, %%s)' % column)
+        rank_params.append(query)
+
+    if not where:
+        return queryset.none()
+
+    rank = ['COALESCE(%s, 0)' % r for r in rank]
+    select = OrderedDict([('rank', ' + '.join(rank))])
+    select_params = rank_params
+
+    if terms and model.SEARCH_HEADLINE:
+        column = get_column_sql(model, model.SEARCH_HEADLINE)
+        select['headline'] = "ts_headline('%s', COALESCE(%s, ''), %s, '%s')" % (
+            get_config(), column, tsquery, HEADLINE_OPTIONS
+        )
+        select_params = select_params + [terms]
+
+    return queryset.extra(
+        select=select,
+        select_params=select_params,
+        where=['(%s)' % ' OR '.join(where)],
+        params=params,
+        order_by=['-rank']
+    )
+
+
+def highlight(headline):
+    """
+    Returns this headline as HTML with the matches in bold
+    """
+    html = escape(headline)
+    html = html.replace(START_SEL, '<strong>').replace(STOP_SEL, '</strong>')
+    return html
+
+
+@receiver(pre_save)
+def trigger_vector_saving(sender, instance, raw=False, **kwargs):
+    if raw or not hasattr(sender, 'SEARCH_VECTOR'):
+        return
+
+    values = [getattr(instance, f) or u'' for f, w in sender.SEARCH_VECTOR]
+    instance.search_vector = RawSQL(
+        get_vector_sql(sender.SEARCH_VECTOR, ['%s'] * len(values)),
+        [unicode(v) for v in values]
+    )
+
+
+@receiver(post_save)
+def trigger_vector_saved(sender, instance, raw=False, **kwargs):
+    # the next full save writes the vector again
+    if hasattr(sender, 'SEARCH_VECTOR'):
+        instance.search_vector = None
@@ -3,6 +3,7 @@
 import json
 import html2text
 import subprocess
+from django.db.models import Q
 from django.http import HttpResponse
 from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
@@ -30,6 +31,102 @@ def paginate(queryset, page, count=10):
     return results
 
 
+class KeysetPage(object):
+    """
+    A page of results fetched by seeking past the last row of the
+    previous page instead of using OFFSET. keys should be integer
+    fields that together order the rows uniquely, ie ('-priority', 'id')
+    """
+    def __init__(self, queryset, keys, count=100, after=None, before=None):
+        self.keys = keys
+        self.has_next = False
+        self.has_previous = False
+
+        cursor = self.decode(after or before)
+        backwards = bool(before) and cursor is not None
+        ordering = list(keys)
+
+        if cursor is not None:
+            queryset = queryset.filter(self.seek(cursor, backwards))
+
+        if backwards:
+            ordering = [self.flip(k) for k in keys]
+
+        rows = list(queryset.order_by(*ordering)[:count+1])
+        more = len(rows) > count
+        rows = rows[:count]
+
+        if backwards:
+            rows.reverse()
+            self.has_next, self.has_previous = True, more
+        else:
+            self.has_next, self.has_previous = more, cursor is not None
+
+        # object_list may be replaced with something to display,
+        # the cursors are always built from the fetched rows
+        self.rows = self.object_list = rows
+
+    @staticmethod
+    def flip(key):
+        return key[1:] if key.startswith('-') else '-' + key
+
+    def decode(self, cursor):
+        try:
+            values = [int(v) for v in cursor.split('.')]
+        except (AttributeError, ValueError):
+            return
+
+        if len(values) == len(self.keys):
+            return values
+
+    def encode(self, row):
+        return '.'.join([str(getattr(row, k.lstrip('-'))) for k in self.keys])
+
+    def seek(self, values, backwards=False):
+        """
+        Returns the filter that selects rows after (or before) values
+        """
+        result = Q()
+
+        for i, key in enumerate(self.keys):
+            name = key.lstrip('-')
+            op = 'lt' if key.startswith('-') != backwards else 'gt'
+            clause = Q(**{'%s__%s' % (name, op): values[i]})
+
+            for k, v in zip(self.keys[:i], values[:i]):
+                clause &= Q(**{k.lstrip('-'): v})
+
+            result |= clause
+
+        return result
+
+    @property
+    def next_cursor(self):
+        if self.rows:
+            return self.encode(self.rows[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.rows:
+            return self.encode(self.rows[0])
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_paginate(queryset, args, count=100, keys=('-priority', 'id',)):
+    """
+    Shortcut for paginating a queryset with the after/before request args
+    """
+    return KeysetPage(queryset, keys, count, args.get('after'), args.get('before'))
+
+
 def text_response(data):
     return HttpResponse(data, content_type='text/plain; charset=utf-8')
 
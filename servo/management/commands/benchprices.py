@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+from django.core.management.base import BaseCommand
+
+from servo.models import PriceEngine, config_snapshot
+
+
+class Part(object):
+    """
+    Looks enough like a GSX partDetail to be priced
+    """
+    def __init__(self, i):
+        self.originalPartNumber = None
+        self.partNumber = '661-%05d' % i
+        self.partDescription = 'Part %d' % i
+        self.stockPrice = '%d.%02d' % (random.randint(5, 900), random.randint(0, 99))
+        self.exchangePrice = random.choice(['', self.stockPrice])
+        self.laborTier = 'L1'
+        self.partType = 'Module'
+        self.eeeCode = '01ABC'
+        self.componentCode = 'A'
+        self.isSerialized = 'N'
+
+
+class Command(BaseCommand):
+
+    help = "Measures how long pricing a GSX parts list takes per part"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parts', type=int, default=150)
+        parser.add_argument('--rounds', type=int, default=100)
+
+    def handle(self, *args, **options):
+        parts = [Part(i) for i in range(options['parts'])]
+        conf = config_snapshot.get()
+        rounds = options['rounds']
+
+        # a new engine every round, so the price memo starts out empty
+        started = time.time()
+        for i in range(rounds):
+            PriceEngine(conf).price_parts(parts)
+        elapsed = time.time() - started
+
+        per_part = elapsed / (rounds * len(parts)) * 10**6
+        print('%d parts x %d rounds: %.1f us per part' % (len(parts), rounds, per_part))
@@ -1,34 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import logging
-from email.parser import Parser
-
 from django.core.management.base import BaseCommand
 
-from servo.models import Configuration, Note, User
+from servo.messaging.imap import MailboxSync
 
 
 class Command(BaseCommand):
     help = "Checks IMAP box for new mail"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--idle', action='store_true', default=False,
+                            help='Keep waiting for new mail with IMAP IDLE')
+
     def handle(self, *args, **options):
-        uid = Configuration.conf('imap_act')
-
-        if uid == '':
-            raise ValueError('Incoming message user not configured')
-
-        user = User.objects.get(pk=uid)
-        server = Configuration.get_imap_server()
-        typ, data = server.search(None, "UnSeen")
-
-        for num in data[0].split():
-            #logging.debug("** Processing message %s" % num)
-            typ, data = server.fetch(num, "(RFC822)")
-            # parsestr() seems to return an email.message?
-            msg = Parser().parsestr(data[0][1])
-            Note.from_email(msg, user)
-            #server.copy(num, 'servo')
-            server.store(num, '+FLAGS', '\\Seen')
-
-        server.close()
-        server.logout()
+        sync = MailboxSync.connect()
+
+        try:
+            print('%d messages processed' % sync.sync())
+
+            while options['idle']:
+                # sync after every IDLE period, in case a notification was missed
+                sync.idle()
+                print('%d messages processed' % sync.sync())
+        finally:
+            sync.close()
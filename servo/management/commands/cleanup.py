@@ -23,10 +23,12 @@ class Command(BaseCommand):
             im.save(infile, "JPEG")
 
         logging.info("Cleaning up unused attachments")
-        for infile in glob("servo/uploads/attachments/*"):
-            fn = infile.decode('utf-8')
-            fp = os.path.join("attachments", os.path.basename(fn))
-            try:
-                Attachment.objects.get(content=fp)
-            except Attachment.DoesNotExist:
-                os.remove(infile)
+        for root, dirs, files in os.walk("servo/uploads/attachments"):
+            for fn in files:
+                if fn.startswith('.upload-'):
+                    continue # still being stored
+                infile = os.path.join(root, fn)
+                fp = os.path.relpath(infile, "servo/uploads").decode('utf-8')
+                # files are shared by attachments with the same contents
+                if not Attachment.objects.filter(content=fp).exists():
+                    os.remove(infile)
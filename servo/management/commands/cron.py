@@ -3,12 +3,12 @@
 import gsxws
 from datetime import date, timedelta
 
-from django.conf import settings
 from django.core.files import File
 from django.core.mail import send_mail
 from django.core.validators import validate_email
 from django.utils.translation import ugettext as _
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 
 from django.db.models import F
@@ -29,16 +29,9 @@ def send_table(sender, recipient, subject, table, send_empty=False):
     except Exception:
         return
 
-    config = Configuration.conf()
-    host, port = Configuration.get_smtp_server()
-
-    settings.EMAIL_HOST = host
-    settings.EMAIL_PORT = int(port)
-    settings.EMAIL_USE_TLS = config.get('smtp_ssl')
-    settings.EMAIL_HOST_USER = config.get('smtp_user')
-    settings.EMAIL_HOST_PASSWORD = config.get('smtp_password')
-
-    send_mail(subject, unicode(table), sender, [recipient], fail_silently=False)
+    connection = Configuration.get_smtp_connection()
+    send_mail(subject, unicode(table), sender, [recipient],
+              fail_silently=False, connection=connection)
 
 
 class Command(BaseCommand):
@@ -135,5 +128,6 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         #self.update_invoices()
         self.update_counts()
+        call_command('recountorders')
         self.notify_aging_repairs()
         self.notify_stock_limits()
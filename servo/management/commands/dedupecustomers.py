@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from servo.lib import dedupe
+from servo.models import Customer
+
+
+class Command(BaseCommand):
+
+    help = "Finds duplicate customers and merges them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-score', type=float, default=dedupe.MIN_SCORE,
+                            help='Merge pairs scoring at least this (0-1)')
+        parser.add_argument('--max-block', type=int, default=Customer.DEDUPE_MAX_BLOCK,
+                            help='Ignore emails, phones and names shared by more customers')
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='Number of customers merged at a time')
+        parser.add_argument('--normalize', action='store_true', default=False,
+                            help='Recompute the normalized columns first')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report the duplicates without merging them')
+
+    def handle(self, *args, **options):
+        if options['normalize']:
+            print('%d customers normalized' % Customer.normalize_all())
+
+        pairs, candidates = [], 0
+
+        for a, b, score in Customer.find_duplicates(options['max_block']):
+            candidates += 1
+            if score >= options['min_score']:
+                pairs.append((a, b))
+                if options['verbosity'] > 1:
+                    print('%d = %d (%.2f)' % (a, b, score))
+
+        merges = dedupe.group_pairs(pairs)
+        print('%d candidate pairs, %d duplicates' % (candidates, len(pairs)))
+
+        if options['dry_run']:
+            print('%d customers would be merged into %d' % (
+                len(merges), len(set(merges.values()))))
+            return
+
+        merged, merges = 0, sorted(merges.items())
+        batch = options['batch']
+
+        for i in range(0, len(merges), batch):
+            merged += Customer.merge_many(dict(merges[i:i + batch]))
+
+        print('%d customers merged' % merged)
@@ -1,103 +1,272 @@
 # -*- coding: utf-8 -*-
 
+import io
 import re
 import os
-import logging
+from cStringIO import StringIO
 
 from decimal import Decimal, InvalidOperation, ROUND_CEILING
 
-from django.db import DatabaseError
+from django.db import connection, transaction
 from django.core.management.base import BaseCommand
 from django.contrib.contenttypes.models import ContentType
+from django.template.defaultfilters import slugify
 
-from servo.models import Product, TaggedItem
+from servo.lib.search import update_vectors
+from servo.models import Product, PriceEngine
 
 
-class Command(BaseCommand):
+CHUNK_SIZE = 5000
 
-    help = "Imports complete GSX parts database"
+COLUMNS = ('line', 'code', 'title', 'part_type', 'labour_tier', 'eee_code',
+           'component_code', 'is_serialized', 'tag', 'slug',
+           'price_purchase_stock', 'pct_margin_stock',
+           'price_notax_stock', 'price_sales_stock',
+           'price_purchase_exchange', 'pct_margin_exchange',
+           'price_notax_exchange', 'price_sales_exchange',)
 
-    def handle(self, *args, **options):
+CREATE_SQL = """CREATE TEMPORARY TABLE servo_partsimport (
+    line integer, code text, title text, part_type text, labour_tier text,
+    eee_code text, component_code text, is_serialized boolean,
+    tag text, slug text,
+    price_purchase_stock numeric, pct_margin_stock numeric,
+    price_notax_stock numeric, price_sales_stock numeric,
+    price_purchase_exchange numeric, pct_margin_exchange numeric,
+    price_notax_exchange numeric, price_sales_exchange numeric
+) ON COMMIT DROP"""
 
-        update_prices = True
-        import_vintage = True
-        dbpath = "servo/uploads/products/partsdb.csv"
+# the last row of a part wins, like it did when rows were saved one by one
+DEDUPE_SQL = """DELETE FROM servo_partsimport i USING servo_partsimport j
+    WHERE i.code = j.code AND i.line < j.line"""
 
-        try:
-            partsdb = open(dbpath, "r")
-        except Exception:
-            pass
+PRICES = ('stock', 'exchange',)
+
+
+def get_updates(new, update_prices=True):
+    """
+    Returns the (column, new value) SQL of the product columns the
+    import updates. Parts without a price don't touch the old prices
+    and fixed prices are only updated to the new purchase price.
+    """
+    updates = [(c, '%s.%s' % (new, c)) for c in ('title', 'part_type',
+               'labour_tier', 'eee_code', 'component_code', 'is_serialized',)]
+
+    if not update_prices:
+        return updates
+
+    for kind in PRICES:
+        missing = '%s.price_purchase_%s = 0' % (new, kind)
+        c = 'price_purchase_%s' % kind
+        updates.append((c, 'CASE WHEN %s THEN p.%s ELSE %s.%s END' % (missing, c, new, c)))
+
+        for c in ('pct_margin_%s', 'price_notax_%s', 'price_sales_%s',):
+            c = c % kind
+            sql = 'CASE WHEN p.fixed_price OR %s THEN p.%s ELSE %s.%s END'
+            updates.append((c, sql % (missing, c, new, c)))
 
-        content_type = ContentType.objects.get(model="product")
+    return updates
 
-        for l in partsdb.readlines():
 
-            line = l.decode("iso-8859-1")
-            row = line.strip().split("\t")
+def get_changed(new, update_prices=True):
+    """
+    Returns the SQL condition of product p changing
+    """
+    updates = get_updates(new, update_prices)
+    old = ', '.join(['p.%s' % c for c, v in updates])
+    return '(%s) IS DISTINCT FROM (%s)' % (old, ', '.join([v for c, v in updates]))
 
-            if row[5] == "" or row[5] == "Currency":
-                continue  # Skip header row and rows without currency
 
-            logging.debug(row)
+def copy_value(value):
+    """
+    Returns value in the text format of COPY
+    """
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bool):
+        return u't' if value else u'f'
 
-            category = row[0]
+    value = unicode(value)
+    value = value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+    return value.replace(u'\n', u'\\n').replace(u'\r', u'\\r')
 
-            if re.match(r'~VIN', category) and not import_vintage:
-                continue  # Skip vintage devices if so desired
 
-            p_number = row[1]
+def to_price(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return Decimal(0)
 
-            if re.match(r'675-', p_number):
-                continue  # Skip DEPOT REPAIR INVOICE
 
-            p_title = row[2]
-            p_type = row[3]
-            lab_tier = row[4]
+class Command(BaseCommand):
+
+    help = "Imports complete GSX parts database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            default='servo/uploads/products/partsdb.csv')
+        parser.add_argument('--skip-vintage', action='store_true', default=False,
+                            help='Skip parts of vintage devices')
+        parser.add_argument('--keep-prices', action='store_true', default=False,
+                            help="Don't update the prices of existing products")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report the changes without saving them')
+        parser.add_argument('--keep-file', action='store_true', default=False)
+
+    def parse_row(self, line, number):
+        """
+        Returns the staging table row of this line of the parts database
+        or None if the part should be skipped
+        """
+        row = line.rstrip(u'\r\n').split(u'\t')
 
-            try:
-                stock_price = Decimal(row[6])
-            except InvalidOperation:
-                continue  # Skip parts with no stock price
+        if len(row) < 13 or row[5] in (u'', u'Currency'):
+            return  # Skip header row and rows without currency
 
-            exchange_price = Decimal(row[7])
+        category = row[0]
 
-            eee_code = row[8]
+        if self.skip_vintage and re.match(r'~VIN', category):
+            return  # Skip vintage devices if so desired
 
-            # skip substitute
-            component_group = row[10] or None
-            is_serialized = row[11]
-            req_diag = (row[12] == "Y")
+        code = row[1].strip()
 
-            product, created = Product.objects.get_or_create(code=p_number)
+        if not code or re.match(r'675-', code):
+            return  # Skip DEPOT REPAIR INVOICE
+
+        try:
+            stock_price = Decimal(row[6])
+        except InvalidOperation:
+            return  # Skip parts with no stock price
+
+        result = [number, code[:32], row[2][:255], (row[3] or u'OTHER').upper()[:18],
+                  row[4][:15], row[8][:256], row[10][:1], row[11] == u'Y',
+                  category[:128], slugify(category)[:50]]
+
+        for price in (stock_price, to_price(row[7]),):
+            purchase_price = price.to_integral_exact(rounding=ROUND_CEILING)
+
+            if price > 0:
+                margin, wo_tax, with_tax = self.engine.get_price(price)
+            else:
+                margin, wo_tax, with_tax = self.engine.get_margin(price), 0, 0
+
+            result += [purchase_price, margin, wo_tax, with_tax]
+
+        return result
+
+    def read_chunks(self, fh):
+        """
+        Yields the valid rows of fh in chunks of CHUNK_SIZE
+        """
+        chunk = []
+
+        for number, line in enumerate(fh, 1):
+            self.read += 1
+            row = self.parse_row(line, number)
+
+            if row is None:
+                self.skipped += 1
+                continue
+
+            chunk.append(row)
+
+            if len(chunk) >= CHUNK_SIZE:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def copy_chunk(self, cursor, chunk):
+        buf = StringIO()
+
+        for row in chunk:
+            line = u'\t'.join([copy_value(v) for v in row]) + u'\n'
+            buf.write(line.encode('utf-8'))
+
+        buf.seek(0)
+        cursor.copy_from(buf, 'servo_partsimport', columns=COLUMNS)
+
+    def report(self, cursor, changed):
+        cursor.execute("""SELECT COUNT(p.id), COUNT(*) - COUNT(p.id),
+            COUNT(p.id) FILTER (WHERE %s)
+            FROM servo_partsimport i LEFT JOIN servo_product p ON (p.code = i.code)""" % changed)
+        existing, new, updated = cursor.fetchone()
+
+        print('%d lines read, %d skipped' % (self.read, self.skipped))
+        print('%d new parts, %d changed, %d unchanged' % (new, updated, existing - updated))
+
+        if self.verbosity > 1:
+            cursor.execute("""SELECT i.code, p.title, i.title,
+                p.price_sales_stock, i.price_sales_stock
+                FROM servo_partsimport i JOIN servo_product p ON (p.code = i.code)
+                WHERE %s ORDER BY i.code""" % changed)
+            for row in cursor.fetchall():
+                print((u'%s: %s (%s) -> %s (%s)' % row).encode('utf-8'))
+
+    def upsert(self, cursor, update_prices):
+        """
+        Saves the new and changed parts.
+        Only the changed products are locked.
+        """
+        columns = ', '.join(COLUMNS[1:8] + COLUMNS[10:])
+        updates = get_updates('EXCLUDED', update_prices)
+
+        cursor.execute("""INSERT INTO servo_product AS p (%s,
+            subst_code, description, pct_vat, fixed_price, warranty_period,
+            shelf, brand, shipping, total_amount)
+            SELECT %s, '', '', %%s, false, 0, '', '', %%s, 0
+            FROM servo_partsimport i
+            WHERE NOT EXISTS (SELECT 1 FROM servo_product p
+                WHERE p.code = i.code AND NOT %s)
+            ON CONFLICT (code) DO UPDATE SET %s
+            RETURNING id, (xmax = 0)""" % (columns, columns,
+                                       get_changed('i', update_prices),
+                                       ', '.join(['%s = %s' % u for u in updates])),
+            [self.engine.vat, float(self.engine.shipping)])
+
+        rows = cursor.fetchall()
+        created = [r[1] for r in rows].count(True)
+        print('%d parts created, %d updated' % (created, len(rows) - created))
+
+        update_vectors(Product, [r[0] for r in rows])
+
+        content_type = ContentType.objects.get_for_model(Product)
+        cursor.execute("""INSERT INTO servo_taggeditem
+            (content_type_id, object_id, tag, slug, color)
+            SELECT %s, p.id, i.tag, i.slug, ''
+            FROM servo_partsimport i JOIN servo_product p ON (p.code = i.code)
+            WHERE i.tag <> ''
+            ON CONFLICT (content_type_id, object_id, tag) DO NOTHING""",
+            [content_type.pk])
+        print('%d tags added' % cursor.rowcount)
+
+    def handle(self, *args, **options):
+        self.read, self.skipped = 0, 0
+        self.verbosity = options['verbosity']
+        self.skip_vintage = options['skip_vintage']
+        self.engine = PriceEngine.current()
+        update_prices = not options['keep_prices']
+        dbpath = options['path']
 
-            product.title = p_title
-            product.eee_code = eee_code
-            product.labour_tier = lab_tier
-            product.part_type = p_type or "OTHER"
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(CREATE_SQL)
 
-            product.component_code = component_group
-            product.is_serialized = (is_serialized == "Y")
+            with io.open(dbpath, 'r', encoding='iso-8859-1') as fh:
+                for chunk in self.read_chunks(fh):
+                    self.copy_chunk(cursor, chunk)
 
-            if update_prices:
-                if stock_price:
-                    purchase_sp = Decimal(stock_price)
-                    product.price_purchase_stock = purchase_sp.to_integral_exact(rounding=ROUND_CEILING)
-                    product.set_stock_sales_price()
+            cursor.execute('CREATE INDEX ON servo_partsimport (code)')
+            cursor.execute(DEDUPE_SQL)
+            cursor.execute('ANALYZE servo_partsimport')
 
-                if exchange_price:
-                    purchase_ep = Decimal(exchange_price)
-                    product.price_purchase_exchange = purchase_ep.to_integral_exact(rounding=ROUND_CEILING)
-                    product.set_exchange_sales_price()
+            self.report(cursor, get_changed('i', update_prices))
 
-            product.save()
+            if options['dry_run']:
+                print('Dry run, nothing saved')
+                return
 
-            try:
-                tag, created = TaggedItem.objects.get_or_create(
-                    content_type=content_type,
-                    object_id=product.pk,
-                    tag=category)
-                tag.save()
-            except DatabaseError:
-                pass
+            self.upsert(cursor, update_prices)
 
-        os.unlink(dbpath)
+        if not options['keep_file']:
+            os.unlink(dbpath)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from servo.models import Queue, Status, Template
+from servo.models.rules import Rule, Condition, Action
+
+
+class Command(BaseCommand):
+
+    help = "Imports the rules of local_rules.json into the database"
+
+    CONDITIONS = {
+        'set_status': ('STATUS', Status),
+        'set_queue': ('QUEUE', Queue),
+    }
+
+    ACTIONS = {
+        'send_email': 'SEND_EMAIL',
+        'send_sms': 'SEND_SMS',
+        'set_queue': 'SET_QUEUE',
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='local_rules.json')
+
+    def handle(self, *args, **options):
+        imported = 0
+
+        with open(options['path'], 'r') as fh:
+            rules = json.load(fh)
+
+        with transaction.atomic():
+            for r in rules:
+                try:
+                    key, model = self.CONDITIONS[r['event']]
+                    action = self.ACTIONS[r['action']]
+                except KeyError:
+                    print('Skipping unsupported rule: %s %s' % (r['event'], r['action']))
+                    continue
+
+                try:
+                    obj = model.objects.get(title=r['match'])
+                except (KeyError, model.DoesNotExist):
+                    print('Skipping rule without a valid match: %s' % r)
+                    continue
+
+                data = r['data']
+
+                if isinstance(data, dict):
+                    data = Template.objects.get(pk=data['template']).content
+
+                rule = Rule.objects.create(description=u'%s: %s' % (r['event'], r['match']))
+                Condition.objects.create(rule=rule, key=key, value=str(obj.pk))
+                Action.objects.create(rule=rule, key=action, value=data)
+                imported += 1
+
+        print('%d rules imported' % imported)
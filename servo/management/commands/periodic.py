@@ -6,10 +6,9 @@ import gsxws
 import subprocess
 from time import strftime
 from django.conf import settings
-from django.core.cache import caches
 from django.core.management.base import BaseCommand
 
-from servo.models import GsxAccount, Article
+from servo.models import GsxAccount, Article, ComptiaCode
 
 
 class Command(BaseCommand):
@@ -43,7 +42,7 @@ class Command(BaseCommand):
         if 'comptia' in options['verb']: # Update raw CompTIA data (all product groups)
             try:
                 codes = gsxws.comptia.fetch()
-                caches['comptia'].set('codes', codes)
+                ComptiaCode.refresh(codes)
             except Exception as e:
                 print >> sys.stderr, 'Failed to fetch CompTIA codes (%s)' % e
                 sys.exit(-1)
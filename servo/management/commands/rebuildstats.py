@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from servo.models import StatsRollup
+
+
+COLUMNS = """INSERT INTO servo_statsrollup (day, metric, key, location_id,
+    queue_id, user_id, created_by_id, count, total)"""
+
+QUERIES = (
+    """SELECT (created_at AT TIME ZONE %s)::date, 'created', '',
+        COALESCE(location_id, 0), COALESCE(queue_id, 0),
+        COALESCE(user_id, 0), COALESCE(created_by_id, 0), COUNT(*), 0
+    FROM servo_order
+    WHERE created_at IS NOT NULL
+    GROUP BY 1, 4, 5, 6, 7""",
+
+    """SELECT (started_at AT TIME ZONE %s)::date, 'started', '',
+        COALESCE(location_id, 0), COALESCE(queue_id, 0),
+        COALESCE(user_id, 0), COALESCE(created_by_id, 0), COUNT(*), 0
+    FROM servo_order
+    WHERE started_at IS NOT NULL AND created_at IS NOT NULL
+    GROUP BY 1, 4, 5, 6, 7""",
+
+    """SELECT (closed_at AT TIME ZONE %s)::date, 'closed', '',
+        COALESCE(location_id, 0), COALESCE(queue_id, 0),
+        COALESCE(user_id, 0), COALESCE(created_by_id, 0), COUNT(*),
+        SUM(EXTRACT(EPOCH FROM closed_at - created_at))
+    FROM servo_order
+    WHERE closed_at IS NOT NULL AND created_at IS NOT NULL
+    GROUP BY 1, 4, 5, 6, 7""",
+
+    """SELECT (e.triggered_at AT TIME ZONE %s)::date, 'status', e.description,
+        COALESCE(o.location_id, 0), COALESCE(o.queue_id, 0),
+        COALESCE(o.user_id, 0), e.triggered_by_id, COUNT(*), 0
+    FROM servo_event e, servo_order o, django_content_type ct
+    WHERE e.action = 'set_status'
+        AND e.object_id = o.id
+        AND e.content_type_id = ct.id
+        AND ct.app_label = 'servo' AND ct.model = 'order'
+    GROUP BY 1, 3, 4, 5, 6, 7""",
+
+    """SELECT (i.created_at AT TIME ZONE %s)::date, 'invoiced', '',
+        COALESCE(i.location_id, 0), COALESCE(o.queue_id, 0),
+        COALESCE(o.user_id, 0), i.created_by_id, COUNT(*), SUM(i.total_gross)
+    FROM servo_invoice i, servo_order o
+    WHERE i.order_id = o.id
+    GROUP BY 1, 4, 5, 6, 7""",
+
+    """SELECT (po.submitted_at AT TIME ZONE %s)::date, 'purchased', '',
+        COALESCE(po.location_id, 0), COALESCE(o.queue_id, 0),
+        COALESCE(o.user_id, 0), po.created_by_id, COUNT(*),
+        COALESCE(SUM((SELECT SUM(poi.price*poi.amount)
+            FROM servo_purchaseorderitem poi
+            WHERE poi.purchase_order_id = po.id)), 0)
+    FROM servo_purchaseorder po LEFT OUTER JOIN servo_order o
+        ON (po.sales_order_id = o.id)
+    WHERE po.submitted_at IS NOT NULL
+    GROUP BY 1, 4, 5, 6, 7""",
+)
+
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the statistics rollups from orders and events"
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        with transaction.atomic():
+            StatsRollup.objects.all().delete()
+
+            for sql in QUERIES:
+                cursor.execute(COLUMNS + sql, [settings.TIME_ZONE])
+
+        count = StatsRollup.objects.count()
+        print('%d rollups created' % count)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+
+    help = "Reconciles the inventory ledger and product totals with the inventory"
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        with transaction.atomic():
+            # Record whatever the ledger is missing as adjustments
+            cursor.execute("""INSERT INTO servo_inventorymovement (product_id,
+                location_id, kind, stocked, ordered, reserved, created_at)
+            SELECT i.product_id, i.location_id, 'adjust',
+                i.amount_stocked - COALESCE(m.stocked, 0),
+                i.amount_ordered - COALESCE(m.ordered, 0),
+                i.amount_reserved - COALESCE(m.reserved, 0), now()
+            FROM servo_inventory i LEFT OUTER JOIN (
+                SELECT product_id, location_id, SUM(stocked) AS stocked,
+                    SUM(ordered) AS ordered, SUM(reserved) AS reserved
+                FROM servo_inventorymovement
+                GROUP BY product_id, location_id
+            ) m ON (m.product_id = i.product_id AND m.location_id = i.location_id)
+            WHERE i.amount_stocked <> COALESCE(m.stocked, 0)
+                OR i.amount_ordered <> COALESCE(m.ordered, 0)
+                OR i.amount_reserved <> COALESCE(m.reserved, 0)""")
+            movements = cursor.rowcount
+
+            cursor.execute("""UPDATE servo_product p
+            SET total_amount = COALESCE(i.amount, 0)
+            FROM servo_product p2 LEFT OUTER JOIN (
+                SELECT product_id, SUM(amount_stocked) AS amount
+                FROM servo_inventory
+                GROUP BY product_id
+            ) i ON (i.product_id = p2.id)
+            WHERE p.id = p2.id
+                AND p.total_amount <> COALESCE(i.amount, 0)""")
+            products = cursor.rowcount
+
+        print('%d inventory adjustments, %d product totals fixed' % (movements, products))
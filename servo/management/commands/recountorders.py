@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+
+RECOUNT_SQL = """INSERT INTO servo_ordercounter (kind, object_id, state, count)
+    SELECT 'queue', queue_id, state, COUNT(*) FROM servo_order
+    WHERE queue_id IS NOT NULL GROUP BY queue_id, state
+    UNION ALL
+    SELECT 'user', user_id, state, COUNT(*) FROM servo_order
+    WHERE user_id IS NOT NULL GROUP BY user_id, state
+    UNION ALL
+    SELECT 'location', location_id, state, COUNT(*) FROM servo_order
+    GROUP BY location_id, state
+    UNION ALL
+    SELECT 'tag', t.tag_id, o.state, COUNT(*)
+    FROM servo_order_tags t JOIN servo_order o ON (o.id = t.order_id)
+    GROUP BY t.tag_id, o.state"""
+
+
+class Command(BaseCommand):
+
+    help = "Recounts the open order badges of queues, tags, users and locations"
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        with transaction.atomic():
+            # order changes wait for the recount instead of being lost
+            cursor.execute("LOCK TABLE servo_ordercounter IN EXCLUSIVE MODE")
+            cursor.execute("DELETE FROM servo_ordercounter")
+            cursor.execute(RECOUNT_SQL)
+            count = cursor.rowcount
+
+        print('%d order counters rebuilt' % count)
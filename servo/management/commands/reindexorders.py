@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from servo.models import Order, OrderSearchIndex
+
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the order search index"
+
+    def handle(self, *args, **options):
+        count = 0
+        orders = Order.objects.select_related('customer', 'status')
+
+        for o in orders.iterator():
+            OrderSearchIndex.rebuild(o)
+            count += 1
+
+        print('%d orders indexed' % count)
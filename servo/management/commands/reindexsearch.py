@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from servo.lib.search import reindex
+from servo.models import Note, Customer, Product, Device
+
+
+MODELS = {
+    'notes': Note,
+    'customers': Customer,
+    'products': Product,
+    'devices': Device,
+}
+
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the full-text search vectors of notes, customers, products and devices"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Any of %s' % ', '.join(sorted(MODELS)))
+        parser.add_argument('--batch', type=int, default=5000,
+                            help='Number of rows updated at a time')
+
+    def handle(self, *args, **options):
+        names = options['models'] or sorted(MODELS)
+
+        for name in names:
+            if name not in MODELS:
+                raise CommandError('Unknown model: %s' % name)
+
+        for name in names:
+            count = reindex(MODELS[name], options['batch'])
+            print('%d %s indexed' % (count, name))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.core.management.base import BaseCommand
+
+from servo.models import Attachment
+
+
+class Command(BaseCommand):
+
+    help = "Moves attachments stored before content addressing into the store"
+
+    def handle(self, *args, **options):
+        moved, removed = 0, 0
+
+        for a in Attachment.objects.filter(sha256='').iterator():
+            old = a.content.name
+            name = os.path.basename(old)
+
+            try:
+                with open(a.content.path, 'rb') as fh:
+                    path, sha256, mime_type = Attachment.store(fh, name)
+            except IOError as e:
+                print('Skipping %s (%s)' % (old, e))
+                continue
+
+            Attachment.objects.filter(pk=a.pk).update(content=path,
+                                                      sha256=sha256,
+                                                      name=name[:255],
+                                                      mime_type=mime_type)
+            moved += 1
+
+            if not Attachment.objects.filter(content=old).exists():
+                os.remove(a.content.path)
+                removed += 1
+
+        print('%d attachments stored, %d old files removed' % (moved, removed))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from servo.lib.export import iterate
+from servo.models import Order
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the money totals of all orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000,
+                            help='Number of orders recomputed at a time')
+
+    def handle(self, *args, **options):
+        batch, counts = [], [0, 0]
+
+        def flush(batch):
+            totals, changed = Order.refresh_totals(batch)
+            counts[0] += len(totals)
+            counts[1] += changed
+
+        for o in iterate(Order.objects.only('pk'), options['batch']):
+            batch.append(o.pk)
+            if len(batch) >= options['batch']:
+                flush(batch)
+                batch = []
+
+        flush(batch)
+
+        print('%d orders recomputed, %d changed' % tuple(counts))
@@ -1,39 +1,49 @@
 # -*- coding: utf-8 -*-
 
-import sys
-import logging
+from datetime import timedelta
 
+from django.db.models import Q
+from django.utils import timezone
 from django.core.management.base import BaseCommand
-from servo.models import (Product, GsxAccount, User,)
+
+from servo.lib.export import iterate
+from servo.models import Product, GsxAccount, User
 
 
 class Command(BaseCommand):
+
     help = "Updates all part prices from GSX"
 
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User whose GSX account to use')
+        parser.add_argument('--max-age', type=int, default=20,
+                            help='Skip products updated within this many hours')
+        parser.add_argument('--workers', type=int, default=Product.PRICE_WORKERS,
+                            help='Number of concurrent GSX lookups')
+        parser.add_argument('--batch', type=int, default=200,
+                            help='Number of products written at a time')
+
     def handle(self, *args, **options):
-        if len(args) < 1:
-            print "Usage: updateprices username [start:finish]"
-            sys.exit(1)
-        
-        start, counter = 0, 0
-        finish = 999999999999
+        GsxAccount.default(User.objects.get(username=options['username']))
 
-        if len(args) == 2:
-            start, finish = args[1].split(':')
+        limit = timezone.now() - timedelta(hours=options['max_age'])
+        products = Product.objects.exclude(part_type='SERVICE')
+        products = products.exclude(fixed_price=True)
+        products = products.filter(Q(price_updated_at=None) | Q(price_updated_at__lt=limit))
 
-        GsxAccount.default(User.objects.get(username=args[0]))
+        batch, counts = [], [0, 0, 0]
 
-        products = Product.objects.filter(pk__gt=start, pk__lt=finish)
-        products = products.exclude(part_type='SERVICE')
-        products = products.exclude(fixed_price=True)
+        def flush(batch):
+            result = Product.refresh_prices(batch, options['workers'])
+            for i, c in enumerate(result):
+                counts[i] += c
+
+        for p in iterate(products, options['batch']):
+            batch.append(p)
+            if len(batch) >= options['batch']:
+                flush(batch)
+                batch = []
 
-        for i in products.order_by('id'):
-            logging.debug('Updating product %d' % i.pk)
-            try:
-                i.update_price()
-                i.save()
-                counter += 1
-            except Exception as e:
-                logging.debug(e)
+        flush(batch)
 
-        print '%d product prices updated' % counter
+        print('%d product prices updated, %d unchanged, %d failed' % tuple(counts))
@@ -9,13 +9,12 @@ class Command(BaseCommand):
 
     help = "Updates statuses and details of open GSX repairs"
 
-    def handle(self, *args, **options):
-        repairs = Repair.objects.filter(completed_at=None)
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=Repair.POLL_WORKERS,
+                            help='Number of concurrent GSX lookups per account')
+        parser.add_argument('--rate', type=int, default=Repair.POLL_RATE,
+                            help='Max number of GSX lookups per second per account')
 
-        for r in repairs.exclude(confirmation=""):
-            r.connect_gsx()
-            try:
-                details = r.get_details()
-                r.update_details(details)
-            except Exception:
-                pass
+    def handle(self, *args, **options):
+        counts = Repair.poll(options['workers'], options['rate'])
+        print('%d repairs checked, %d changed, %d failed' % counts)
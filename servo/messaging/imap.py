@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental IMAP mailbox sync.
+Messages are found by UID so that every sync only asks for what
+arrived after the previous one, and are fetched in batches.
+"""
+
+import re
+import ssl
+import base64
+import logging
+import quopri
+import socket
+from cStringIO import StringIO
+from tempfile import TemporaryFile
+from email.parser import Parser
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+from django.utils import timezone
+from django.core.cache import cache
+
+from servo.lib.utils import empty
+from servo.exceptions import ConfigurationError
+from servo.models import Configuration, User, Note, MailboxState
+
+
+BATCH_SIZE = 50                 # messages per UID FETCH
+BATCH_BYTES = 20*1024*1024      # or this much message data
+WORKERS = 4
+CHUNK_SIZE = 64*1024            # a multiple of 4 for base64
+IDLE_TIMEOUT = 25*60            # servers may drop IDLE after 30 minutes
+LOCK_TIMEOUT = 10*60
+MAX_ATTEMPTS = 3                # tries to save a message before giving up
+
+UID_RE = re.compile(r'UID (\d+)')
+SIZE_RE = re.compile(r'RFC822\.SIZE (\d+)')
+
+
+def decode_part(part):
+    """
+    Decodes the payload of a message part into a temporary file
+    one chunk at a time
+    """
+    fh = TemporaryFile()
+    payload = StringIO(part.get_payload())
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+
+    if encoding == 'base64':
+        buf = ''
+        for line in payload:
+            buf += line.strip()
+            if len(buf) >= CHUNK_SIZE:
+                end = len(buf) - len(buf) % 4
+                fh.write(base64.b64decode(buf[:end]))
+                buf = buf[end:]
+        fh.write(base64.b64decode(buf))
+    elif encoding == 'quoted-printable':
+        quopri.decode(payload, fh)
+    else:
+        for chunk in iter(lambda: payload.read(CHUNK_SIZE), ''):
+            fh.write(chunk)
+
+    fh.seek(0)
+    return fh
+
+
+def decode_attachments(msg):
+    """
+    Returns the (filename, file) pairs of the attachments of msg
+    """
+    result = []
+
+    for part in msg.walk():
+        filename = part.get_filename()
+
+        if part.is_multipart() or not filename:
+            continue
+
+        if not isinstance(filename, unicode):
+            filename = filename.decode('utf-8', 'replace')
+
+        result.append((filename, decode_part(part),))
+
+    return result
+
+
+def parse_message(raw):
+    """
+    Returns the parsed message and its decoded attachments
+    """
+    msg = Parser().parsestr(raw)
+    return msg, decode_attachments(msg)
+
+
+class MailboxSync(object):
+    """
+    Reads the messages of an IMAP mailbox into notes
+    """
+    def __init__(self, server, user, mailbox='INBOX'):
+        self.server = server
+        self.user = user
+        self.mailbox = mailbox
+
+    @classmethod
+    def connect(cls):
+        uid = Configuration.conf('imap_act')
+
+        if empty(uid):
+            raise ConfigurationError('Incoming message user not configured')
+
+        user = User.objects.get(pk=uid)
+        return cls(Configuration.get_imap_server(), user)
+
+    def close(self):
+        self.server.close()
+        self.server.logout()
+
+    def get_state(self):
+        conf = Configuration.conf()
+        key = u'%s@%s/%s' % (conf.get('imap_user'), conf.get('imap_host'), self.mailbox)
+        return MailboxState.objects.get_or_create(mailbox=key[:255])[0]
+
+    def get_uidvalidity(self):
+        typ, data = self.server.response('UIDVALIDITY')
+
+        if data and data[0] is not None:
+            return int(data[0])
+
+        typ, data = self.server.status(self.mailbox, '(UIDVALIDITY)')
+        return int(re.search(r'UIDVALIDITY (\d+)', data[0]).group(1))
+
+    def get_new_uids(self, state):
+        if state.last_uid == 0:
+            # start from the unread messages, like before UIDs were tracked
+            typ, data = self.server.uid('SEARCH', None, 'UNSEEN')
+        else:
+            since = '%d:*' % (state.last_uid + 1)
+            typ, data = self.server.uid('SEARCH', None, 'UID', since)
+
+        # n:* always matches the last message, even if it's older
+        uids = [int(u) for u in data[0].split()]
+        uids = [u for u in uids if u > state.last_uid]
+
+        # messages that couldn't be saved are tried again a few times
+        uids += [int(u) for u in state.failed_uids]
+
+        return sorted(set(uids))
+
+    def get_batches(self, uids):
+        """
+        Splits uids into batches of at most BATCH_SIZE messages
+        or BATCH_BYTES of message data
+        """
+        sizes = {}
+
+        for i in range(0, len(uids), 1000):
+            uid_set = ','.join([str(u) for u in uids[i:i+1000]])
+            typ, data = self.server.uid('FETCH', uid_set, '(UID RFC822.SIZE)')
+            for line in data:
+                uid, size = UID_RE.search(line or ''), SIZE_RE.search(line or '')
+                if uid and size:
+                    sizes[int(uid.group(1))] = int(size.group(1))
+
+        batch, batch_bytes = [], 0
+
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if batch and (len(batch) >= BATCH_SIZE or batch_bytes + size > BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(uid)
+            batch_bytes += size
+
+        if batch:
+            yield batch
+
+    def fetch(self, uids):
+        """
+        Returns the (uid, raw message) pairs of uids.
+        BODY.PEEK leaves the messages unread until they have been saved.
+        """
+        uid_set = ','.join([str(u) for u in uids])
+        typ, data = self.server.uid('FETCH', uid_set, '(UID BODY.PEEK[])')
+        result = []
+
+        for item in data:
+            if isinstance(item, tuple):
+                uid = UID_RE.search(item[0])
+                if uid:
+                    result.append((int(uid.group(1)), item[1],))
+
+        return sorted(result)
+
+    def is_saved(self, msg):
+        """
+        Returns True if msg has already been read into a note
+        """
+        message_id = (msg['Message-ID'] or '').strip()[:255]
+        return bool(message_id) and Note.objects.filter(message_id=message_id).exists()
+
+    def save_message(self, uid, msg, attachments):
+        try:
+            with transaction.atomic():
+                Note.from_email(msg, self.user, attachments)
+            return True
+        except Exception as e:
+            logging.error('Failed to read message %d (%s)', uid, e)
+            for filename, fh in attachments:
+                fh.close()
+            return False
+
+    def set_failed(self, state, uid):
+        """
+        Records a failed attempt to save message uid
+        """
+        attempts = state.failed_uids.get(str(uid), 0) + 1
+
+        if attempts >= MAX_ATTEMPTS:
+            logging.error('Giving up on message %d after %d attempts', uid, attempts)
+            state.failed_uids.pop(str(uid), None)
+        else:
+            state.failed_uids[str(uid)] = attempts
+
+    def sync(self):
+        """
+        Reads the new messages of the mailbox.
+        Returns the number of notes created.
+        """
+        if not cache.add('check-mail', True, LOCK_TIMEOUT):
+            return 0 # another worker is reading the mailbox
+
+        count = 0
+        pool = ThreadPool(WORKERS)
+
+        try:
+            state = self.get_state()
+            uidvalidity = self.get_uidvalidity()
+
+            if state.uidvalidity != uidvalidity:
+                # the old UIDs mean nothing in this mailbox
+                state.uidvalidity, state.last_uid = uidvalidity, 0
+                state.failed_uids = {}
+
+            for batch in self.get_batches(self.get_new_uids(state)):
+                messages = self.fetch(batch)
+                parsed = pool.map(parse_message, [raw for uid, raw in messages])
+
+                done = []
+
+                for (uid, raw), (msg, attachments) in zip(messages, parsed):
+                    if self.is_saved(msg):
+                        # saved before, but the server never marked it read
+                        for filename, fh in attachments:
+                            fh.close()
+                        done.append(uid)
+                    elif self.save_message(uid, msg, attachments):
+                        count += 1
+                        done.append(uid)
+                    else:
+                        # left unread, and retried until MAX_ATTEMPTS
+                        self.set_failed(state, uid)
+
+                fetched = set([uid for uid, raw in messages])
+
+                for uid in batch:
+                    if uid in done or uid not in fetched:
+                        # saved or gone from the mailbox
+                        state.failed_uids.pop(str(uid), None)
+
+                state.last_uid = max(state.last_uid, max(batch))
+                state.synced_at = timezone.now()
+                state.save()
+
+                if done:
+                    uid_set = ','.join([str(u) for u in done])
+                    self.server.uid('STORE', uid_set, '+FLAGS', '(\\Seen)')
+        finally:
+            pool.close()
+            cache.delete('check-mail')
+
+        return count
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        """
+        Waits for new messages with IMAP IDLE (RFC 2177).
+        Returns True if the server reported new messages.
+        """
+        server = self.server
+
+        if 'IDLE' not in server.capabilities:
+            raise ValueError('IMAP server does not support IDLE')
+
+        tag = server._new_tag()
+        server.send('%s IDLE\r\n' % tag)
+
+        if not server.readline().startswith('+'):
+            raise ValueError('IMAP server refused IDLE')
+
+        sock = server.socket()
+        sock.settimeout(timeout)
+        new_mail = False
+
+        try:
+            while True:
+                line = server.readline()
+                if not line:
+                    break
+                if line.rstrip().endswith('EXISTS'):
+                    new_mail = True
+                    break
+        except (socket.timeout, ssl.SSLError):
+            pass # nothing arrived
+        finally:
+            sock.settimeout(None)
+
+        server.send('DONE\r\n')
+
+        while True:
+            line = server.readline()
+            if not line or line.startswith(tag):
+                break
+
+        return new_mail
@@ -1,16 +1,65 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import urllib
+import urllib2
 from hashlib import md5
 from ssl import _create_unverified_context
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext as _
 
 from servo.models.common import Configuration
 
 
+TIMEOUT = 15 # seconds
+
+
+def urlopen(url, data=None):
+    """
+    Sends a request to an SMS gateway and returns the response
+    """
+    context = _create_unverified_context()
+    return urllib2.urlopen(url, data, timeout=TIMEOUT, context=context).read()
+
+
+class RateLimit(object):
+    """
+    Limits how many messages are sent through a gateway per period
+    """
+    LIMITS = {
+        'hqsms'     : 100,
+        'jazz'      : 60,
+        'http'      : 60,
+        'smtp'      : 30,
+        'builtin'   : 30,
+    }
+
+    def __init__(self, gateway, limit, period=60):
+        self.gateway = gateway
+        self.limit = limit
+        self.period = period
+
+    @classmethod
+    def for_gateway(cls, gateway):
+        return cls(gateway, cls.LIMITS.get(gateway, 30))
+
+    def acquire(self):
+        """
+        Returns True if one more message can be sent in this period
+        """
+        window = int(time.time()) // self.period
+        key = 'sms-rate-%s-%d' % (self.gateway, window)
+        cache.add(key, 0, self.period)
+
+        try:
+            return cache.incr(key) <= self.limit
+        except ValueError: # expired between add and incr
+            return True
+
+
 class BaseSMSProvider:
     def __init__(self, recipient, note, msg):
         self.conf = Configuration.conf()
@@ -85,7 +134,7 @@ class SMSJazzProvider:
             params['dlruri'] = dlruri
 
         params = urllib.urlencode(params)
-        r = urllib.urlopen(self.URL, params, context=_create_unverified_context()).read()
+        r = urlopen(self.URL, params)
 
         if not '1:OK' in r:
             raise ValueError(_('Failed to send message to %s') % self.recipient)
@@ -120,7 +169,7 @@ class HQSMSProvider(BaseSMSProvider):
         '406' : ('FAILED', 'Sending message failed – please report it to us'),
         '407' : ('REJECTED', 'Message is undelivered (invalid number, roaming error etc)'),
         '408' : ('UNKNOWN', 'No report (message may be either delivered or not)'),
-        '409' : ('QUEUED', 'Message is waiting to be sent'),
+        '409' : ('SENT', 'Message is waiting to be sent'),
         '410' : ('ACCEPTED', 'Message is delivered to operator'),
     }
 
@@ -140,7 +189,7 @@ class HQSMSProvider(BaseSMSProvider):
             params['notify_url'] = dlruri
 
         params = urllib.urlencode(params)
-        r = urllib.urlopen(self.URL, params, context=_create_unverified_context()).read()
+        r = urlopen(self.URL, params)
 
         if 'ERROR:' in r:
             raise ValueError(self.ERRORS.get(r, _('Unknown error (%s)') % r))
@@ -153,7 +202,12 @@ class HttpProvider:
     """
     Sends SMS through a HTTP gateway (ie Kannel)
     """
-    def send(self, note, number):
+    def __init__(self, recipient, note, msg):
+        self.recipient = recipient
+        self.note = note
+        self.msg = msg
+
+    def send(self):
         conf = Configuration.conf()
 
         if not conf.get('sms_http_url'):
@@ -162,10 +216,8 @@ class HttpProvider:
         params = urllib.urlencode({
             'username'  : conf['sms_http_user'],
             'password'  : conf['sms_http_password'],
-            'text'      : note.body.encode('utf8'),
-            'to'        : number
+            'text'      : self.note.body.encode('utf8'),
+            'to'        : self.recipient
         })
 
-        f = urllib.urlopen("%s?%s" % (conf['sms_http_url'], params),
-                           context=_create_unverified_context())
-        return f.read()
+        return urlopen("%s?%s" % (conf['sms_http_url'], params))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0056_auto_20160502_1634'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderSearchIndex',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_index', serialize=False, to='servo.Order')),
+                ('priority', models.IntegerField(default=1)),
+                ('state', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(null=True)),
+                ('location_id', models.IntegerField(null=True)),
+                ('checkin_location_id', models.IntegerField(null=True)),
+                ('queue_id', models.IntegerField(null=True)),
+                ('user_id', models.IntegerField(null=True)),
+                ('created_by_id', models.IntegerField(null=True)),
+                ('customer_id', models.IntegerField(null=True)),
+                ('customer_tree_id', models.IntegerField(null=True)),
+                ('status_id', models.IntegerField(null=True)),
+                ('status_started_at', models.DateTimeField(null=True)),
+                ('status_limit_green', models.DateTimeField(null=True)),
+                ('status_limit_yellow', models.DateTimeField(null=True)),
+                ('tag_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('device_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('device_slugs', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=128), default=list, size=None)),
+                ('follower_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('repair_refs', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=16), default=list, size=None)),
+                ('customer_text', models.TextField(default=b'')),
+                ('device_text', models.TextField(default=b'')),
+            ],
+        ),
+        migrations.RunSQL(
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            """
+            CREATE INDEX servo_ordersearchindex_list
+                ON servo_ordersearchindex (location_id, state, priority DESC, order_id);
+            CREATE INDEX servo_ordersearchindex_sort
+                ON servo_ordersearchindex (priority DESC, order_id);
+            CREATE INDEX servo_ordersearchindex_queue
+                ON servo_ordersearchindex (queue_id, state);
+            CREATE INDEX servo_ordersearchindex_user
+                ON servo_ordersearchindex (user_id, state);
+            CREATE INDEX servo_ordersearchindex_customer
+                ON servo_ordersearchindex (customer_tree_id);
+            CREATE INDEX servo_ordersearchindex_tag_ids
+                ON servo_ordersearchindex USING gin (tag_ids);
+            CREATE INDEX servo_ordersearchindex_device_ids
+                ON servo_ordersearchindex USING gin (device_ids);
+            CREATE INDEX servo_ordersearchindex_device_slugs
+                ON servo_ordersearchindex USING gin (device_slugs);
+            CREATE INDEX servo_ordersearchindex_follower_ids
+                ON servo_ordersearchindex USING gin (follower_ids);
+            CREATE INDEX servo_ordersearchindex_repair_refs
+                ON servo_ordersearchindex USING gin (repair_refs);
+            CREATE INDEX servo_ordersearchindex_customer_text
+                ON servo_ordersearchindex USING gin (customer_text gin_trgm_ops);
+            CREATE INDEX servo_ordersearchindex_device_text
+                ON servo_ordersearchindex USING gin (device_text gin_trgm_ops);
+            """,
+            """
+            DROP INDEX servo_ordersearchindex_list;
+            DROP INDEX servo_ordersearchindex_sort;
+            DROP INDEX servo_ordersearchindex_queue;
+            DROP INDEX servo_ordersearchindex_user;
+            DROP INDEX servo_ordersearchindex_customer;
+            DROP INDEX servo_ordersearchindex_tag_ids;
+            DROP INDEX servo_ordersearchindex_device_ids;
+            DROP INDEX servo_ordersearchindex_device_slugs;
+            DROP INDEX servo_ordersearchindex_follower_ids;
+            DROP INDEX servo_ordersearchindex_repair_refs;
+            DROP INDEX servo_ordersearchindex_customer_text;
+            DROP INDEX servo_ordersearchindex_device_text;
+            """
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0057_ordersearchindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarrantyCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sn', models.CharField(max_length=32, unique=True)),
+                ('coverage', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('coverage_checked_at', models.DateTimeField(null=True)),
+                ('activation', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('activation_checked_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
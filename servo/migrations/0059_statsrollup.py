@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0058_warrantycache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('metric', models.CharField(max_length=16)),
+                ('key', models.CharField(default=b'', max_length=255)),
+                ('location_id', models.IntegerField(default=0)),
+                ('queue_id', models.IntegerField(default=0)),
+                ('user_id', models.IntegerField(default=0)),
+                ('created_by_id', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='statsrollup',
+            unique_together=set([('day', 'metric', 'key', 'location_id', 'queue_id', 'user_id', 'created_by_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='statsrollup',
+            index_together=set([('metric', 'day')]),
+        ),
+    ]
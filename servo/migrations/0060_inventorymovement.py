@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('servo', '0059_statsrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryMovement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[(b'opening', 'Opening balance'), (b'adjust', 'Adjusted'), (b'order', 'Ordered'), (b'cancel', 'Order cancelled'), (b'receive', 'Received'), (b'reserve', 'Reserved'), (b'sell', 'Sold'), (b'move', 'Moved')], max_length=16)),
+                ('stocked', models.IntegerField(default=0)),
+                ('ordered', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servo.Location')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servo.Product')),
+                ('purchase_order_item', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='servo.PurchaseOrderItem')),
+            ],
+            options={
+                'ordering': ('-id',),
+            },
+        ),
+        # The current inventory is where the ledger starts from
+        migrations.RunSQL(
+            """INSERT INTO servo_inventorymovement (product_id, location_id, kind,
+                stocked, ordered, reserved, created_at)
+            SELECT product_id, location_id, 'opening',
+                amount_stocked, amount_ordered, amount_reserved, now()
+            FROM servo_inventory""",
+            migrations.RunSQL.noop
+        ),
+    ]
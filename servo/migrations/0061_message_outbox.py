@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0060_inventorymovement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[(b'QUEUED', b'QUEUED'), (b'SENT', b'SENT'), (b'DELIVERED', b'DELIVERED'), (b'RECEIVED', b'RECEIVED'), (b'FAILED', b'FAILED')], max_length=16),
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX servo_message_queued ON servo_message (next_attempt_at, id) WHERE status = 'QUEUED'",
+            "DROP INDEX servo_message_queued"
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0062_orderbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('state', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ordercounter',
+            unique_together=set([('kind', 'object_id', 'state')]),
+        ),
+        migrations.RunSQL(
+            """INSERT INTO servo_ordercounter (kind, object_id, state, count)
+            SELECT 'queue', queue_id, state, COUNT(*) FROM servo_order
+            WHERE queue_id IS NOT NULL GROUP BY queue_id, state
+            UNION ALL
+            SELECT 'user', user_id, state, COUNT(*) FROM servo_order
+            WHERE user_id IS NOT NULL GROUP BY user_id, state
+            UNION ALL
+            SELECT 'location', location_id, state, COUNT(*) FROM servo_order
+            GROUP BY location_id, state
+            UNION ALL
+            SELECT 'tag', t.tag_id, o.state, COUNT(*)
+            FROM servo_order_tags t JOIN servo_order o ON (o.id = t.order_id)
+            GROUP BY t.tag_id, o.state""",
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('servo', '0063_ordercounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(max_length=32)),
+                ('is_read', models.BooleanField(default=False)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to='servo.Event')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='inboxitem',
+            unique_together=set([('user', 'event')]),
+        ),
+        migrations.RunSQL(
+            """INSERT INTO servo_inboxitem (user_id, event_id, action, is_read)
+            SELECT n.user_id, n.event_id, e.action, e.handled_at IS NOT NULL
+            FROM servo_event_notify_users n JOIN servo_event e ON (e.id = n.event_id)""",
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            # the unread counts are an index-only scan of this
+            "CREATE INDEX servo_inboxitem_unread ON servo_inboxitem (user_id, action, event_id DESC) WHERE NOT is_read",
+            "DROP INDEX servo_inboxitem_unread"
+        ),
+        migrations.RemoveField(
+            model_name='event',
+            name='notify_users',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0064_inboxitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='name',
+            field=models.CharField(default=b'', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='sha256',
+            field=models.CharField(db_index=True, default=b'', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0065_attachment_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mailbox', models.CharField(max_length=255, unique=True)),
+                ('uidvalidity', models.BigIntegerField(default=0)),
+                ('last_uid', models.BigIntegerField(default=0)),
+                ('synced_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
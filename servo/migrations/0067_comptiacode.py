@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import yaml
+
+from django.db import migrations, models
+
+
+def load_fixture(apps, schema_editor):
+    """
+    Starts the catalog off with the bundled codes until
+    the periodic comptia command fetches them from GSX
+    """
+    ComptiaCode = apps.get_model('servo', 'ComptiaCode')
+    path = os.path.join(os.path.dirname(__file__), '..', 'fixtures', 'comptia.yaml')
+
+    with open(path) as fh:
+        # BaseLoader keeps codes like 000 as strings
+        data = yaml.load(fh, Loader=yaml.BaseLoader)
+
+    rows = []
+
+    for group, v in data.items():
+        for code, description in v['symptoms'].items():
+            rows.append(ComptiaCode(group=group, code=code,
+                                    description=description[:255]))
+
+    ComptiaCode.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0066_mailboxstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComptiaCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.CharField(max_length=4)),
+                ('code', models.CharField(max_length=4)),
+                ('description', models.CharField(default=b'', max_length=255)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='comptiacode',
+            unique_together=set([('group', 'code')]),
+        ),
+        migrations.RunPython(load_fixture, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0067_comptiacode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='price_updated_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='PriceChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('changes', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servo.Product')),
+            ],
+            options={
+                'get_latest_by': 'changed_at',
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0068_pricechange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repair',
+            name='next_check_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='repair',
+            name='status_changed_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
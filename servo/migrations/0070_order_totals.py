@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+BACKFILL_SQL = """UPDATE servo_order o SET net_amount = t.net, gross_amount = t.gross,
+    tax_amount = t.gross - t.net, purchase_amount = t.purchase,
+    margin_amount = t.net - t.purchase
+FROM (SELECT i.order_id,
+    SUM(ROUND(i.price / ((100 + p.pct_vat) / 100), 2) * i.amount) AS net,
+    SUM(i.price * i.amount) AS gross,
+    SUM(CASE i.price_category
+        WHEN 'stock' THEN p.price_purchase_stock
+        WHEN 'exchange' THEN p.price_purchase_exchange
+        ELSE 0 END * i.amount) AS purchase
+    FROM servo_serviceorderitem i JOIN servo_product p ON (p.id = i.product_id)
+    WHERE i.should_report GROUP BY i.order_id) t
+WHERE o.id = t.order_id"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0069_repair_next_check_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='gross_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='margin_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='net_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='purchase_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='tax_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import servo.lib.search
+
+
+# the SEARCH_VECTOR of each model when this migration was written
+VECTORS = (
+    ('Note', (('subject', 'A'), ('body', 'B'),
+              ('sender', 'C'), ('recipient', 'C'),)),
+    ('Customer', (('fullname', 'A'), ('email', 'B'), ('phone', 'B'),
+                  ('street_address', 'C'), ('city', 'C'), ('notes', 'D'),)),
+    ('Product', (('code', 'A'), ('title', 'A'),
+                 ('eee_code', 'B'), ('description', 'C'),)),
+    ('Device', (('sn', 'A'), ('description', 'A'), ('imei', 'B'),
+                ('configuration', 'C'), ('notes', 'D'),)),
+)
+
+
+def build_vectors(apps, schema_editor):
+    """
+    Indexes the existing rows. The vectors are computed in SQL
+    from the columns of the historical models.
+    """
+    for name, fields in VECTORS:
+        servo.lib.search.reindex(apps.get_model('servo', name), fields=fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0070_order_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='search_vector',
+            field=servo.lib.search.TSVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='search_vector',
+            field=servo.lib.search.TSVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='search_vector',
+            field=servo.lib.search.TSVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=servo.lib.search.TSVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            """
+            CREATE INDEX servo_note_search_vector
+                ON servo_note USING gin (search_vector);
+            CREATE INDEX servo_customer_search_vector
+                ON servo_customer USING gin (search_vector);
+            CREATE INDEX servo_product_search_vector
+                ON servo_product USING gin (search_vector);
+            CREATE INDEX servo_device_search_vector
+                ON servo_device USING gin (search_vector);
+            CREATE INDEX servo_note_sender_trgm
+                ON servo_note USING gin (UPPER(sender::text) gin_trgm_ops);
+            CREATE INDEX servo_note_recipient_trgm
+                ON servo_note USING gin (UPPER(recipient::text) gin_trgm_ops);
+            CREATE INDEX servo_customer_phone_trgm
+                ON servo_customer USING gin (UPPER(phone::text) gin_trgm_ops);
+            CREATE INDEX servo_customer_email_trgm
+                ON servo_customer USING gin (UPPER(email::text) gin_trgm_ops);
+            CREATE INDEX servo_product_code_trgm
+                ON servo_product USING gin (UPPER(code::text) gin_trgm_ops);
+            CREATE INDEX servo_product_eee_code_trgm
+                ON servo_product USING gin (UPPER(eee_code::text) gin_trgm_ops);
+            CREATE INDEX servo_device_sn_trgm
+                ON servo_device USING gin (UPPER(sn::text) gin_trgm_ops);
+            CREATE INDEX servo_device_imei_trgm
+                ON servo_device USING gin (UPPER(imei::text) gin_trgm_ops);
+            """,
+            """
+            DROP INDEX servo_note_search_vector;
+            DROP INDEX servo_customer_search_vector;
+            DROP INDEX servo_product_search_vector;
+            DROP INDEX servo_device_search_vector;
+            DROP INDEX servo_note_sender_trgm;
+            DROP INDEX servo_note_recipient_trgm;
+            DROP INDEX servo_customer_phone_trgm;
+            DROP INDEX servo_customer_email_trgm;
+            DROP INDEX servo_product_code_trgm;
+            DROP INDEX servo_product_eee_code_trgm;
+            DROP INDEX servo_device_sn_trgm;
+            DROP INDEX servo_device_imei_trgm;
+            """
+        ),
+        migrations.RunPython(build_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def normalize(apps, schema_editor):
+    """
+    Fills in the normalized columns of the existing customers.
+    Phone numbers are normalized with phonenumbers, so this can't be SQL.
+    """
+    from servo.lib import dedupe
+
+    Customer = apps.get_model('servo', 'Customer')
+    cursor = schema_editor.connection.cursor()
+    rows = Customer.objects.order_by('pk').values_list('pk', 'name', 'email',
+                                                       'phone', 'country')
+    last_pk = 0
+
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:5000])
+
+        if not chunk:
+            break
+
+        last_pk = chunk[-1][0]
+        values = []
+
+        for pk, name, email, phone, country in chunk:
+            values += [pk, dedupe.normalize_name(name),
+                       dedupe.normalize_email(email),
+                       dedupe.normalize_phone(phone, country)]
+
+        cursor.execute("""UPDATE servo_customer c SET
+            name_normalized = v.name,
+            email_normalized = v.email,
+            phone_normalized = v.phone
+            FROM (VALUES %s) AS v (id, name, email, phone)
+            WHERE c.id = v.id""" % ', '.join(['(%s, %s, %s, %s)'] * len(chunk)),
+            values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0071_search_vectors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='email_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='name_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='phone_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=32),
+        ),
+        migrations.RunPython(normalize, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servo', '0072_customer_normalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxstate',
+            name='failed_uids',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='message_id',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+    ]
@@ -16,3 +16,4 @@ from parts import *
 from repair import *
 from escalations import *
 from rules import *
+from stats import *
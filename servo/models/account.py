@@ -218,7 +218,8 @@ class User(AbstractUser):
         return count if count > 0 else ""
 
     def get_order_count(self, max_state=2):
-        count = self.order_set.filter(state__lt=max_state).count()
+        from servo.models.order import OrderCounter
+        count = OrderCounter.get_count('user', self.pk, max_state)
         return count if count > 0 else ""
 
     def order_count_in_queue(self, queue):
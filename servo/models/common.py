@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
+import uuid
 import gsxws
 import os.path
 
@@ -11,7 +13,7 @@ from pytz import common_timezones, country_timezones
 
 from django.contrib.sites.models import Site
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 
 from mptt.managers import TreeManager
@@ -19,9 +21,6 @@ from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 from django.utils.translation import ugettext_lazy as _
 
-from django.dispatch import receiver
-from django.db.models.signals import post_save
-
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 
@@ -137,17 +136,26 @@ class Event(BaseItem):
     action = models.CharField(max_length=32)
     priority = models.SmallIntegerField(default=1)
 
-    notify_users = models.ManyToManyField(
-        settings.AUTH_USER_MODEL,
-        related_name="notifications" # request.user.notifications
-    )
-
     def save(self, *args, **kwargs):
-        saved = super(Event, self).save(*args, **kwargs)
-
-        if settings.ENABLE_RULES is True:
-            from servo.tasks import apply_rules
-            apply_rules.delay(self)
+        created = self.pk is None
+        super(Event, self).save(*args, **kwargs)
+
+        if created and settings.ENABLE_RULES is True:
+            from servo.models.rules import rule_index
+            # only bother the workers with events that have rules
+            if rule_index.lookup(self.action, self.description):
+                from servo.tasks import apply_rules
+                pk = self.pk
+                transaction.on_commit(lambda: apply_rules.delay(pk))
+
+    def notify(self, users):
+        """
+        Adds this event to the inboxes of users
+        """
+        existing = set(self.inbox.values_list('user_id', flat=True))
+        items = [InboxItem(user_id=u.pk, event=self, action=self.action)
+                 for u in users if u.pk not in existing]
+        InboxItem.objects.bulk_create(items)
 
     def get_status(self):
         from servo.models import Status
@@ -170,6 +178,28 @@ class Event(BaseItem):
         app_label = "servo"
 
 
+class InboxItem(models.Model):
+    """
+    An event in the notification inbox of a user.
+    The action is copied from the event so that the unread
+    items of a kind can be read from the index alone.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='inbox')
+    event = models.ForeignKey(Event, related_name='inbox')
+    action = models.CharField(max_length=32)
+    is_read = models.BooleanField(default=False)
+
+    @classmethod
+    def get_unread(cls, user, action):
+        items = cls.objects.filter(user=user, action=action, is_read=False)
+        items = items.select_related('event', 'event__triggered_by')
+        return items.order_by('-event_id')
+
+    class Meta:
+        app_label = "servo"
+        unique_together = ('user', 'event',)
+
+
 class GsxAccount(models.Model):
 
     site = models.ForeignKey(
@@ -366,7 +396,8 @@ class Tag(MPTTModel):
     )
 
     def count_open_orders(self):
-        count = self.order_set.filter(state__lt=2).count()
+        from servo.models.order import OrderCounter
+        count = OrderCounter.get_count('tag', self.pk)
         return count if count > 0 else ''
 
     def get_admin_url(self):
@@ -586,9 +617,11 @@ class Configuration(models.Model):
         or None if it's invalid
         """
         from django.core.validators import validate_email
+        address = cls.conf('notify_address')
+
         try:
-            validate_email(conf['notify_address'])
-            return conf['notify_address']
+            validate_email(address)
+            return address
         except Exception:
             pass
 
@@ -612,6 +645,22 @@ class Configuration(models.Model):
 
         return host, port
 
+    @classmethod
+    def get_smtp_connection(cls):
+        """
+        Returns an (unopened) connection to the configured SMTP server
+        """
+        from django.core.mail import get_connection
+        conf = cls.conf()
+        host, port = cls.get_smtp_server()
+
+        return get_connection(host=host,
+                              port=int(port),
+                              username=str(conf.get('smtp_user') or ''),
+                              password=str(conf.get('smtp_password') or ''),
+                              use_tls=cls.smtp_ssl(),
+                              timeout=30)
+
     @classmethod
     def get_imap_server(cls):
         import imaplib
@@ -634,27 +683,84 @@ class Configuration(models.Model):
         """
         Returns the admin-configurable config of the site
         """
-        config = cache.get('config')
-        if config is None:
-            config = dict()
-            for r in Configuration.objects.all():
-                config[r.key] = r.value
+        config = config_snapshot.get()
 
-            cache.set('config', config)
+        if key:
+            return config.get(key)
 
-        return config.get(key) if key else config
+        return dict(config)
 
     def save(self, *args, **kwargs):
-        config = super(Configuration, self).save(*args, **kwargs)
-        # Using cache instead of session since it's shared among
-        # all the users of the instance
-        cache.set('config', config, 60*60*24*1)
+        super(Configuration, self).save(*args, **kwargs)
+        config_snapshot.invalidate()
 
     class Meta:
         app_label = 'servo'
         unique_together = ('key', 'site',)
 
 
+class Snapshot(object):
+    """
+    Data loaded from the database and kept in process memory.
+    Every CHECK_INTERVAL seconds the snapshot is compared to the version
+    in the shared cache, so changes saved by other processes show up
+    without a cache round trip on every read.
+    """
+    VERSION_KEY = None
+    CHECK_INTERVAL = 5 # seconds
+
+    def __init__(self):
+        # (version, data, checked_at), replaced as a whole
+        self.state = (None, None, 0)
+
+    def get_version(self):
+        version = cache.get(self.VERSION_KEY)
+
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(self.VERSION_KEY, version, None):
+                version = cache.get(self.VERSION_KEY, version)
+
+        return version
+
+    def load(self):
+        raise NotImplementedError
+
+    def get(self):
+        version, data, checked_at = self.state
+        now = time.time()
+
+        if data is not None and now - checked_at < self.CHECK_INTERVAL:
+            return data
+
+        # read the version before the rows so that a concurrent
+        # save can only make us load again
+        current = self.get_version()
+
+        if data is None or current != version:
+            data = self.load()
+
+        self.state = (current, data, now)
+        return data
+
+    def invalidate(self):
+        self.state = (None, None, 0)
+        cache.set(self.VERSION_KEY, uuid.uuid4().hex, None)
+
+
+class ConfigSnapshot(Snapshot):
+    """
+    The site configuration
+    """
+    VERSION_KEY = 'config-version'
+
+    def load(self):
+        return dict(Configuration.objects.values_list('key', 'value'))
+
+
+config_snapshot = ConfigSnapshot()
+
+
 class Property(models.Model):
     TYPES = (
         ('customer',    _('Customer')),
@@ -765,14 +871,22 @@ class Template(models.Model):
 
 class Attachment(BaseItem):
     """
-    A file attached to something
+    A file attached to something.
+    The files are stored once under the SHA-256 of their contents,
+    so attachments with the same contents share the file.
     """
+    STORE_DIR = 'attachments'
+    THUMBNAIL_DIR = 'thumbnails'
+    CHUNK_SIZE = 64*1024
+
     mime_type = models.CharField(max_length=64, editable=False)
     content = models.FileField(
         upload_to='attachments',
         verbose_name=_('file'),
         validators=[file_upload_validator]
     )
+    name = models.CharField(max_length=255, default='', editable=False)
+    sha256 = models.CharField(max_length=64, default='', editable=False, db_index=True)
 
     @classmethod
     def get_content_type(cls, model):
@@ -786,6 +900,65 @@ class Attachment(BaseItem):
         attachment = cls(content=file)
         attachment.save()
 
+    @classmethod
+    def get_mime_type(cls, buf, filename):
+        try:
+            from servo.lib.utils import file_type
+            return file_type(buf)
+        except ImportError:
+            import mimetypes
+            return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    @classmethod
+    def store(cls, fh, filename):
+        """
+        Streams fh to the store in chunks.
+        Returns the (path, SHA-256, MIME type) of the stored file.
+        """
+        import hashlib
+        import tempfile
+        from django.core.files.storage import default_storage
+
+        digest = hashlib.sha256()
+        mime_type = None
+        tmpdir = default_storage.path(cls.STORE_DIR)
+
+        if not os.path.isdir(tmpdir):
+            os.makedirs(tmpdir)
+
+        # in the same file system so that the rename below is atomic
+        fd, tmp = tempfile.mkstemp(prefix='.upload-', dir=tmpdir)
+
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                if hasattr(fh, 'seek'):
+                    fh.seek(0)
+
+                for chunk in iter(lambda: fh.read(cls.CHUNK_SIZE), b''):
+                    if mime_type is None:
+                        mime_type = cls.get_mime_type(chunk[:2048], filename)
+                    digest.update(chunk)
+                    out.write(chunk)
+
+            sha256 = digest.hexdigest()
+            ext = os.path.splitext(filename)[1].lower()
+            path = '%s/%s/%s%s' % (cls.STORE_DIR, sha256[:2], sha256, ext)
+            target = default_storage.path(path)
+
+            if os.path.exists(target):
+                os.remove(tmp) # already stored
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, target)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return path, sha256, mime_type or 'application/x-empty'
+
     def save(self, *args, **kwargs):
         DENIED_EXTENSIONS = ('.htm', '.html', '.py', '.js',)
         filename = self.content.name.lower()
@@ -794,10 +967,52 @@ class Attachment(BaseItem):
         if ext in DENIED_EXTENSIONS:
             raise ValueError(_(u'%s is not of an allowed file type') % filename)
 
+        if self.content and not self.content._committed:
+            # a new upload
+            name = os.path.basename(self.content.name)
+            path, self.sha256, self.mime_type = self.store(self.content.file, name)
+            self.name = name[:255]
+            self.content = path
+
         return super(Attachment, self).save(*args, **kwargs)
 
+    def is_image(self):
+        return self.mime_type.startswith('image/')
+
+    def get_thumbnail(self, size=256):
+        """
+        Returns the path to a JPEG thumbnail of this image.
+        Thumbnails are made when first asked for and shared by
+        all the attachments of the same file.
+        """
+        from django.core.files.storage import default_storage
+
+        key = self.sha256 or str(self.pk)
+        path = '%s/%s_%d.jpg' % (self.THUMBNAIL_DIR, key, size)
+        target = default_storage.path(path)
+
+        if os.path.exists(target):
+            return target
+
+        from PIL import Image
+
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+
+        im = Image.open(self.content.path)
+        im.thumbnail((size, size), Image.ANTIALIAS)
+
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+
+        tmp = '%s.%d' % (target, os.getpid())
+        im.save(tmp, 'JPEG')
+        os.rename(tmp, target)
+
+        return target
+
     def __unicode__(self):
-        return os.path.basename(self.content.name)
+        return self.name or os.path.basename(self.content.name)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
@@ -811,13 +1026,3 @@ class Attachment(BaseItem):
     class Meta:
         app_label = "servo"
         get_latest_by = "id"
-
-
-@receiver(post_save, sender=Attachment)
-def set_mimetype(sender, instance, created, **kwargs):
-    if created:
-        import subprocess
-        path = instance.content.path
-        mimetype = subprocess.check_output(['file', '-b', '--mime-type', path]).strip()
-        instance.mime_type = mimetype
-        instance.save()
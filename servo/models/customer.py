@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import phonenumbers
-from django.db import models
 from django.conf import settings
+from django.dispatch import receiver
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save
 
 from mptt.managers import TreeManager
 from django.core.validators import validate_email
@@ -13,10 +15,32 @@ from django.utils.translation import ugettext_lazy as _
 from pytz import country_names
 
 from servo import defaults
+from servo.lib import dedupe
+from servo.lib.search import TSVectorField, update_vectors
 from servo.models import Tag
 from servo.models.device import Device
 
 
+# Recomputes the full names of a customer and its contacts,
+# each name followed by those of its ancestors from the top down
+FULLNAMES_SQL = """WITH RECURSIVE tree (id, name, path) AS (
+    SELECT c.id, c.name, ARRAY(SELECT a.name::text FROM servo_customer a
+        WHERE a.tree_id = c.tree_id AND a.lft < c.lft AND a.rght > c.rght
+        ORDER BY a.lft)
+    FROM servo_customer c WHERE c.id = %s
+  UNION ALL
+    SELECT c.id, c.name, t.path || t.name::text
+    FROM servo_customer c JOIN tree t ON (c.parent_id = t.id)
+), names AS (
+    SELECT id, LEFT(CASE WHEN cardinality(path) = 0 THEN name
+        ELSE name || ' - ' || array_to_string(path, ', ') END, 255) AS fullname
+    FROM tree
+)
+UPDATE servo_customer c SET fullname = n.fullname FROM names n
+WHERE c.id = n.id AND c.fullname <> n.fullname
+RETURNING c.id"""
+
+
 class CustomerGroup(models.Model):
     name = models.CharField(
         unique=True,
@@ -122,6 +146,40 @@ class Customer(MPTTModel):
         verbose_name=_("notes")
     )
 
+    search_vector = TSVectorField()
+
+    # for finding duplicates, see servo.lib.dedupe
+    name_normalized = models.CharField(
+        default='',
+        editable=False,
+        db_index=True,
+        max_length=255
+    )
+    email_normalized = models.CharField(
+        default='',
+        editable=False,
+        db_index=True,
+        max_length=254
+    )
+    phone_normalized = models.CharField(
+        default='',
+        editable=False,
+        db_index=True,
+        max_length=32
+    )
+
+    # customers with more contacts than this are renamed in the background
+    RENAME_SYNC_LIMIT = 100
+
+    # blocking keys shared by more customers than this are
+    # placeholders (like a company switchboard), not duplicates
+    DEDUPE_MAX_BLOCK = 50
+
+    SEARCH_VECTOR = (('fullname', 'A'), ('email', 'B'), ('phone', 'B'),
+                     ('street_address', 'C'), ('city', 'C'), ('notes', 'D'),)
+    SEARCH_TRIGRAMS = ('phone', 'email',)
+    SEARCH_HEADLINE = None
+
     devices = models.ManyToManyField(
         Device,
         blank=True,
@@ -264,19 +322,272 @@ class Customer(MPTTModel):
     def get_icon(self):
         return 'icon-briefcase' if self.is_company else 'icon-user'
 
+    def normalize(self):
+        """
+        Sets the columns that duplicates are found by
+        """
+        self.name_normalized = dedupe.normalize_name(self.name)
+        self.email_normalized = dedupe.normalize_email(self.email)
+        self.phone_normalized = dedupe.normalize_phone(self.phone, self.country)
+
+    @classmethod
+    def normalize_all(cls, chunk_size=5000):
+        """
+        Recomputes the normalized columns of all customers one chunk
+        at a time. Returns the number of customers that changed.
+        """
+        count, last_pk = 0, 0
+        cursor = connection.cursor()
+        rows = cls.objects.order_by('pk').values_list(
+            'pk', 'name', 'email', 'phone', 'country',
+            'name_normalized', 'email_normalized', 'phone_normalized'
+        )
+
+        while True:
+            chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+
+            if not chunk:
+                break
+
+            last_pk = chunk[-1][0]
+            changed = []
+
+            for pk, name, email, phone, country, n, e, p in chunk:
+                new = (dedupe.normalize_name(name),
+                       dedupe.normalize_email(email),
+                       dedupe.normalize_phone(phone, country),)
+                if new != (n, e, p):
+                    changed.append((pk,) + new)
+
+            if not changed:
+                continue
+
+            cursor.execute("""UPDATE servo_customer c SET
+                name_normalized = v.name,
+                email_normalized = v.email,
+                phone_normalized = v.phone
+                FROM (VALUES %s) AS v (id, name, email, phone)
+                WHERE c.id = v.id""" % ', '.join(['(%s, %s, %s, %s)'] * len(changed)),
+                [x for row in changed for x in row])
+            count += len(changed)
+
+        return count
+
+    @classmethod
+    def find_duplicates(cls, max_block=None):
+        """
+        Yields (customer id, customer id, score) for every pair of
+        customers that share a blocking key. Companies are only compared
+        with companies and customers never with their own contacts.
+        """
+        max_block = max_block or cls.DEDUPE_MAX_BLOCK
+        blocks, params = [], []
+
+        for key in dedupe.BLOCKING_KEYS:
+            columns = ', '.join(key)
+            blocks.append("""SELECT a.id AS a_id, b.id AS b_id
+                FROM servo_customer a JOIN servo_customer b ON (%s AND b.id > a.id)
+                WHERE (%s) IN (SELECT %s FROM servo_customer WHERE %s
+                    GROUP BY %s HAVING COUNT(*) BETWEEN 2 AND %%s)""" % (
+                ' AND '.join(['b.%s = a.%s' % (c, c) for c in key]),
+                ', '.join(['a.%s' % c for c in key]),
+                columns,
+                ' AND '.join(["%s <> ''" % c for c in key]),
+                columns
+            ))
+            params.append(max_block)
+
+        columns = ('name_normalized', 'email_normalized', 'phone_normalized',
+                   'zip_code', 'city',)
+        cursor = connection.cursor()
+        cursor.execute("""SELECT a.id, b.id, %s, %s FROM (%s) AS p
+            JOIN servo_customer a ON (a.id = p.a_id)
+            JOIN servo_customer b ON (b.id = p.b_id)
+            WHERE a.is_company = b.is_company
+            AND NOT (a.tree_id = b.tree_id AND (b.lft BETWEEN a.lft AND a.rght
+                                                OR a.lft BETWEEN b.lft AND b.rght))""" % (
+            ', '.join(['a.%s' % c for c in columns]),
+            ', '.join(['b.%s' % c for c in columns]),
+            ' UNION '.join(blocks)
+        ), params)
+
+        for row in cursor:
+            a = dict(zip(columns, row[2:7]))
+            b = dict(zip(columns, row[7:]))
+            yield row[0], row[1], dedupe.score(a, b)
+
+    @classmethod
+    def merge_many(cls, merges):
+        """
+        Merges customers into other customers, {source id: target id}.
+        Everything that refers to a source (orders, notes, invoices,
+        devices, contacts...) is moved to its target with one statement
+        per relation and then the sources are deleted.
+        Returns the number of customers merged.
+        """
+        merges = dict((int(s), int(t)) for s, t in merges.items() if int(s) != int(t))
+
+        if not merges:
+            return 0
+
+        if set(merges) & set(merges.values()):
+            raise ValueError(_('Customers can only be merged into customers that are kept'))
+
+        sources = list(merges)
+        mapping = '(VALUES %s) AS m (source, target)' % ', '.join(['(%s, %s)'] * len(merges))
+        params = [x for row in merges.items() for x in row]
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("""SELECT 1 FROM %s
+                JOIN servo_customer s ON (s.id = m.source)
+                JOIN servo_customer t ON (t.id = m.target)
+                WHERE t.tree_id = s.tree_id AND t.lft > s.lft AND t.rght < s.rght
+                LIMIT 1""" % mapping, params)
+
+            if cursor.fetchone():
+                raise ValueError(_("Customers can't be merged into their own contacts"))
+
+            # contacts are moved one by one so that MPTT keeps the tree in order
+            contacts = cls.objects.filter(parent_id__in=sources)
+
+            for pk in list(contacts.values_list('pk', flat=True)):
+                contact = cls.objects.get(pk=pk)
+                contact.parent_id = merges[contact.parent_id]
+                contact.save()
+
+            for rel in cls._meta.related_objects:
+                field = rel.field
+
+                if rel.many_to_many or field.model is cls:
+                    continue
+
+                table = field.model._meta.db_table
+                column = field.column
+
+                # rows that would break a unique constraint are dropped,
+                # keeping the target's row (or the first source's)
+                for unique in field.model._meta.unique_together:
+                    if field.name not in unique:
+                        continue
+
+                    others = [field.model._meta.get_field(f).column for f in unique]
+                    others = [c for c in others if c != column]
+                    cursor.execute("""DELETE FROM {table} s
+                        USING {mapping}, {table} t
+                        LEFT JOIN {other} ON (n.source = t.{column})
+                        WHERE s.{column} = m.source
+                        AND COALESCE(n.target, t.{column}) = m.target
+                        AND (t.{column} = m.target OR t.id < s.id)
+                        AND {same}""".format(
+                            table=table,
+                            column=column,
+                            mapping=mapping,
+                            other=mapping.replace(' m ', ' n '),
+                            same=' AND '.join(['s.%s = t.%s' % (c, c) for c in others])
+                        ), params + params)
+
+                cursor.execute("""UPDATE {table} SET {column} = m.target
+                    FROM {mapping} WHERE {table}.{column} = m.source""".format(
+                        table=table, column=column, mapping=mapping
+                    ), params)
+
+            for field in cls._meta.many_to_many:
+                through = field.remote_field.through._meta.db_table
+                own, other = field.m2m_column_name(), field.m2m_reverse_name()
+                cursor.execute("""INSERT INTO {through} ({own}, {other})
+                    SELECT DISTINCT m.target, t.{other} FROM {through} t
+                    JOIN {mapping} ON (t.{own} = m.source)
+                    ON CONFLICT DO NOTHING""".format(
+                        through=through, own=own, other=other, mapping=mapping
+                    ), params)
+                cursor.execute('DELETE FROM {through} WHERE {own} = ANY(%s)'.format(
+                    through=through, own=own
+                ), [sources])
+
+            # orders show their new customer like they would after a rename
+            targets = list(set(merges.values()))
+            cursor.execute("""UPDATE servo_order o SET customer_name = c.fullname
+                FROM servo_customer c WHERE c.id = o.customer_id
+                AND c.id = ANY(%s) AND o.customer_name <> c.fullname""", [targets])
+            cursor.execute("""UPDATE servo_ordersearchindex i SET
+                customer_id = o.customer_id,
+                customer_tree_id = c.tree_id,
+                customer_text = LOWER(c.fullname || ' ' || c.phone)
+                FROM servo_order o JOIN servo_customer c ON (c.id = o.customer_id)
+                WHERE i.order_id = o.id AND (i.customer_id = ANY(%s)
+                                             OR i.customer_id = ANY(%s))""",
+                [sources, targets])
+
+            cls.objects.filter(pk__in=sources).delete()
+
+        return len(merges)
+
+    @classmethod
+    def update_fullnames(cls, pk):
+        """
+        Updates the full names of this customer and all its contacts
+        and the customer names of their orders, a statement for each.
+        The orders of this customer are always updated, since its own
+        name may have been saved already.
+        Returns the number of customers and orders renamed.
+        """
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(FULLNAMES_SQL, [pk])
+            renamed = [r[0] for r in cursor.fetchall()]
+            update_vectors(cls, renamed)
+            ids = list(set(renamed + [pk]))
+
+            cursor.execute("""UPDATE servo_order o SET customer_name = LEFT(c.fullname, 128)
+                FROM servo_customer c WHERE c.id = o.customer_id AND c.id = ANY(%s)
+                AND o.customer_name <> LEFT(c.fullname, 128)""", [ids])
+            orders = cursor.rowcount
+
+            cls.reindex_orders(ids)
+
+        return len(renamed), orders
+
+    @classmethod
+    def reindex_orders(cls, ids):
+        """
+        Refreshes the customer columns of the search index rows of the
+        orders of these customers. Returns the number of rows changed.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""UPDATE servo_ordersearchindex i SET
+            customer_tree_id = c.tree_id,
+            customer_text = LOWER(c.fullname || ' ' || c.phone)
+            FROM servo_customer c
+            WHERE c.id = i.customer_id AND c.id = ANY(%s)
+            AND (i.customer_tree_id IS DISTINCT FROM c.tree_id
+                 OR i.customer_text <> LOWER(c.fullname || ' ' || c.phone))""",
+            [list(ids)])
+        return cursor.rowcount
+
     def save(self, *args, **kwargs):
         self.zip_code = self.zip_code.replace(' ', '')
+        self.normalize()
 
         super(Customer, self).save(*args, **kwargs)
         fn = self.get_fullname()
 
-        if self.fullname != fn:
-            self.fullname = fn
-            self.save()
+        if self.fullname == fn:
+            return
 
-            for o in self.orders.all():
-                o.customer_name = fn
-                o.save()
+        self.fullname = fn
+
+        if self.get_descendant_count() <= self.RENAME_SYNC_LIMIT:
+            Customer.update_fullnames(self.pk)
+            return
+
+        # big companies get their own name now and their contacts' later
+        Customer.objects.filter(pk=self.pk).update(fullname=fn)
+        update_vectors(Customer, [self.pk])
+
+        from servo.tasks import update_customer_names
+        pk = self.pk
+        transaction.on_commit(lambda: update_customer_names.delay(pk))
 
     class Meta:
         app_label = "servo"
@@ -297,3 +608,10 @@ class ContactInfo(models.Model):
         app_label = 'servo'
         # Only allow a field once per customer
         unique_together = ('customer', 'key',)
+
+
+@receiver(post_save, sender=Customer)
+def trigger_customer_saved(sender, instance, created, raw=False, **kwargs):
+    # orders are found by the name and phone of their customer
+    if not created and not raw:
+        Customer.reindex_orders([instance.pk])
@@ -4,6 +4,9 @@ import re
 import gsxws
 from gsxws import diagnostics
 from os.path import basename
+from datetime import timedelta
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from django_countries import countries
 from django.core.validators import RegexValidator
 
@@ -12,10 +15,13 @@ from django.conf import settings
 from django.core.files import File
 from django.core.cache import cache
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.text import slugify
+from django.utils.dateparse import parse_date
 from django.core.urlresolvers import reverse
 from django.db.models.signals import post_save
 
+from django.contrib.postgres.fields import JSONField
 from django.contrib.contenttypes.fields import GenericRelation
 
 from django.utils.translation import ugettext_lazy as _
@@ -23,7 +29,8 @@ from django.contrib.contenttypes.models import ContentType
 
 from servo import defaults
 from servo.validators import sn_validator
-from servo.models import GsxAccount, Product, DeviceGroup, TaggedItem
+from servo.lib.search import TSVectorField
+from servo.models import GsxAccount, Product, PriceEngine, DeviceGroup, TaggedItem
 
 
 class Device(models.Model):
@@ -161,6 +168,12 @@ class Device(models.Model):
 
     notes = models.TextField(blank=True, default="", verbose_name=_("notes"))
     tags = GenericRelation(TaggedItem)
+    search_vector = TSVectorField()
+
+    SEARCH_VECTOR = (('sn', 'A'), ('description', 'A'), ('imei', 'B'),
+                     ('configuration', 'C'), ('notes', 'D'),)
+    SEARCH_TRIGRAMS = ('sn', 'imei',)
+    SEARCH_HEADLINE = None
     photo = models.ImageField(
         null=True,
         blank=True,
@@ -289,86 +302,75 @@ class Device(models.Model):
         return gsxws.Product(self.sn)
 
     @classmethod
-    def from_gsx(cls, sn, device=None, cached=True, user=None):
+    def from_gsx(cls, sn, device=None, cached=True, user=None, stale=False):
         """
         Initialize new Device with warranty info from GSX
         Or update existing one
+
+        Results are kept in the warranty cache, cached=False
+        forces a fresh lookup. With stale=True an expired cache entry
+        is returned as is and refreshed in the background.
         """
         sn = sn.upper()
-        cache_key = 'device-%s' % sn
-
-        # Only cache unsaved devices
-        if cached and device is None:
-            if cache.get(cache_key):
-                return cache.get(cache_key)
-
         arg = gsxws.validate(sn)
 
         if arg not in ("serialNumber", "alternateDeviceId",):
             raise ValueError(_(u"Invalid input for warranty check: %s") % sn)
 
-        product = gsxws.Product(sn)
-
-        if user and user.location:
-            ship_to = user.location.gsx_shipto
-        else:
-            gsx_act = GsxAccount.get_default_account()
-            ship_to = gsx_act.ship_to
-
-        wty     = product.warranty(ship_to=ship_to)
-        model   = product.model()
+        ship_to = WarrantyCache.get_ship_to(user)
+        entry = WarrantyCache.get_entry(sn)
 
-        if device is None:
-            # serialNumber may sometimes come back empty
-            serial_number = wty.serialNumber or sn
-            device = Device(sn=serial_number)
+        if not cached:
+            entry.refresh(ship_to)
+            entry.save()
+        elif stale and entry.is_usable():
+            if not entry.is_fresh():
+                entry.revalidate(ship_to)
+        elif not entry.is_fresh():
+            entry.refresh(ship_to, *entry.get_stale_parts())
+            entry.save()
 
-        from servo.lib.utils import empty
+        return entry.apply(device)
 
-        if empty(device.notes):
-            device.notes = wty.notes or ''
-            device.notes += wty.csNotes or ''
-
-        device.has_onsite       = product.has_onsite
-        device.is_vintage       = product.is_vintage
-        device.description      = product.description
-        device.fmip_active      = product.fmip_is_active
-
-        device.slug             = slugify(device.description)
-        device.configuration    = wty.configDescription or ''
-        device.purchase_country = wty.purchaseCountry or ''
-
-        device.config_code      = model.configCode
-        device.product_line     = model.productLine.replace(" ", "")
-        device.parts_and_labor_covered = product.parts_and_labor_covered
-
-        device.sla_description      = wty.slaGroupDescription or ''
-        device.contract_start_date  = wty.contractCoverageStartDate
-        device.contract_end_date    = wty.contractCoverageEndDate
-        device.onsite_start_date    = wty.onsiteStartDate
-        device.onsite_end_date      = wty.onsiteEndDate
-
-        if wty.estimatedPurchaseDate:
-            device.purchased_on = wty.estimatedPurchaseDate
-
-        device.image_url         = wty.imageURL or ''
-        device.manual_url        = wty.manualURL or ''
-        device.exploded_view_url = wty.explodedViewURL or ''
-
-        if wty.warrantyStatus:
-            device.set_wty_status(wty.warrantyStatus)
-
-        if product.is_ios:
-            ad = device.get_activation()
-            device.imei = ad.imeiNumber or ''
-            device.unlocked = product.is_unlocked(ad)
-            device.applied_activation_policy = ad.appliedActivationDetails or ''
-            device.initial_activation_policy = ad.initialActivationPolicyDetails or ''
-            device.next_tether_policy = ad.nextTetherPolicyDetails or ''
-
-        cache.set(cache_key, device)
+    @classmethod
+    def from_gsx_many(cls, serials, cached=True, user=None):
+        """
+        Warranty check for many serial numbers at once.
+        Lookups missing from the warranty cache run concurrently.
+        Returns a dict of serial number -> Device, or the exception
+        that the lookup raised for that serial number
+        """
+        results = OrderedDict()
+        ship_to = WarrantyCache.get_ship_to(user)
+
+        for sn in serials:
+            sn = sn.strip().upper()
+            if gsxws.validate(sn) in ("serialNumber", "alternateDeviceId",):
+                results[sn] = None
+            else:
+                results[sn] = ValueError(_(u"Invalid input for warranty check: %s") % sn)
+
+        serials = [k for k, v in results.items() if v is None]
+        entries = WarrantyCache.objects.filter(sn__in=serials)
+        entries = dict((e.sn, e) for e in entries)
+
+        jobs = []
+        for sn in serials:
+            entry = entries.get(sn) or WarrantyCache(sn=sn)
+            parts = entry.get_stale_parts() if cached else (True, True,)
+            if any(parts):
+                jobs.append((entry, ship_to, parts,))
+            else:
+                results[sn] = entry.apply()
+
+        for entry, error in WarrantyCache.refresh_many(jobs):
+            if error is None:
+                entry.save()
+                results[entry.sn] = entry.apply()
+            else:
+                results[entry.sn] = error
 
-        return device
+        return results
 
     def is_mac(self):
         """
@@ -386,8 +388,8 @@ class Device(models.Model):
         p.description = self.description
         return p.is_ios
 
-    def update_gsx_details(self):
-        Device.from_gsx(self.sn, self)
+    def update_gsx_details(self, cached=True, stale=False):
+        Device.from_gsx(self.sn, self, cached=cached, stale=stale)
         self.save()
 
     def get_image_url(self):
@@ -423,7 +425,9 @@ class Device(models.Model):
             # Non-serialized products may have more than one repair
             return True
 
-        return self.repair_set.filter(completed_at=None).count() < 1
+        # reads the repairs prefetched by Order.get_detail()
+        open_repairs = [r for r in self.repair_set.all() if r.completed_at is None]
+        return len(open_repairs) < 1
 
     def get_accessories(self, order):
         return self.accessory_set.filter(order=order).values_list('name', flat=True)
@@ -463,8 +467,9 @@ class Device(models.Model):
         results = {}
         cache_key = "%s_parts" % self.sn
 
-        for p in gsxws.Product(self.sn).parts():
-            product = Product.from_gsx(p)
+        parts = gsxws.Product(self.sn).parts()
+
+        for product in PriceEngine.current().price_parts(parts):
             results[product.code] = product
 
         cache.set_many(results)
@@ -541,6 +546,204 @@ class Device(models.Model):
         get_latest_by = "id"
 
 
+class WarrantyCache(models.Model):
+    """
+    The last known GSX warranty details of a serial number.
+    Coverage and activation details expire separately since
+    activation policies change more often than coverage dates.
+    """
+    sn = models.CharField(max_length=32, unique=True)
+    coverage = JSONField(default=dict)
+    coverage_checked_at = models.DateTimeField(null=True)
+    activation = JSONField(default=dict)
+    activation_checked_at = models.DateTimeField(null=True)
+
+    COVERAGE_TTL = timedelta(days=1)
+    ACTIVATION_TTL = timedelta(hours=1)
+    # how old an entry can be and still be served while it's refreshed
+    STALE_TTL = timedelta(days=30)
+    # max number of concurrent GSX lookups
+    WORKERS = 4
+
+    DATE_FIELDS = ('contract_start_date', 'contract_end_date',
+                   'onsite_start_date', 'onsite_end_date', 'purchased_on',)
+
+    @classmethod
+    def get_ship_to(cls, user=None):
+        if user and user.location:
+            return user.location.gsx_shipto
+
+        return GsxAccount.get_default_account().ship_to
+
+    @classmethod
+    def get_entry(cls, sn):
+        try:
+            return cls.objects.get(sn=sn)
+        except cls.DoesNotExist:
+            return cls(sn=sn)
+
+    def is_expired(self, checked_at, ttl):
+        return checked_at is None or checked_at < timezone.now() - ttl
+
+    def get_stale_parts(self):
+        """
+        Returns which parts of the entry need refreshing
+        as a (coverage, activation) tuple
+        """
+        coverage = self.is_expired(self.coverage_checked_at, self.COVERAGE_TTL)
+        activation = self.coverage.get('is_ios', True) and \
+            self.is_expired(self.activation_checked_at, self.ACTIVATION_TTL)
+        return (coverage, activation,)
+
+    def is_fresh(self):
+        return not any(self.get_stale_parts())
+
+    def is_usable(self):
+        """
+        Returns True if this entry is recent enough to show
+        while it's being refreshed
+        """
+        return not self.is_expired(self.coverage_checked_at, self.STALE_TTL)
+
+    def fetch_coverage(self, ship_to):
+        product = gsxws.Product(self.sn)
+        wty = product.warranty(ship_to=ship_to)
+        model = product.model()
+
+        result = {
+            # serialNumber may sometimes come back empty
+            'sn': wty.serialNumber or self.sn,
+            'notes': (wty.notes or '') + (wty.csNotes or ''),
+            'is_ios': product.is_ios,
+            'has_onsite': product.has_onsite,
+            'is_vintage': product.is_vintage,
+            'description': product.description,
+            'fmip_active': product.fmip_is_active,
+            'configuration': wty.configDescription or '',
+            'purchase_country': wty.purchaseCountry or '',
+            'config_code': model.configCode,
+            'product_line': model.productLine.replace(" ", ""),
+            'parts_and_labor_covered': product.parts_and_labor_covered,
+            'sla_description': wty.slaGroupDescription or '',
+            'contract_start_date': wty.contractCoverageStartDate,
+            'contract_end_date': wty.contractCoverageEndDate,
+            'onsite_start_date': wty.onsiteStartDate,
+            'onsite_end_date': wty.onsiteEndDate,
+            'purchased_on': wty.estimatedPurchaseDate,
+            'image_url': wty.imageURL or '',
+            'manual_url': wty.manualURL or '',
+            'exploded_view_url': wty.explodedViewURL or '',
+            'warranty_status': wty.warrantyStatus,
+        }
+
+        for k in self.DATE_FIELDS:
+            if hasattr(result[k], 'isoformat'):
+                result[k] = result[k].isoformat()
+
+        return result
+
+    def fetch_activation(self):
+        product = gsxws.Product(self.coverage.get('sn', self.sn))
+        ad = product.activation()
+
+        return {
+            'imei': ad.imeiNumber or '',
+            'unlocked': product.is_unlocked(ad),
+            'applied_activation_policy': ad.appliedActivationDetails or '',
+            'initial_activation_policy': ad.initialActivationPolicyDetails or '',
+            'next_tether_policy': ad.nextTetherPolicyDetails or '',
+        }
+
+    def refresh(self, ship_to, coverage=True, activation=True):
+        """
+        Updates the entry from GSX without saving it.
+        Only talks to GSX so it's safe to call from worker threads.
+        """
+        if coverage or not self.coverage:
+            self.coverage = self.fetch_coverage(ship_to)
+            self.coverage_checked_at = timezone.now()
+
+        if not self.coverage['is_ios']:
+            self.activation = {}
+        elif activation:
+            self.activation = self.fetch_activation()
+            self.activation_checked_at = timezone.now()
+
+    @classmethod
+    def refresh_many(cls, jobs):
+        """
+        Runs (entry, ship_to, (coverage, activation)) refreshes
+        concurrently and returns a list of (entry, error)
+        """
+        if not jobs:
+            return []
+
+        def run(job):
+            entry, ship_to, parts = job
+            try:
+                entry.refresh(ship_to, *parts)
+                return (entry, None,)
+            except Exception as e:
+                return (entry, e,)
+
+        pool = ThreadPool(min(cls.WORKERS, len(jobs)))
+
+        try:
+            return pool.map(run, jobs)
+        finally:
+            pool.close()
+
+    def revalidate(self, ship_to):
+        """
+        Refreshes this entry in the background
+        """
+        from servo.tasks import refresh_warranty
+        # don't queue the same serial more than once at a time
+        if cache.add('warranty-refresh-%s' % self.sn, True, 60):
+            refresh_warranty.delay(self.sn, ship_to)
+
+    def apply(self, device=None):
+        """
+        Sets the cached details on device
+        or a new Device if it's not given
+        """
+        from servo.lib.utils import empty
+        values = self.coverage
+
+        if device is None:
+            device = Device(sn=values['sn'])
+
+        if empty(device.notes):
+            device.notes = values['notes']
+
+        for k in ('has_onsite', 'is_vintage', 'description', 'fmip_active',
+                  'configuration', 'purchase_country', 'config_code',
+                  'product_line', 'parts_and_labor_covered', 'sla_description',
+                  'image_url', 'manual_url', 'exploded_view_url',):
+            setattr(device, k, values[k])
+
+        for k in self.DATE_FIELDS:
+            value = values[k] and parse_date(values[k])
+            if value or k != 'purchased_on':
+                setattr(device, k, value)
+
+        device.slug = slugify(device.description)
+
+        if values['warranty_status']:
+            device.set_wty_status(values['warranty_status'])
+
+        for k, v in self.activation.items():
+            setattr(device, k, v)
+
+        return device
+
+    def __unicode__(self):
+        return self.sn
+
+    class Meta:
+        app_label = "servo"
+
+
 @receiver(post_save, sender=Device)
 def device_saved(sender, instance, created, **kwargs):
     # make sure we have this tag and product category
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -8,7 +8,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.dispatch import receiver
 from django.db.models.signals import post_save
 
-from servo.models import (User, Customer, Order, Location, 
+from servo.models import (User, Customer, Order, Location, Product, Inventory,
                           AbstractOrderItem, ServiceOrderItem,)
 
 
@@ -104,15 +104,40 @@ class Invoice(models.Model):
 
     def dispatch(self, products):
         """
-        Dispatches the products in this invoice from the inventory
+        Dispatches these order items in this invoice from the inventory.
+        All the lines are written at once, so the number of queries
+        doesn't grow with the size of the order.
         """
-        for p in products:
-            soi = ServiceOrderItem.objects.get(pk=p)
-            InvoiceItem.from_soi(soi, self)
+        with transaction.atomic():
+            items = ServiceOrderItem.objects.select_for_update()
+            items = list(items.filter(pk__in=products, order_id=self.order_id,
+                                      dispatched=False))
 
-            soi.product.sell(soi.amount, self.location)
-            soi.dispatched = True
-            soi.save()
+            if not items:
+                return []
+
+            catalog = Product.objects.in_bulk(set(i.product_id for i in items))
+            sold = {}
+
+            for soi in items:
+                soi.product = catalog[soi.product_id]
+                if soi.product.track_inventory():
+                    stocked = sold.get(soi.product, (0,))[0] - soi.amount
+                    sold[soi.product] = (stocked, 0, stocked,)
+
+            InvoiceItem.objects.bulk_create([
+                InvoiceItem.from_soi(soi, self, commit=False) for soi in items
+            ])
+
+            Inventory.record_many(self.location, 'sell', sold, self.created_by)
+
+            dispatched = [soi.pk for soi in items]
+            ServiceOrderItem.objects.filter(pk__in=dispatched).update(dispatched=True)
+
+            description = _(u'Order %s dispatched') % self.order.code
+            self.order.notify('dispatched', description, self.created_by)
+
+        return items
 
     def get_absolute_url(self):
         from django.core.urlresolvers import reverse
@@ -122,10 +147,6 @@ class Invoice(models.Model):
         if self.location is None:
             self.location = self.order.location
 
-        if self.pk is None:
-            description = _(u'Order %s dispatched') % self.order.code
-            self.order.notify('dispatched', description, self.created_by)
-
         return super(Invoice, self).save(*args, **kwargs)
 
     class Meta:
@@ -143,7 +164,7 @@ class InvoiceItem(AbstractOrderItem):
     )
 
     @classmethod
-    def from_soi(cls, soi, invoice, invoice_item=None):
+    def from_soi(cls, soi, invoice, invoice_item=None, commit=True):
         """
         Copies SalesOrderItem into an InvoiceItem
         """
@@ -160,7 +181,10 @@ class InvoiceItem(AbstractOrderItem):
         i.product = soi.product
         i.description = soi.description
         i.created_by = invoice.created_by
-        i.save()
+
+        if commit:
+            i.save()
+
         return i
 
     class Meta:
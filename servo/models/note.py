@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import re
-import base64
 import urllib
 import chardet
 import html2text
+from datetime import timedelta
 from email.header import decode_header
 
 from django.db import models, IntegrityError
@@ -13,7 +13,7 @@ from django.conf import settings
 from django.utils import timezone
 from django.core.cache import cache
 from django.dispatch import receiver
-from django.core.files.base import ContentFile
+from django.core.files import File
 from django.core.exceptions import ValidationError
 
 from django.utils.translation import ugettext_lazy as _
@@ -24,13 +24,14 @@ from django.contrib.contenttypes.fields import GenericRelation
 
 from django.template.defaultfilters import truncatechars
 from django.db.models.signals import pre_delete, post_save
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 
 from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 
 from servo import defaults
 from servo.lib.shorturl import from_time
+from servo.lib.search import TSVectorField
 
 from servo.models.order import Order
 from servo.models.account import User
@@ -92,6 +93,13 @@ class Note(MPTTModel):
         max_length=255,
         verbose_name=_('To')
     )
+    # Message-ID header of the email this note was read from
+    message_id = models.CharField(
+        default='',
+        max_length=255,
+        db_index=True,
+        editable=False
+    )
     customer = models.ForeignKey(Customer, null=True, blank=True)
     escalation = UnsavedForeignKey(Escalation, null=True, editable=False)
     labels = models.ManyToManyField(Tag, blank=True, limit_choices_to={'type': 'note'})
@@ -138,6 +146,13 @@ class Note(MPTTModel):
         verbose_name=_('Type')
     )
 
+    search_vector = TSVectorField()
+
+    SEARCH_VECTOR = (('subject', 'A'), ('body', 'B'),
+                     ('sender', 'C'), ('recipient', 'C'),)
+    SEARCH_TRIGRAMS = ('sender', 'recipient',)
+    SEARCH_HEADLINE = 'body'
+
     objects = TreeManager()
 
     def __render__(self, tpl, ctx):
@@ -264,9 +279,11 @@ class Note(MPTTModel):
             self.order = Order.objects.get(url_code=order_code)
 
     @classmethod
-    def from_email(cls, msg, user):
+    def from_email(cls, msg, user, attachments=None):
         """
-        Creates a new Note from an email message
+        Creates a new Note from an email message.
+        attachments are the (filename, file) pairs of msg
+        if they have already been decoded.
         """
         sender = decode_header(msg['From'])
         detected = chardet.detect(sender[0][0]).get('encoding')
@@ -278,6 +295,7 @@ class Note(MPTTModel):
         note.is_read = False
         note.is_reported = False
         note.recipient = msg['To']
+        note.message_id = (msg['Message-ID'] or '').strip()[:255]
 
         subject = decode_header(msg['Subject'])[0]
         detected = chardet.detect(subject[0]).get('encoding')
@@ -289,24 +307,25 @@ class Note(MPTTModel):
             t, s = part.get_content_type().split('/', 1)
             charset = part.get_content_charset() or "latin1"
 
-            if t == "text":
+            if t == "text" and not part.get_filename():
                 payload = part.get_payload(decode=True)
                 note.body = unicode(payload, str(charset), "ignore")
                 if s == "html":
                     h = html2text.HTML2Text()
                     h.ignore_images = True
                     note.body = h.handle(note.body)
-            else:
-                note.save()
-                if part.get_filename():
-                    filename = unicode(part.get_filename())
-                    payload = part.get_payload()
-                    content = base64.b64decode(payload)
-                    content = ContentFile(content, filename)
-                    attachment = Attachment(content=content, content_object=note)
-                    attachment.save()
-                    attachment.content.save(filename, content)
-                    note.attachments.add(attachment)
+
+        note.save()
+
+        if attachments is None:
+            from servo.messaging.imap import decode_attachments
+            attachments = decode_attachments(msg)
+
+        for filename, fh in attachments:
+            content = File(fh, filename)
+            attachment = Attachment(content=content, content_object=note)
+            attachment.save()
+            fh.close()
 
         if not note.parent:
             # cookie not found in the subject, let's try the body...
@@ -367,25 +386,27 @@ class Note(MPTTModel):
         r = self.message_set.filter(recipient=recipient)
         return r.exclude(status='FAILED').exists()
 
-    def send_mail(self, user):
-        """Sends this note as an email"""
+    def send_mail(self, user, send=True):
+        """
+        Queues this note to be sent as an email.
+        With send=False the queue is left for the caller to flush.
+        """
         mailto = self.mailto()
+        recipients = mailto.split(',')
 
         # Only send the same note once
-        if self.has_sent_message(mailto):
+        if all([self.has_sent_message(r) for r in recipients]):
             raise ValueError(_('Already sent message to %s') % mailto)
 
-        config = Configuration.conf()
-        smtp_host = config.get('smtp_host').split(':')
-        settings.EMAIL_HOST = smtp_host[0]
-
-        if len(smtp_host) > 1:
-            settings.EMAIL_PORT = int(smtp_host[1])
+        for r in recipients:
+            Message.queue(self, r, 'EMAIL', user, send)
 
-        settings.EMAIL_USE_TLS = config.get('smtp_ssl')
-        settings.EMAIL_HOST_USER = str(config.get('smtp_user'))
-        settings.EMAIL_HOST_PASSWORD = str(config.get('smtp_password'))
+        return _(u'Message to %s queued') % mailto
 
+    def deliver_mail(self, messages, connection):
+        """
+        Sends this note as one email to the recipients of messages
+        """
         headers = {}
         headers['Reply-To'] = self.sender
         headers['References'] = '%s.%s' % (self.code, self.sender)
@@ -398,41 +419,30 @@ class Note(MPTTModel):
                                            self.code,
                                            self.order.url_code)
 
-        recipients = mailto.split(',')
+        recipients = [m.recipient for m in messages]
 
         msg = EmailMessage(subject,
                            self.body,
                            self.sender,
                            recipients,
-                           headers=headers)
+                           headers=headers,
+                           connection=connection)
 
         for f in self.attachments.all():
             msg.attach_file(f.content.path)
 
         msg.send()
 
-        for r in recipients:
-            msg = Message(note=self, recipient=r, created_by=user, body=self.body)
-            msg.sent_at = timezone.now()
-            msg.sender = self.sender
-            msg.status = 'SENT'
-            msg.save()
+        message = _(u'Message sent to %s') % ','.join(recipients)
+        self.notify('email_sent', message, messages[0].created_by)
 
-        message = _(u'Message sent to %s') % mailto
-        self.notify('email_sent', message, user)
-        return message
-
-    def send_sms_smtp(self, config, recipient):
+    def send_sms_smtp(self, config, recipient, connection):
         """
         Sends SMS through SMTP gateway
         """
         recipient = recipient.replace(' ', '')
-        settings.EMAIL_HOST = config.get('smtp_host')
-        settings.EMAIL_USE_TLS = config.get('smtp_ssl')
-        settings.EMAIL_HOST_USER = config.get('smtp_user')
-        settings.EMAIL_HOST_PASSWORD = config.get('smtp_password')
-
-        send_mail(recipient, self.body, self.sender, [config['sms_smtp_address']])
+        send_mail(recipient, self.body, self.sender,
+                  [config['sms_smtp_address']], connection=connection)
 
     def send_sms_builtin(self, recipient, sender=None):
         """
@@ -453,13 +463,12 @@ class Note(MPTTModel):
             'message'   : self.body.encode(SMS_ENCODING),
         })
 
-        from ssl import _create_unverified_context
-        f = urllib.urlopen(settings.SMS_HTTP_URL, data, context=_create_unverified_context())
-        return f.read()
+        from servo.messaging.sms import urlopen
+        return urlopen(settings.SMS_HTTP_URL, data)
 
-    def send_sms(self, number, user):
+    def send_sms(self, number, user, send=True):
         """
-        Sends message as SMS
+        Queues this note to be sent as SMS
         """
         number = validate_phone_number(number)
 
@@ -472,7 +481,19 @@ class Note(MPTTModel):
         if not sms_gw:
             raise ValueError(_("SMS gateway not configured"))
 
-        msg = Message(note=self, recipient=number, created_by=user, body=self.body)
+        if sms_gw == 'smtp' and not conf.get('sms_smtp_address'):
+            raise ValueError('Missing SMTP SMS gateway address')
+
+        Message.queue(self, number, 'SMS', user, send)
+        return _('Message to %s queued') % number
+
+    def deliver_sms(self, msg, connection):
+        """
+        Sends msg through the configured SMS gateway
+        """
+        conf = Configuration.conf()
+        sms_gw = conf.get('sms_gateway')
+        number = msg.recipient
 
         if sms_gw == 'hqsms':
             from servo.messaging.sms import HQSMSProvider
@@ -481,31 +502,19 @@ class Note(MPTTModel):
         if sms_gw == 'jazz':
             from servo.messaging.sms import SMSJazzProvider
             SMSJazzProvider(number, self, msg).send()
-            #self.send_sms_jazz(number, conf.get('sms_http_sender', ''), msg)
 
         if sms_gw == 'http':
             from servo.messaging.sms import HttpProvider
-            HttpProvider(self, number).send()
+            HttpProvider(number, self, msg).send()
 
         if sms_gw == 'smtp':
-            gw_address = conf.get('sms_smtp_address')
-
-            if not gw_address:
-                raise ValueError('Missing SMTP SMS gateway address')
-
-            self.send_sms_smtp(conf, number)
+            self.send_sms_smtp(conf, number, connection)
 
         if sms_gw == 'builtin':
             self.send_sms_builtin(number)
 
-        msg.method  = 'SMS'
-        msg.status  = 'SENT'
-        msg.sent_at = timezone.now()
-        msg.save()
-
         message = _('Message sent to %s') % number
         self.notify('sms_sent', message, self.created_by)
-        return message
 
     def send_and_save(self, user):
         """
@@ -561,6 +570,9 @@ class Message(models.Model):
     Only one sender and recipient per message
     Keeping this separate from Note so that we can send and track
     messages separately from Notes
+
+    Messages are QUEUED by the web requests and sent by
+    the send_messages task.
     """
     note = models.ForeignKey(Note)
     code = models.CharField(unique=True, max_length=36, default=defaults.uid)
@@ -571,6 +583,7 @@ class Message(models.Model):
     sent_at = models.DateTimeField(null=True)
     received_at = models.DateTimeField(null=True)
     STATUSES = (
+        ('QUEUED',    'QUEUED'),
         ('SENT',      'SENT'),
         ('DELIVERED', 'DELIVERED'),
         ('RECEIVED',  'RECEIVED'),
@@ -588,31 +601,169 @@ class Message(models.Model):
         default=METHODS[0][0]
     )
     error = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True)
 
-    def send(self):
-        result = None
-        self.recipient = self.recipient.strip()
+    # the gateway has the message but hasn't reported on it for good
+    IN_TRANSIT = ('SENT', 'ACCEPTED',)
 
-        try:
-            validate_phone_number(self.recipient)
-            result = self.send_sms()
-        except ValidationError:
-            pass
+    MAX_ATTEMPTS = 6
+    RETRY_DELAY = 60 # seconds, doubled after each attempt
+    BATCH_SIZE = 100
 
-        try:
-            validate_email(self.recipient)
-            result = self.send_mail()
-        except ValidationError:
-            pass
+    @classmethod
+    def queue(cls, note, recipient, method, user, send=True):
+        """
+        Queues note to be sent to recipient.
+        Failed messages are queued again.
+        send=False skips waking up the sender, for callers
+        that queue many messages at once.
+        """
+        from django.db import transaction
+        from servo.tasks import send_messages
+
+        msg, created = cls.objects.get_or_create(
+            note=note,
+            recipient=recipient,
+            defaults={'created_by': user, 'method': method, 'status': 'QUEUED',
+                      'sender': note.sender, 'body': note.body}
+        )
+
+        if not created:
+            if msg.status != 'FAILED':
+                return msg
+
+            msg.status, msg.error = 'QUEUED', ''
+            msg.attempts, msg.next_attempt_at = 0, None
+            msg.body, msg.created_by = note.body, user
+            msg.save()
+
+        if send:
+            transaction.on_commit(lambda: send_messages.delay())
+
+        return msg
+
+    def set_sent(self):
+        """
+        Marks this message as sent, unless a delivery report
+        has already moved it further along
+        """
+        self.sent_at = timezone.now()
+        queued = Message.objects.filter(pk=self.pk, status='QUEUED')
+
+        if queued.update(status='SENT', sent_at=self.sent_at):
+            self.status = 'SENT'
+
+    def set_failed(self, error):
+        """
+        Schedules this message to be retried later, with exponential
+        backoff, or marks it as FAILED after too many attempts
+        """
+        self.attempts += 1
+        self.error = unicode(error)
+
+        if self.attempts >= self.MAX_ATTEMPTS:
+            self.status = 'FAILED'
+        else:
+            delay = self.RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
 
         self.save()
-        return result
+
+    def postpone(self, seconds):
+        self.next_attempt_at = timezone.now() + timedelta(seconds=seconds)
+        self.save()
+
+    @classmethod
+    def get_queued(cls):
+        from django.db.models import Q
+        now = timezone.now()
+        queued = cls.objects.filter(status='QUEUED')
+        queued = queued.filter(Q(next_attempt_at=None) | Q(next_attempt_at__lte=now))
+        return queued.select_related('note', 'created_by').order_by('id')
+
+    @classmethod
+    def send_queued(cls):
+        """
+        Sends a batch of queued messages over one SMTP connection.
+        Every message of the batch is either sent, failed or postponed.
+        Returns the number of messages sent.
+        """
+        from itertools import groupby
+        from servo.messaging.sms import RateLimit
+
+        sent = 0
+        queued = list(cls.get_queued()[:cls.BATCH_SIZE])
+        gateway = Configuration.conf('sms_gateway')
+
+        emails = sorted([m for m in queued if m.method == 'EMAIL'], key=lambda m: m.note_id)
+        texts = [m for m in queued if m.method == 'SMS']
+        connection, error = None, None
+
+        if emails or (texts and gateway == 'smtp'):
+            try:
+                connection = Configuration.get_smtp_connection()
+                connection.open()
+            except Exception as e:
+                connection, error = None, e
+
+        def deliver(messages, send, needs_connection=True):
+            try:
+                if needs_connection and error:
+                    raise error
+                send()
+            except Exception as e:
+                for m in messages:
+                    m.set_failed(e)
+                return 0
+
+            for m in messages:
+                m.set_sent()
+
+            return len(messages)
+
+        try:
+            for note, messages in groupby(emails, lambda m: m.note):
+                messages = list(messages)
+                sent += deliver(messages, lambda: note.deliver_mail(messages, connection))
+
+            limit = RateLimit.for_gateway(gateway)
+
+            for m in texts:
+                if not limit.acquire():
+                    m.postpone(limit.period)
+                    continue
+
+                send = lambda: m.note.deliver_sms(m, connection)
+                sent += deliver([m], send, gateway == 'smtp')
+        finally:
+            if connection:
+                connection.close()
+
+        return sent
 
     class Meta:
         app_label = "servo"
         unique_together = ('note', 'recipient')
 
 
+class MailboxState(models.Model):
+    """
+    How far an IMAP mailbox has been read.
+    The UIDs are only valid for as long as the UIDVALIDITY of the
+    mailbox stays the same.
+    """
+    mailbox = models.CharField(max_length=255, unique=True)
+    uidvalidity = models.BigIntegerField(default=0)
+    last_uid = models.BigIntegerField(default=0)
+    synced_at = models.DateTimeField(null=True)
+    # {uid: attempts} of the messages that couldn't be saved
+    failed_uids = JSONField(default=dict)
+
+    class Meta:
+        app_label = "servo"
+
+
 class Article(models.Model):
     """
     GSX Communications article or a bit of local news
@@ -1,18 +1,20 @@
 # -*- coding: utf-8 -*-
 
 from datetime import timedelta
-from django.db import models, IntegrityError
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Prefetch
 
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.contrib.contenttypes.fields import GenericRelation
 
 from django.dispatch import receiver
 from django.core.urlresolvers import reverse
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+                                      post_delete, m2m_changed,)
 
 from servo import defaults
 from servo.lib.shorturl import encode_url
@@ -24,6 +26,34 @@ from servo.models.device import Device
 from servo.models.queue import Queue, Status, QueueStatus
 
 
+# the totals of the reported items of these orders, saved when they change
+TOTALS_SQL = """WITH t AS (
+    SELECT o.id,
+        COALESCE(SUM(ROUND(i.price / ((100 + p.pct_vat) / 100), 2) * i.amount), 0) AS net,
+        COALESCE(SUM(i.price * i.amount), 0) AS gross,
+        COALESCE(SUM(CASE i.price_category
+            WHEN 'stock' THEN p.price_purchase_stock
+            WHEN 'exchange' THEN p.price_purchase_exchange
+            ELSE 0 END * i.amount), 0) AS purchase
+    FROM servo_order o
+    LEFT JOIN servo_serviceorderitem i ON (i.order_id = o.id AND i.should_report)
+    LEFT JOIN servo_product p ON (p.id = i.product_id)
+    WHERE o.id = ANY(%s)
+    GROUP BY o.id
+), u AS (
+    UPDATE servo_order o SET net_amount = t.net, gross_amount = t.gross,
+        tax_amount = t.gross - t.net, purchase_amount = t.purchase,
+        margin_amount = t.net - t.purchase
+    FROM t WHERE o.id = t.id
+    AND (o.net_amount, o.gross_amount, o.purchase_amount)
+        IS DISTINCT FROM (t.net, t.gross, t.purchase)
+    RETURNING o.id
+)
+SELECT t.id, t.net, t.gross, t.gross - t.net, t.purchase, t.net - t.purchase,
+    u.id IS NOT NULL
+FROM t LEFT JOIN u ON (u.id = t.id)"""
+
+
 class Order(models.Model):
     """
     The Service Order
@@ -142,8 +172,124 @@ class Order(models.Model):
     status_limit_green = models.DateTimeField(null=True)  # turn yellow after this
     status_limit_yellow = models.DateTimeField(null=True) # turn red after this
 
+    # money totals of the reported items, kept up to date by update_totals()
+    net_amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                     default=0, editable=False)
+    gross_amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                       default=0, editable=False)
+    tax_amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                     default=0, editable=False)
+    purchase_amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                          default=0, editable=False)
+    margin_amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                        default=0, editable=False)
+
+    TOTAL_FIELDS = ('net_amount', 'gross_amount', 'tax_amount',
+                    'purchase_amount', 'margin_amount',)
+
     api_fields = ('status_name', 'status_description',)
 
+    # the most queries get_detail() runs, however big the order is
+    DETAIL_QUERIES = 17
+
+    @classmethod
+    def get_detail(cls, pk):
+        """
+        Returns this order with everything the order page shows
+        in at most DETAIL_QUERIES queries
+        """
+        from servo.models.note import Note
+        from servo.models.repair import ChecklistItemValue
+
+        items = ServiceOrderItem.objects.select_related('product')
+        devices = OrderDevice.objects.select_related('device')
+        values = ChecklistItemValue.objects.select_related('checked_by')
+        notes = Note.objects.select_related('created_by', 'escalation')
+
+        orders = cls.objects.select_related(
+            'customer', 'queue', 'status__status', 'user',
+            'location', 'checkin_location', 'checkout_location',
+        ).prefetch_related(
+            'followed_by', 'tags', 'accessory_set', 'invoice_set',
+            Prefetch('serviceorderitem_set', queryset=items),
+            'serviceorderitem_set__servicepart_set',
+            Prefetch('orderdevice_set', queryset=devices),
+            'orderdevice_set__device__repair_set',
+            'repair_set__servicepart_set__order_item',
+            Prefetch('checklistitemvalue_set', queryset=values),
+            # recursetree wants the notes in tree order
+            Prefetch('note_set', queryset=notes.order_by('tree_id', 'lft')),
+            'note_set__message_set', 'note_set__attachments', 'note_set__labels',
+        )
+
+        order = orders.get(pk=pk)
+        order._detail = {}
+        return order
+
+    @classmethod
+    def refresh_totals(cls, order_ids):
+        """
+        Recomputes the money totals of these orders in one query.
+        Returns the totals by order ID and how many orders changed.
+        """
+        totals, changed = {}, 0
+
+        if not order_ids:
+            return totals, changed
+
+        cursor = connection.cursor()
+        cursor.execute(TOTALS_SQL, [list(order_ids)])
+
+        for row in cursor.fetchall():
+            totals[row[0]] = row[1:6]
+            changed += row[6]
+
+        return totals, changed
+
+    def update_totals(self):
+        totals, changed = Order.refresh_totals([self.pk])
+
+        for f, v in zip(self.TOTAL_FIELDS, totals.get(self.pk, ())):
+            setattr(self, f, v)
+
+        return changed > 0
+
+    def get_detail_value(self, key, func):
+        """
+        Returns func(), memoized if this order came from get_detail()
+        since its prefetched rows won't change under it
+        """
+        detail = getattr(self, '_detail', None)
+
+        if detail is None:
+            return func()
+
+        if key not in detail:
+            detail[key] = func()
+
+        return detail[key]
+
+    def get_items(self):
+        """
+        Returns the reported order items with their products
+        """
+        def items():
+            items = self.serviceorderitem_set.all()
+            if getattr(self, '_detail', None) is None:
+                items = items.select_related('product')
+            return [i for i in items if i.should_report]
+
+        return self.get_detail_value('items', items)
+
+    def get_order_devices(self):
+        def devices():
+            devices = self.orderdevice_set.all()
+            if getattr(self, '_detail', None) is None:
+                devices = devices.select_related('device')
+            return [d.device for d in devices]
+
+        return self.get_detail_value('devices', devices)
+
     def get_issues(self):
         return self.note_set.filter(type=1)
 
@@ -159,7 +305,7 @@ class Order(models.Model):
             a.save()
 
     def add_tag(self, tag, user):
-        from servo.tasks import apply_rules
+        from servo.tasks import run_rules
 
         if not isinstance(tag, Tag):
             tag = Tag.objects.get(pk=tag)
@@ -171,7 +317,7 @@ class Order(models.Model):
         event.action = "set_tag"
         event.triggered_by = user
 
-        apply_rules(event)
+        run_rules(event)
 
     def set_tags(self, tags, user):
         return [self.add_tag(t, user) for t in tags]
@@ -184,7 +330,7 @@ class Order(models.Model):
         self.set_queue(queue_id, user)
 
     def can_order_products(self):
-        return self.products.count() > 0 and self.is_editable
+        return self.has_products and self.is_editable
 
     def duplicate(self, user):
         new_order = Order(customer=self.customer, created_by=user)
@@ -215,14 +361,13 @@ class Order(models.Model):
 
     def get_repairs(self):
         # Returns the active GSX repairs for this SO
-        return self.repair_set.exclude(submitted_at=None)
+        return [r for r in self.repair_set.all() if r.submitted_at is not None]
 
     def get_repair(self):
         # Returns the latest GSX repair for this SO
-        try:
-            return self.get_repairs().latest()
-        except Exception:
-            return
+        repairs = self.get_repairs()
+        if repairs:
+            return max(repairs, key=lambda r: r.created_at)
 
     def get_similar(self, status, state):
         # Returns a queryset of "similar" cases
@@ -340,10 +485,10 @@ class Order(models.Model):
             return _("Orders")
 
     def is_item_complete(self, item):
-        try:
-            return self.checklistitemvalue_set.get(item=item)
-        except Exception:
-            return False
+        values = self.get_detail_value('checklist', lambda: dict(
+            (v.item_id, v) for v in self.checklistitemvalue_set.all()
+        ))
+        return values.get(item.pk, False)
 
     def close(self, user):
         """
@@ -356,7 +501,7 @@ class Order(models.Model):
                 except Exception as e:
                     # notify the creator of the GSX repair instead of just erroring out
                     e = self.notify("gsx_error", e, user)
-                    e.notify_users.add(r.created_by)
+                    e.notify([r.created_by])
 
         if self.queue and self.queue.status_closed:
             self.set_status(self.queue.status_closed, user)
@@ -479,8 +624,8 @@ class Order(models.Model):
         e.triggered_by = user
         e.save()
 
-        for f in self.followed_by.exclude(pk=user.pk).exclude(should_notify=False):
-            e.notify_users.add(f)
+        followers = self.followed_by.exclude(pk=user.pk)
+        e.notify(followers.exclude(should_notify=False))
 
         if action == "product_arrived":
             if self.queue and self.queue.status_products_received:
@@ -522,6 +667,18 @@ class Order(models.Model):
         # trigger the notification
         self.notify("set_status", self.status_name, user)
 
+    def products_received(self, user):
+        """
+        Sets the products received status of this order's queue, if any
+        """
+        if self.queue is None:
+            return
+
+        new_status = self.queue.status_products_received
+
+        if new_status and self.is_editable:
+            self.set_status(new_status, user)
+
     def unset_status(self, user):
         if self.is_closed:
             return # fail silently
@@ -639,11 +796,12 @@ class Order(models.Model):
             return self.customer.tree_id
 
     def has_devices(self):
-        return self.devices.all().count() > 0
+        return len(self.get_order_devices()) > 0
 
     def device_name(self):
-        if self.devices.count():
-            return self.devices.all()[0].description
+        devices = self.get_order_devices()
+        if devices:
+            return devices[0].description
 
     def set_customer(self, new_customer):
         self.customer = new_customer
@@ -656,29 +814,18 @@ class Order(models.Model):
             pass
 
     def device_slug(self):
-        try:
-            return self.devices.all()[0].slug
-        except Exception:
-            pass
+        devices = self.get_order_devices()
+        if devices:
+            return devices[0].slug
 
     def net_total(self):
-        total = 0
-
-        for p in self.serviceorderitem_set.filter(should_report=True):
-            total += p.price_notax() * p.amount
-
-        return total
+        return self.net_amount
 
     def gross_total(self):
-        total = 0
-
-        for p in self.serviceorderitem_set.filter(should_report=True):
-            total += p.price * p.amount
-
-        return total
+        return self.gross_amount
 
     def total_tax(self):
-        return self.gross_total() - self.net_total()
+        return self.tax_amount
 
     def add_product(self, product, amount, user):
         """
@@ -708,8 +855,8 @@ class Order(models.Model):
 
     @property
     def can_dispatch(self):
-        undispatched = self.products.filter(dispatched=False)
-        return undispatched.count() > 0 and self.is_editable
+        undispatched = [p for p in self.get_items() if not p.dispatched]
+        return len(undispatched) > 0 and self.is_editable
 
     @property
     def can_close(self):
@@ -724,14 +871,7 @@ class Order(models.Model):
             self.set_status(self.queue.status_dispatched, invoice.created_by)
 
     def total_margin(self):
-        """
-        Calculates the total margin for this Service Order
-        """
-        total_purchase_price = 0
-        for p in self.serviceorderitem_set.filter(should_report=True):
-            total_purchase_price += p.get_product_price('purchase') * p.amount
-
-        return (self.net_total() - Decimal(total_purchase_price))
+        return self.margin_amount
 
     @property
     def products(self):
@@ -745,7 +885,7 @@ class Order(models.Model):
         """
         Returns the GSX parts that can be ordered for this SRO
         """
-        return [x for x in self.products.all() if x.product.is_apple_part]
+        return [x for x in self.get_items() if x.product.is_apple_part]
 
     @property
     def has_parts(self):
@@ -770,10 +910,13 @@ class Order(models.Model):
 
     @property
     def has_products(self):
-        return self.products.count() > 0
+        return len(self.get_items()) > 0
 
     def has_accessories(self):
-        return self.accessory_set.all().count() > 0
+        return len(self.accessory_set.all()) > 0
+
+    def get_device_accessories(self, device):
+        return [a.name for a in self.accessory_set.all() if a.device_id == device.pk]
 
     def get_accessories(self):
         return self.accessory_set.values_list('name', flat=True)
@@ -806,6 +949,12 @@ class Order(models.Model):
         if self.customer and self.customer_name == '':
             self.customer_name = self.customer.fullname
 
+        if self.pk is not None and not args and not kwargs:
+            # only refresh_totals() writes the totals, so an order
+            # loaded before its items changed can't overwrite them
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.TOTAL_FIELDS]
+
         super(Order, self).save(*args, **kwargs)
 
         if self.code is None:
@@ -965,7 +1114,10 @@ class ServiceOrderItem(AbstractOrderItem):
                     return m[1]
 
     def get_part(self):
-        return self.servicepart_set.latest()
+        # the latest part, from the prefetch cache of Order.get_detail()
+        parts = self.servicepart_set.all()
+        if parts:
+            return max(parts, key=lambda p: p.pk)
 
     def get_poitem(self):
         return self.purchaseorderitem_set.latest()
@@ -977,11 +1129,8 @@ class ServiceOrderItem(AbstractOrderItem):
         """
         Reserve this SOI for the inventory at this location
         """
-        location = self.order.location
-        inventory, created = Inventory.objects.get_or_create(location=location,
-                                                             product=self.product)
-        inventory.amount_reserved += self.amount
-        inventory.save()
+        Inventory.record(self.product, self.order.location, 'reserve',
+                         reserved=self.amount)
 
     def get_purchase_price(self):
         """
@@ -1151,6 +1300,313 @@ class Accessory(models.Model):
         app_label = "servo"
 
 
+class OrderBatch(models.Model):
+    """
+    Progress and results of one run of /orders/batch.
+    The orders are processed in chunks by parallel workers that
+    each add their counts and errors to this record.
+    """
+    CHUNK_SIZE = 50
+
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # order code -> error message
+    errors = JSONField(default=dict)
+
+    @classmethod
+    def get_codes(cls, text):
+        """
+        Returns the unique order codes in text, in their original order
+        """
+        codes = []
+
+        for c in text.split():
+            if c not in codes:
+                codes.append(c)
+
+        return codes
+
+    def get_chunks(self, codes):
+        """
+        Resolves codes to order IDs, records the ones that don't exist
+        and returns the IDs in chunks of CHUNK_SIZE
+        """
+        orders = dict(Order.objects.filter(code__in=codes).values_list('code', 'pk'))
+        missing = [c for c in codes if c not in orders]
+        ids = [orders[c] for c in codes if c in orders]
+
+        self.total = len(codes)
+        self.save()
+
+        if missing or not ids:
+            errors = dict([(c, unicode(_('Order not found'))) for c in missing])
+            self.add_results(0, errors)
+
+        size = self.CHUNK_SIZE
+        return [ids[i:i+size] for i in range(0, len(ids), size)]
+
+    def add_results(self, processed, errors, failed=None):
+        """
+        Adds the results of one chunk to this batch.
+        failed defaults to one per error, but processed orders can
+        have errors too (like a message that couldn't be sent).
+        Done in one statement since the chunks finish concurrently.
+        """
+        import json
+        from django.db import connection
+
+        sql = """UPDATE servo_orderbatch SET processed = processed + %(processed)s,
+            failed = failed + %(failed)s, errors = errors || %(errors)s::jsonb,
+            finished_at = CASE WHEN processed + failed + %(processed)s + %(failed)s >= total
+                THEN %(now)s ELSE finished_at END
+            WHERE id = %(id)s"""
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'id': self.pk,
+                                 'processed': processed,
+                                 'failed': len(errors) if failed is None else failed,
+                                 'errors': json.dumps(errors),
+                                 'now': timezone.now()})
+
+    def is_finished(self):
+        return self.finished_at is not None
+
+    def get_progress(self):
+        if not self.total:
+            return 100
+        return int(100.0 * (self.processed + self.failed) / self.total)
+
+    class Meta:
+        app_label = "servo"
+        ordering = ('-id',)
+
+
+class OrderCounter(models.Model):
+    """
+    The number of orders per queue, tag, user and location in each state.
+    Kept current by the signal handlers at the end of this module
+    so that the badges don't have to count the orders.
+    """
+    KINDS = ('queue', 'tag', 'user', 'location',)
+
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    state = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def get_keys(cls, state, queue_id=None, user_id=None, location_id=None, tag_ids=()):
+        """
+        Returns the (kind, object_id, state) counters an order counts towards
+        """
+        keys = [('queue', queue_id, state),
+                ('user', user_id, state),
+                ('location', location_id, state),]
+        keys += [('tag', pk, state) for pk in tag_ids]
+        return [k for k in keys if k[1] is not None]
+
+    @classmethod
+    def get_order_keys(cls, order, tag_ids=()):
+        return cls.get_keys(order.state, order.queue_id, order.user_id,
+                            order.location_id, tag_ids)
+
+    @classmethod
+    def add(cls, key, count):
+        kind, object_id, state = key
+        values = {'kind': kind, 'object_id': object_id, 'state': state}
+
+        if cls.objects.filter(**values).update(count=models.F('count') + count) > 0:
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(count=count, **values)
+        except IntegrityError:
+            # created by a concurrent request
+            cls.objects.filter(**values).update(count=models.F('count') + count)
+
+    @classmethod
+    def apply(cls, old, new):
+        """
+        Moves an order from the old counters to the new ones
+        """
+        with transaction.atomic():
+            for k in old:
+                if k not in new:
+                    cls.add(k, -1)
+            for k in new:
+                if k not in old:
+                    cls.add(k, 1)
+
+    @classmethod
+    def get_count(cls, kind, object_id, max_state=Order.STATE_CLOSED):
+        rows = cls.objects.filter(kind=kind, object_id=object_id, state__lt=max_state)
+        return rows.aggregate(total=models.Sum('count'))['total'] or 0
+
+    class Meta:
+        app_label = "servo"
+        unique_together = ('kind', 'object_id', 'state',)
+
+
+class OrderSearchIndex(models.Model):
+    """
+    A denormalized copy of the filterable columns of an Order.
+    The order list views query this table alone instead of joining
+    devices, tags and followers. Rows are kept current by the signal
+    handlers at the end of this module.
+    """
+    order = models.OneToOneField(
+        Order,
+        primary_key=True,
+        related_name='search_index'
+    )
+
+    priority = models.IntegerField(default=Queue.PRIO_NORMAL)
+    state = models.IntegerField(default=Order.STATE_QUEUED)
+    created_at = models.DateTimeField(null=True)
+
+    location_id = models.IntegerField(null=True)
+    checkin_location_id = models.IntegerField(null=True)
+    queue_id = models.IntegerField(null=True)
+    user_id = models.IntegerField(null=True)
+    created_by_id = models.IntegerField(null=True)
+    customer_id = models.IntegerField(null=True)
+    customer_tree_id = models.IntegerField(null=True)
+    # the Status (not the QueueStatus) of the order
+    status_id = models.IntegerField(null=True)
+
+    status_started_at = models.DateTimeField(null=True)
+    status_limit_green = models.DateTimeField(null=True)
+    status_limit_yellow = models.DateTimeField(null=True)
+
+    tag_ids = ArrayField(models.IntegerField(), default=list)
+    device_ids = ArrayField(models.IntegerField(), default=list)
+    device_slugs = ArrayField(models.CharField(max_length=128), default=list)
+    follower_ids = ArrayField(models.IntegerField(), default=list)
+    repair_refs = ArrayField(models.CharField(max_length=16), default=list)
+
+    # lowercased free text for search.orders, trigram-indexed
+    customer_text = models.TextField(default='')
+    device_text = models.TextField(default='')
+
+    @classmethod
+    def get_order_values(cls, order):
+        """
+        Returns the index columns that are stored on the order itself
+        """
+        values = {
+            'priority': order.priority,
+            'state': order.state,
+            'created_at': order.created_at,
+            'location_id': order.location_id,
+            'checkin_location_id': order.checkin_location_id,
+            'queue_id': order.queue_id,
+            'user_id': order.user_id,
+            'created_by_id': order.created_by_id,
+            'customer_id': order.customer_id,
+            'customer_tree_id': None,
+            'status_id': None,
+            'status_started_at': order.status_started_at,
+            'status_limit_green': order.status_limit_green,
+            'status_limit_yellow': order.status_limit_yellow,
+            'customer_text': order.customer_name.lower(),
+        }
+
+        if order.status_id:
+            values['status_id'] = order.status.status_id
+
+        if order.customer_id:
+            customer = order.customer
+            values['customer_tree_id'] = customer.tree_id
+            text = u'%s %s' % (customer.fullname, customer.phone)
+            values['customer_text'] = text.lower()
+
+        return values
+
+    @classmethod
+    def get_related_values(cls, order_id):
+        """
+        Returns the index columns that come from the order's relations
+        """
+        from servo.models.repair import Repair
+
+        tags = Order.tags.through.objects.filter(order_id=order_id)
+        followers = Order.followed_by.through.objects.filter(order_id=order_id)
+        devices = Device.objects.filter(orderdevice__order_id=order_id)
+        devices = devices.values_list('pk', 'slug', 'sn', 'imei')
+        repairs = Repair.objects.filter(order_id=order_id)
+        repairs = repairs.values_list('confirmation', 'reference')
+
+        values = {
+            'tag_ids': list(tags.values_list('tag_id', flat=True)),
+            'follower_ids': list(followers.values_list('user_id', flat=True)),
+            'device_ids': [],
+            'device_slugs': [],
+            'repair_refs': [],
+        }
+
+        serials = []
+
+        for pk, slug, sn, imei in devices:
+            values['device_ids'].append(pk)
+            if slug:
+                values['device_slugs'].append(slug)
+            serials += [sn, imei]
+
+        values['device_text'] = ' '.join([s for s in serials if s]).lower()
+
+        for refs in repairs:
+            values['repair_refs'] += [r for r in refs if r]
+
+        return values
+
+    @classmethod
+    def update_order(cls, order, create=False):
+        """
+        Refreshes the index row of this order.
+        Rows are only created for new orders (or by the reindexorders
+        command) so that saves during a cascading delete can't
+        resurrect them.
+        """
+        values = cls.get_order_values(order)
+
+        if cls.objects.filter(pk=order.pk).update(**values) > 0 or not create:
+            return
+
+        values.update(cls.get_related_values(order.pk))
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(order=order, **values)
+        except IntegrityError:
+            # created by a concurrent request
+            cls.objects.filter(pk=order.pk).update(**values)
+
+    @classmethod
+    def update_related(cls, order_ids):
+        """
+        Refreshes the relation columns of these orders.
+        Never creates rows so that it's safe to call while an order is
+        being deleted.
+        """
+        for pk in set(order_ids):
+            values = cls.get_related_values(pk)
+            cls.objects.filter(pk=pk).update(**values)
+
+    @classmethod
+    def rebuild(cls, order):
+        cls.update_order(order, create=True)
+        cls.update_related([order.pk])
+
+    class Meta:
+        app_label = "servo"
+
+
 @receiver(post_save, sender=OrderDevice)
 def trigger_orderdevice_saved(sender, instance, created, **kwargs):
     order = instance.order
@@ -1178,3 +1634,141 @@ def trigger_device_removed(sender, instance, **kwargs):
         order.description = ''
 
     order.save()
+
+
+@receiver(post_save, sender=ServiceOrderItem)
+@receiver(post_delete, sender=ServiceOrderItem)
+def trigger_order_items_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    # keep the totals of the order we were given current too
+    order = instance.__dict__.get('_order_cache')
+
+    if order is None:
+        Order.refresh_totals([instance.order_id])
+    else:
+        order.update_totals()
+
+
+@receiver(post_save, sender=Order)
+def trigger_order_saved(sender, instance, created, raw, **kwargs):
+    if not raw:
+        OrderSearchIndex.update_order(instance, create=created)
+
+
+@receiver(post_save, sender=OrderDevice)
+@receiver(post_delete, sender=OrderDevice)
+def trigger_order_devices_changed(sender, instance, **kwargs):
+    OrderSearchIndex.update_related([instance.order_id])
+
+
+@receiver(post_save, sender=Device)
+def trigger_indexed_device_saved(sender, instance, created, **kwargs):
+    if not created:
+        rows = OrderSearchIndex.objects.filter(device_ids__contains=[instance.pk])
+        OrderSearchIndex.update_related(rows.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Order.tags.through)
+@receiver(m2m_changed, sender=Order.followed_by.through)
+def trigger_order_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        return OrderSearchIndex.update_related([instance.pk])
+
+    # the change was made from the Tag or User side
+    if pk_set is None:
+        field = 'tag_ids' if sender is Order.tags.through else 'follower_ids'
+        rows = OrderSearchIndex.objects.filter(**{field + '__contains': [instance.pk]})
+        pk_set = rows.values_list('pk', flat=True)
+
+    OrderSearchIndex.update_related(pk_set)
+
+
+@receiver(pre_save, sender=Order)
+def trigger_counter_snapshot(sender, instance, raw=False, **kwargs):
+    """
+    Remembers which counters the saved version of this order counts towards
+    """
+    if raw or instance.pk is None:
+        return
+
+    old = Order.objects.filter(pk=instance.pk)
+    old = old.values_list('state', 'queue_id', 'user_id', 'location_id')
+
+    if old:
+        instance._counter_values = old[0]
+
+
+@receiver(post_save, sender=Order)
+def trigger_counter_order_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    old = instance.__dict__.pop('_counter_values', None)
+    new = (instance.state, instance.queue_id, instance.user_id, instance.location_id,)
+
+    if old == new or (old is None and not created):
+        return
+
+    tag_ids = ()
+
+    if old is not None and old[0] != new[0]:
+        # the tags are counted per state too
+        tags = Order.tags.through.objects.filter(order_id=instance.pk)
+        tag_ids = list(tags.values_list('tag_id', flat=True))
+
+    old_keys = OrderCounter.get_keys(*old, tag_ids=tag_ids) if old else []
+    OrderCounter.apply(old_keys, OrderCounter.get_keys(*new, tag_ids=tag_ids))
+
+
+@receiver(pre_delete, sender=Order)
+def trigger_counter_order_deleting(sender, instance, **kwargs):
+    # the tags are gone by the time the order is
+    tags = Order.tags.through.objects.filter(order_id=instance.pk)
+    instance._counter_tags = list(tags.values_list('tag_id', flat=True))
+
+
+@receiver(post_delete, sender=Order)
+def trigger_counter_order_deleted(sender, instance, **kwargs):
+    tag_ids = instance.__dict__.pop('_counter_tags', ())
+    OrderCounter.apply(OrderCounter.get_order_keys(instance, tag_ids), [])
+
+
+@receiver(m2m_changed, sender=Order.tags.through)
+def trigger_counter_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    through = Order.tags.through.objects
+
+    if reverse:
+        through = through.filter(tag_id=instance.pk)
+        column = 'order_id'
+    else:
+        through = through.filter(order_id=instance.pk)
+        column = 'tag_id'
+
+    if action in ('pre_remove', 'pre_clear',):
+        # only count the relations that actually go away
+        if pk_set is not None:
+            through = through.filter(**{column + '__in': pk_set})
+        instance._counter_removed = list(through.values_list(column, flat=True))
+        return
+
+    if action == 'post_add':
+        delta = 1
+    elif action in ('post_remove', 'post_clear',):
+        pk_set, delta = instance.__dict__.pop('_counter_removed', []), -1
+    else:
+        return
+
+    if reverse:
+        states = Order.objects.filter(pk__in=pk_set).values_list('state', flat=True)
+        keys = [('tag', instance.pk, s) for s in states]
+    else:
+        keys = [('tag', pk, instance.state) for pk in pk_set]
+
+    with transaction.atomic():
+        for k in keys:
+            OrderCounter.add(k, delta)
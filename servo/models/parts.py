@@ -1,15 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import yaml
 import gsxws
 
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.core.files import File
-from django.core.cache import caches
 from django.utils.translation import ugettext_lazy as _
 
-from servo.models import GsxAccount
+from servo.models import Snapshot
 from servo.models.shipments import Shipment
 from servo.models.order import ServiceOrderItem
 from servo.models.purchases import PurchaseOrder, PurchaseOrderItem
@@ -19,25 +17,71 @@ def symptom_modifiers():
     return gsxws.MODIFIERS
 
 
-def get_remote_symptom_codes(group):
+class ComptiaCode(models.Model):
     """
-    Remote lookup for symptom codes
+    A CompTIA symptom code of a component group.
+    Refreshed from GSX by the periodic comptia command.
     """
-    symptoms = {}
-    cache = caches['comptia']
-    # First, try to load from global cache (updated every 24h)
-    data = cache.get('codes') or {}
+    group = models.CharField(max_length=4)
+    code = models.CharField(max_length=4)
+    description = models.CharField(max_length=255, default='')
 
-    if not data:
-        # ... then try to fetch from GSX
-        GsxAccount.fallback()
-        data = gsxws.comptia.fetch()
-        cache.set('codes', data)
+    @classmethod
+    def refresh(cls, data):
+        """
+        Replaces the catalog with data ({group: [(code, description)]}).
+        Returns the number of codes.
+        """
+        rows = []
+
+        for group, codes in data.items():
+            for code, description in codes:
+                rows.append(cls(group=group, code=code,
+                                description=(description or '')[:255]))
+
+        if not rows:
+            raise ValueError(_('No CompTIA codes received'))
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rows)
 
-    for k, v in data.get(group):
-        symptoms[k] = v
+        comptia_catalog.invalidate()
+        return len(rows)
 
-    return symptoms
+    class Meta:
+        app_label = "servo"
+        unique_together = ('group', 'code',)
+
+
+class ComptiaCatalog(Snapshot):
+    """
+    The CompTIA symptom codes as ready-made choice lists
+    keyed by component group
+    """
+    VERSION_KEY = 'comptia-version'
+    CHECK_INTERVAL = 60 # the codes change about never
+
+    def load(self):
+        symptoms = {}
+        codes = ComptiaCode.objects.values_list('group', 'code', 'description')
+
+        for group, code, description in codes:
+            symptoms.setdefault(group, []).append((code, description,))
+
+        catalog = {}
+
+        for group, codes in symptoms.items():
+            codes.sort()
+            catalog[group] = tuple([(k, "%s - %s " % (k, v)) for k, v in codes])
+
+        return catalog
+
+    def get_choices(self, group):
+        return self.get().get(group, ())
+
+
+comptia_catalog = ComptiaCatalog()
 
 
 def symptom_codes(group):
@@ -47,16 +91,7 @@ def symptom_codes(group):
     if group == '':
         return
 
-    try:
-        symptoms = get_remote_symptom_codes(group)
-    except Exception as e:
-        # ... finally fall back to local static data
-        # @FIXME: How do we keep this up to date?
-        data = yaml.load(open("servo/fixtures/comptia.yaml", "r"))
-        symptoms = data[group]['symptoms']
-
-    codes = [(k, "%s - %s " % (k, symptoms[k])) for k in sorted(symptoms)]
-    return codes
+    return comptia_catalog.get_choices(group)
 
 
 class ServicePart(models.Model):
@@ -230,6 +265,15 @@ class ServicePart(models.Model):
 
         new_part.save()
 
+    # the fields set from GSX part details
+    GSX_FIELDS = ('comptia_code', 'return_order', 'comptia_modifier',
+                  'order_status', 'order_status_code', 'coverage_description',
+                  'return_code', 'return_status', 'carrier_url', 'line_number',)
+
+    def get_gsx_details(self):
+        # GSX sends numbers as text
+        return [unicode(getattr(self, k)) for k in self.GSX_FIELDS]
+
     def set_part_details(self, gsx_part):
         """
         Updates this part to match the info from gsx_part
@@ -2,9 +2,12 @@
 
 import re
 from os.path import basename
+from multiprocessing.pool import ThreadPool
 
 from django.db import models
-from django.db import connection
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
 from django.conf import settings
 from django.core.files import File
 from django.core.cache import cache
@@ -13,6 +16,7 @@ from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.postgres.fields import JSONField
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -22,27 +26,137 @@ from mptt.models import MPTTModel, TreeForeignKey
 
 from servo import defaults
 from servo.lib.shorturl import from_time
-from servo.models import Configuration, Location, TaggedItem
+from servo.lib.search import TSVectorField, update_vectors
+from servo.models import Configuration, Location, TaggedItem, config_snapshot
 
 
-def get_margin(price=0.0):
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value or 0)
+
+
+class PriceEngine(object):
     """
-    Returns the proper margin % for this price
+    Calculates sales prices from purchase prices with the margin tiers,
+    VAT and shipping settings parsed once per configuration version
     """
-    price  = Decimal(price)
-    margin = defaults.margin()
+    _current = None # (configuration, engine)
+
+    def __init__(self, conf):
+        self.tiers = []
+        self.margin = Decimal(0)
+        margin = conf.get('pct_margin') or '0'
+
+        try:
+            self.margin = Decimal(margin)
+        except Exception:
+            for r in margin.split(';'):
+                m = re.search(r'(\d+)\-(\d+)=(\d+)', r)
+                if m is None:
+                    continue
+                p_min, p_max, pct = [Decimal(i) for i in m.groups()]
+                self.tiers.append((p_min, p_max, pct,))
+                # prices outside all the tiers get the last margin
+                self.margin = pct
+
+        self.tiers = tuple(self.tiers)
+        self.vat = to_decimal(conf.get('pct_vat'))
+
+        try:
+            self.shipping = to_decimal(conf.get('shipping_cost'))
+        except Exception:
+            self.shipping = Decimal(0)
+
+        self.prices = {}
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the engine for the current configuration
+        """
+        conf = config_snapshot.get()
+        current = cls._current
+
+        if current is None or current[0] is not conf:
+            current = (conf, cls(conf),)
+            cls._current = current
+
+        return current[1]
+
+    def get_margin(self, price):
+        """
+        Returns the margin % for this purchase price
+        """
+        for p_min, p_max, pct in self.tiers:
+            if p_min <= price <= p_max:
+                return pct
+
+        return self.margin
+
+    def get_price(self, price, shipping=None):
+        """
+        Returns the margin %, the price w/o tax and the price with tax
+        for this purchase price
+        """
+        price = to_decimal(price)
+        shipping = self.shipping if shipping is None else to_decimal(shipping)
+        key = (price, shipping,)
+
+        try:
+            return self.prices[key]
+        except KeyError:
+            pass
+
+        margin = self.get_margin(price)
+        # @TODO: make rounding configurable!
+        wo_tax = ((price*100)/(100-margin)+shipping).to_integral_exact(rounding=ROUND_CEILING)
+        with_tax = (wo_tax*(self.vat+100)/100).to_integral_exact(rounding=ROUND_CEILING)
+
+        # parts lists repeat the same few prices a lot
+        result = self.prices[key] = (margin, wo_tax, with_tax,)
+        return result
+
+    def set_stock_price(self, product, purchase_price, shipping=None):
+        margin, wo_tax, with_tax = self.get_price(purchase_price, shipping)
+        product.pct_margin_stock = margin
+        product.price_notax_stock = wo_tax
+        product.price_sales_stock = with_tax
+
+    def set_exchange_price(self, product, purchase_price, shipping=None):
+        margin, wo_tax, with_tax = self.get_price(purchase_price, shipping)
+        product.pct_margin_exchange = margin
+        product.price_notax_exchange = wo_tax
+        product.price_sales_exchange = with_tax
+
+    def price_products(self, products):
+        """
+        Sets the sales prices of products from their purchase prices
+        """
+        for p in products:
+            if p.fixed_price:
+                continue
+            if p.price_purchase_stock:
+                self.set_stock_price(p, p.price_purchase_stock, p.shipping)
+            if p.price_purchase_exchange:
+                self.set_exchange_price(p, p.price_purchase_exchange, p.shipping)
+
+        return products
 
-    try:
-        return Decimal(margin)
-    except Exception:
-        ranges = margin.split(';')
-        for r in ranges:
-            m = re.search(r'(\d+)\-(\d+)=(\d+)', r)
-            p_min, p_max, margin = m.groups()
-            if Decimal(p_min) <= price <= Decimal(p_max):
-                return Decimal(margin)
+    def price_parts(self, parts):
+        """
+        Returns the GSX partDetails parts as priced Products
+        """
+        return [Product.from_gsx(p, self) for p in parts]
 
-    return Decimal(margin)
+
+def get_margin(price=0.0):
+    """
+    Returns the proper margin % for this price
+    """
+    return PriceEngine.current().get_margin(to_decimal(price))
 
 
 def default_vat():
@@ -256,6 +370,22 @@ class Product(AbstractBaseProduct):
     )
 
     total_amount = models.IntegerField(editable=False, default=0)
+    price_updated_at = models.DateTimeField(null=True, editable=False)
+    search_vector = TSVectorField()
+
+    SEARCH_VECTOR = (('code', 'A'), ('title', 'A'),
+                     ('eee_code', 'B'), ('description', 'C'),)
+    SEARCH_TRIGRAMS = ('code', 'eee_code',)
+    SEARCH_HEADLINE = None
+
+    # the fields updated from GSX price info
+    PRICE_FIELDS = ('title', 'component_code',
+                    'price_purchase_stock', 'pct_margin_stock',
+                    'price_notax_stock', 'price_sales_stock',
+                    'price_purchase_exchange', 'pct_margin_exchange',
+                    'price_notax_exchange', 'price_sales_exchange',)
+    # max number of concurrent GSX lookups
+    PRICE_WORKERS = 4
 
     def get_pick_url(self, order, device=None):
         pk = self.pk or self.code
@@ -275,88 +405,152 @@ class Product(AbstractBaseProduct):
     def can_update_price(self):
         return self.can_order_from_gsx() and not self.fixed_price
 
-    def update_price(self, new_product=None):
+    def fetch_price(self, engine=None):
         """
-        Updates part's price info from GSX or to match new_product
+        Returns a Product with the current GSX details of this part.
+        Only talks to GSX so it's safe to call from worker threads.
         """
-        if new_product is None:
-            part = parts.Part(partNumber=self.code).lookup()
-            new_product = Product.from_gsx(part)
+        part = parts.Part(partNumber=self.code).lookup()
+        return Product.from_gsx(part, engine)
 
-        self.price_purchase_exchange = new_product.price_purchase_exchange
-        self.price_purchase_stock = new_product.price_purchase_stock
+    def get_price_changes(self, new_product):
+        """
+        Returns the {field: (old, new)} differences in price info
+        between this product and new_product
+        """
+        changes = {}
 
-        self.title = new_product.title
+        for k in self.PRICE_FIELDS:
+            old, new = getattr(self, k), getattr(new_product, k)
+            if old != new:
+                changes[k] = (old, new,)
 
-        self.component_code = new_product.component_code
+        return changes
 
-        self.price_notax_stock = new_product.price_notax_stock
-        self.price_notax_exchange = new_product.price_notax_exchange
+    def update_price(self, new_product=None):
+        """
+        Updates part's price info from GSX or to match new_product
+        """
+        if new_product is None:
+            new_product = self.fetch_price()
 
-        self.pct_margin_stock = new_product.pct_margin_stock
-        self.pct_margin_exchange = new_product.pct_margin_exchange
+        changes = self.get_price_changes(new_product)
 
-        self.price_sales_stock = new_product.price_sales_stock
-        self.price_sales_exchange = new_product.price_sales_exchange
+        for k, (old, new) in changes.items():
+            setattr(self, k, new)
 
+        self.price_updated_at = timezone.now()
         self.save()
 
-    def calculate_price(self, price, shipping=0.0):
+        if changes:
+            PriceChange.log(self, changes)
+
+    @classmethod
+    def refresh_prices(cls, products, workers=PRICE_WORKERS):
         """
-        Calculates price and returns it w/ and w/o tax
+        Updates the price info of products from GSX concurrently.
+        Only the products whose prices changed are written.
+        Returns the (changed, unchanged, failed) counts.
         """
-        conf = Configuration.conf()
-        shipping = shipping or 0.0
+        if not products:
+            return 0, 0, 0
 
-        if not isinstance(shipping, Decimal):
-            shipping = Decimal(shipping)
+        engine = PriceEngine.current()
 
-        margin = get_margin(price)
-        vat = Decimal(conf.get("pct_vat", 0.0))
+        def run(product):
+            try:
+                return (product, product.fetch_price(engine),)
+            except Exception as e:
+                return (product, e,)
 
-        # TWOPLACES = Decimal(10) ** -2  # same as Decimal('0.01')
-        # @TODO: make rounding configurable!
-        wo_tax = ((price*100)/(100-margin)+shipping).to_integral_exact(rounding=ROUND_CEILING)
-        with_tax = (wo_tax*(vat+100)/100).to_integral_exact(rounding=ROUND_CEILING)
+        pool = ThreadPool(min(workers, len(products)))
+
+        try:
+            results = pool.map(run, products)
+        finally:
+            pool.close()
+
+        changed, unchanged, failed = [], [], 0
+
+        for product, result in results:
+            if isinstance(result, Exception):
+                failed += 1
+                continue
+
+            changes = product.get_price_changes(result)
+
+            if changes:
+                changed.append((product, changes,))
+            else:
+                unchanged.append(product.pk)
+
+        now = timezone.now()
+
+        with transaction.atomic():
+            cls.objects.filter(pk__in=unchanged).update(price_updated_at=now)
+
+            if changed:
+                columns = ('id',) + cls.PRICE_FIELDS
+                rows, params = [], []
+
+                for product, changes in changed:
+                    rows.append('(%s)' % ', '.join(['%s'] * len(columns)))
+                    params.append(product.pk)
+                    for k in cls.PRICE_FIELDS:
+                        params.append(changes[k][1] if k in changes else getattr(product, k))
+
+                sql = """UPDATE servo_product p SET %s, price_updated_at = %%s
+                    FROM (VALUES %s) AS v (%s) WHERE p.id = v.id""" % (
+                    ', '.join(['%s = v.%s' % (k, k) for k in cls.PRICE_FIELDS]),
+                    ', '.join(rows), ', '.join(columns)
+                )
+
+                cursor = connection.cursor()
+                cursor.execute(sql, [now] + params)
+                # the title is in the search vector
+                update_vectors(cls, [p.pk for p, c in changed if 'title' in c])
+                PriceChange.objects.bulk_create([
+                    PriceChange.from_changes(p, c) for p, c in changed
+                ])
+
+        return len(changed), len(unchanged), failed
 
+    def calculate_price(self, price, shipping=0.0):
+        """
+        Calculates price and returns it w/ and w/o tax
+        """
+        margin, wo_tax, with_tax = PriceEngine.current().get_price(price, shipping)
         return wo_tax, with_tax
 
     def set_stock_sales_price(self):
         if not self.price_purchase_stock or self.fixed_price:
             return
 
-        purchase_sp = self.price_purchase_stock
-        sp, vat_sp  = self.calculate_price(purchase_sp, self.shipping)
-        self.price_notax_stock = sp
-        self.price_sales_stock = vat_sp
+        engine = PriceEngine.current()
+        engine.set_stock_price(self, self.price_purchase_stock, self.shipping)
 
     def set_exchange_sales_price(self):
         if not self.price_purchase_exchange or self.fixed_price:
             return
 
-        purchase_ep = self.price_purchase_exchange
-        ep, vat_ep  = self.calculate_price(purchase_ep, self.shipping)
-        self.price_notax_exhcange = ep
-        self.price_sales_exchange = vat_ep
+        engine = PriceEngine.current()
+        engine.set_exchange_price(self, self.price_purchase_exchange, self.shipping)
 
     @property
     def is_apple_part(self):
         return validate(self.code, 'partNumber')
 
     @classmethod
-    def from_gsx(cls, part):
+    def from_gsx(cls, part, engine=None):
         """
         Creates a Servo Product from GSX partDetail.
         We don't do GSX lookups here since we can't
         determine the correct GSX Account at this point.
         """
-        conf = Configuration.conf()
-
-        try:
-            shipping = Decimal(conf.get("shipping_cost"))
-        except TypeError:
-            shipping = Decimal(0.0)
+        if engine is None:
+            engine = PriceEngine.current()
 
+        shipping = engine.shipping
         part_number = part.originalPartNumber or part.partNumber
         product = Product(code=part_number)
         product.title = part.partDescription
@@ -366,33 +560,22 @@ class Product(AbstractBaseProduct):
 
         if part.stockPrice and not product.fixed_price:
             # calculate stock price
-            purchase_sp = part.stockPrice or 0.0
-            purchase_sp = Decimal(purchase_sp)
-            sp, vat_sp  = product.calculate_price(purchase_sp, shipping)
-            product.pct_margin_stock  = get_margin(purchase_sp)
-            product.price_notax_stock = sp
-            product.price_sales_stock = vat_sp
+            purchase_sp = to_decimal(part.stockPrice)
+            engine.set_stock_price(product, purchase_sp, shipping)
             # @TODO: make rounding configurable
             product.price_purchase_stock = purchase_sp.to_integral_exact(
                 rounding=ROUND_CEILING
             )
 
-        try:
-            # calculate exchange price
-            purchase_ep = part.exchangePrice or 0.0
-            purchase_ep = Decimal(purchase_ep)
-
-            if purchase_ep > 0 and not product.fixed_price:
-                ep, vat_ep = product.calculate_price(purchase_ep, shipping)
-                product.price_notax_exchange = ep
-                product.price_sales_exchange = vat_ep
-                product.pct_margin_exchange = Configuration.get_margin(purchase_ep)
-                # @TODO: make rounding configurable
-                product.price_purchase_exchange = purchase_ep.to_integral_exact(
-                    rounding=ROUND_CEILING
-                )
-        except AttributeError:
-            pass  # Not all parts have exchange prices
+        # Not all parts have exchange prices
+        purchase_ep = to_decimal(getattr(part, 'exchangePrice', None))
+
+        if purchase_ep > 0 and not product.fixed_price:
+            engine.set_exchange_price(product, purchase_ep, shipping)
+            # @TODO: make rounding configurable
+            product.price_purchase_exchange = purchase_ep.to_integral_exact(
+                rounding=ROUND_CEILING
+            )
 
         product.brand = "Apple"
         product.shipping = shipping
@@ -450,20 +633,11 @@ class Product(AbstractBaseProduct):
         if not self.track_inventory():
             return
 
-        try:
-            inventory = Inventory.objects.get(product=self, location=location)
-            
-            try:
-                inventory.amount_stocked  = inventory.amount_stocked - amount
-                inventory.amount_reserved = inventory.amount_reserved - amount
-            except Exception as e:
-                # @TODO: Would be nice to trigger a warning
-                pass
-
-            inventory.save()
-        except Inventory.DoesNotExist:
+        if not Inventory.objects.filter(product=self, location=location).exists():
             raise ValueError(_(u"Product %s not found in inventory.") % self.code)
 
+        Inventory.record(self, location, 'sell', stocked=-amount, reserved=-amount)
+
     def get_relative_url(self):
         if self.pk is None:
             return "code/%s/" % self.code
@@ -546,6 +720,32 @@ class Product(AbstractBaseProduct):
         )
 
 
+class PriceChange(models.Model):
+    """
+    A change in the price info of a product
+    found when updating prices from GSX
+    """
+    product = models.ForeignKey(Product)
+    changed_at = models.DateTimeField(default=timezone.now, editable=False)
+    changes = JSONField(default=dict)
+
+    @classmethod
+    def from_changes(cls, product, changes):
+        # Decimals don't serialize to JSON
+        changes = dict([(k, [unicode(o), unicode(n)]) for k, (o, n) in changes.items()])
+        return cls(product=product, changes=changes)
+
+    @classmethod
+    def log(cls, product, changes):
+        change = cls.from_changes(product, changes)
+        change.save()
+        return change
+
+    class Meta:
+        app_label = "servo"
+        get_latest_by = "changed_at"
+
+
 class ProductCategory(MPTTModel):
     site = models.ForeignKey(
         Site,
@@ -623,6 +823,122 @@ class Inventory(models.Model):
         verbose_name=_("Ordered amount")
     )
 
+    AMOUNTS = ('amount_stocked', 'amount_ordered', 'amount_reserved',)
+
+    @classmethod
+    def record(cls, product, location, kind, stocked=0, ordered=0,
+               reserved=0, user=None, item=None):
+        """
+        Applies these changes to the inventory of product at location
+        and records them as an InventoryMovement.
+        Ordered and reserved amounts never go below zero.
+        """
+        if not (stocked or ordered or reserved):
+            return
+
+        with transaction.atomic():
+            lookup = {'product': product, 'location': location}
+            inventory = cls.objects.select_for_update().filter(**lookup).first()
+
+            if inventory is None:
+                try:
+                    with transaction.atomic():
+                        inventory = cls.objects.create(**lookup)
+                except IntegrityError:
+                    # created by a concurrent request
+                    inventory = cls.objects.select_for_update().get(**lookup)
+
+            ordered = max(ordered, -inventory.amount_ordered)
+            reserved = max(reserved, -inventory.amount_reserved)
+
+            cls.objects.filter(pk=inventory.pk).update(
+                amount_stocked=F('amount_stocked') + stocked,
+                amount_ordered=F('amount_ordered') + ordered,
+                amount_reserved=F('amount_reserved') + reserved
+            )
+
+            movement = InventoryMovement.objects.create(
+                product=product,
+                location=location,
+                kind=kind,
+                stocked=stocked,
+                ordered=ordered,
+                reserved=reserved,
+                created_by=user,
+                purchase_order_item=item
+            )
+
+            if stocked:
+                Product.objects.filter(pk=product.pk).update(
+                    total_amount=F('total_amount') + stocked
+                )
+
+        cache.delete("product_%d_amount_stocked" % product.pk)
+        return movement
+
+    @classmethod
+    def record_many(cls, location, kind, changes, user=None):
+        """
+        Applies these {product: (stocked, ordered, reserved)} changes
+        to the inventory at location like record() does, with one
+        query per step instead of a round of queries per product.
+        Raises ValueError if a product isn't in the inventory.
+        """
+        changes = dict((p, c) for p, c in changes.items() if any(c))
+
+        if not changes:
+            return []
+
+        with transaction.atomic():
+            ids = [p.pk for p in changes]
+            inventory = cls.objects.select_for_update()
+            inventory = inventory.filter(location=location, product_id__in=ids)
+            inventory = dict((i.product_id, i) for i in inventory)
+
+            rows, params, movements = [], [], []
+
+            for product, (stocked, ordered, reserved) in changes.items():
+                if product.pk not in inventory:
+                    raise ValueError(_(u"Product %s not found in inventory.") % product.code)
+
+                i = inventory[product.pk]
+                ordered = max(ordered, -i.amount_ordered)
+                reserved = max(reserved, -i.amount_reserved)
+
+                rows.append('(%s, %s, %s, %s)')
+                params += [i.pk, stocked, ordered, reserved]
+                movements.append(InventoryMovement(
+                    product=product,
+                    location=location,
+                    kind=kind,
+                    stocked=stocked,
+                    ordered=ordered,
+                    reserved=reserved,
+                    created_by=user
+                ))
+
+            cursor = connection.cursor()
+            cursor.execute("""UPDATE servo_inventory i SET
+                amount_stocked = i.amount_stocked + v.stocked,
+                amount_ordered = i.amount_ordered + v.ordered,
+                amount_reserved = i.amount_reserved + v.reserved
+                FROM (VALUES %s) AS v (id, stocked, ordered, reserved)
+                WHERE i.id = v.id""" % ', '.join(rows), params)
+
+            InventoryMovement.objects.bulk_create(movements)
+
+            stocked = [(m.product.pk, m.stocked) for m in movements if m.stocked]
+
+            if stocked:
+                cursor.execute("""UPDATE servo_product p
+                    SET total_amount = p.total_amount + v.stocked
+                    FROM (VALUES %s) AS v (id, stocked) WHERE p.id = v.id""" % (
+                    ', '.join(['(%s, %s)'] * len(stocked))),
+                    [x for row in stocked for x in row])
+
+        cache.delete_many(["product_%d_amount_stocked" % pk for pk in ids])
+        return movements
+
     def move(self, new_location, amount=1):
         """
         Move this inventory to a new_location
@@ -630,28 +946,90 @@ class Inventory(models.Model):
         if new_location == self.location:
             raise ValueError(_('Cannot move products to the same location'))
 
-        target, created = Inventory.objects.get_or_create(location=new_location,
-                                                          product=self.product)
-        self.amount_stocked = self.amount_stocked - amount
-        self.save()
-        target.amount_stocked = target.amount_stocked + amount
-        target.save()
+        with transaction.atomic():
+            Inventory.record(self.product, self.location, 'move', stocked=-amount)
+            Inventory.record(self.product, new_location, 'move', stocked=amount)
 
     def save(self, *args, **kwargs):
-        super(Inventory, self).save(*args, **kwargs)
-        total_amount = 0
+        """
+        Amounts that are set directly (ie from a form)
+        are recorded as an adjustment
+        """
+        with transaction.atomic():
+            old = dict.fromkeys(self.AMOUNTS, 0)
+
+            if self.pk:
+                saved = Inventory.objects.select_for_update().filter(pk=self.pk)
+                old = saved.values(*self.AMOUNTS).first() or old
+
+            super(Inventory, self).save(*args, **kwargs)
+            delta = dict((k, getattr(self, k) - old[k]) for k in self.AMOUNTS)
+
+            if not any(delta.values()):
+                return
+
+            InventoryMovement.objects.create(
+                product_id=self.product_id,
+                location_id=self.location_id,
+                kind='adjust',
+                stocked=delta['amount_stocked'],
+                ordered=delta['amount_ordered'],
+                reserved=delta['amount_reserved']
+            )
 
-        for i in self.product.inventory_set.all():
-            total_amount += i.amount_stocked
+            if delta['amount_stocked']:
+                Product.objects.filter(pk=self.product_id).update(
+                    total_amount=F('total_amount') + delta['amount_stocked']
+                )
 
-        self.product.total_amount = total_amount
-        self.product.save()
+        cache.delete("product_%d_amount_stocked" % self.product_id)
 
     class Meta:
         app_label = "servo"
         unique_together = ('product', 'location',)
 
 
+class InventoryMovement(models.Model):
+    """
+    A change in the inventory of a product at a location.
+    The amounts are deltas.
+    """
+    KINDS = (
+        ('opening', _('Opening balance')),
+        ('adjust', _('Adjusted')),
+        ('order', _('Ordered')),
+        ('cancel', _('Order cancelled')),
+        ('receive', _('Received')),
+        ('reserve', _('Reserved')),
+        ('sell', _('Sold')),
+        ('move', _('Moved')),
+    )
+
+    product = models.ForeignKey(Product)
+    location = models.ForeignKey(Location)
+    kind = models.CharField(max_length=16, choices=KINDS)
+
+    stocked = models.IntegerField(default=0)
+    ordered = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        on_delete=models.SET_NULL
+    )
+    purchase_order_item = models.ForeignKey(
+        'PurchaseOrderItem',
+        null=True,
+        on_delete=models.SET_NULL
+    )
+
+    class Meta:
+        app_label = "servo"
+        ordering = ('-id',)
+
+
 class ShippingMethod(models.Model):
     """
     How the contents of an order should be shipped
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -130,10 +130,8 @@ class PurchaseOrder(models.Model):
         location = user.get_location()
 
         for i in self.purchaseorderitem_set.all():
-            inventory = Inventory.objects.get_or_create(location=location,
-                                                        product=i.product)[0]
-            inventory.amount_ordered += i.amount
-            inventory.save()
+            Inventory.record(i.product, location, 'order',
+                             ordered=i.amount, user=user, item=i)
             i.ordered_at = timezone.now()
             i.save()
 
@@ -148,9 +146,8 @@ class PurchaseOrder(models.Model):
         location = self.created_by.get_location()
 
         for i in self.purchaseorderitem_set.all():
-            inventory = Inventory.objects.get(location=location, product=i.product)
-            inventory.amount_ordered -= i.amount
-            inventory.save()
+            Inventory.record(i.product, location, 'cancel',
+                             ordered=-i.amount, item=i)
             i.expected_ship_date = None
             i.save()
 
@@ -282,6 +279,55 @@ class PurchaseOrderItem(AbstractOrderItem):
         self.received_by = user
         self.save()
 
+    def stock(self, user=None):
+        """
+        Moves this received item from ordered to stocked.
+        Does nothing if that has already been done.
+        """
+        if not Configuration.track_inventory():
+            return
+
+        if self.inventorymovement_set.filter(kind='receive').exists():
+            return
+
+        location = self.purchase_order.created_by.get_location()
+
+        try:
+            Inventory.record(self.product, location, 'receive',
+                             stocked=self.amount, ordered=-self.amount,
+                             user=user, item=self)
+        except Exception:
+            ref = self.purchase_order.reference or self.purchase_order.confirmation
+            ed = {'prod': self.product.code, 'ref': ref}
+            raise ValueError(_('Cannot receive item %(prod)s (%(ref)s)') % ed)
+
+    @classmethod
+    def receive_items(cls, items, user):
+        """
+        Receives many items at once.
+        Returns the number of items received.
+        """
+        items = cls.objects.filter(pk__in=[i.pk for i in items], received_at=None)
+        items = list(items.select_related('product', 'purchase_order__created_by',
+                                          'sales_order__queue'))
+
+        with transaction.atomic():
+            now = timezone.now()
+            received = cls.objects.filter(pk__in=[i.pk for i in items], received_at=None)
+            received.update(received_at=now, received_by=user)
+
+            for i in items:
+                i.received_at, i.received_by = now, user
+                i.stock(user)
+
+        # Trigger status change for parts receive, once per order
+        orders = dict((i.sales_order_id, i.sales_order) for i in items if i.sales_order)
+
+        for order in orders.values():
+            order.products_received(user)
+
+        return len(items)
+
     def save(self, *args, **kwargs):
         # The following four fields are used so much
         # that we store them for fast access
@@ -324,22 +370,8 @@ def trigger_product_received(sender, instance, created, **kwargs):
     if instance.received_at is None:
         return
 
-    product = instance.product
-    po = instance.purchase_order
-    location = po.created_by.get_location()
-
-    inventory = Inventory.objects.get_or_create(location=location, product=product)[0]
-
     # Receiving an incoming item
-    if Configuration.track_inventory():
-        try:
-            inventory.amount_ordered -= instance.amount
-            inventory.amount_stocked += instance.amount
-            inventory.save()
-        except Exception:
-            ref = po.reference or po.confirmation
-            ed = {'prod': product.code, 'ref': ref}
-            raise ValueError(_('Cannot receive item %(prod)s (%(ref)s)') % ed)
+    instance.stock(instance.received_by or instance.created_by)
 
     sales_order = instance.purchase_order.sales_order
 
@@ -347,11 +379,7 @@ def trigger_product_received(sender, instance, created, **kwargs):
         return
 
     # Trigger status change for parts receive
-    if sales_order.queue:
-        new_status = sales_order.queue.status_products_received
-        if new_status and sales_order.is_editable:
-            user = instance.received_by or instance.created_by
-            sales_order.set_status(new_status, user)
+    sales_order.products_received(instance.received_by or instance.created_by)
 
 
 @receiver(post_save, sender=PurchaseOrder)
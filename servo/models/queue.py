@@ -163,7 +163,8 @@ class Queue(models.Model):
         return reverse('orders-list_queue', args=[self.pk])
 
     def get_order_count(self, max_state=2):
-        count = self.order_set.filter(state__lt=max_state).count()
+        from servo.models.order import OrderCounter
+        count = OrderCounter.get_count('queue', self.pk, max_state)
         return count if count > 0 else ''
 
     def __unicode__(self):
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
+import logging
 import gsxws
 import os.path
+import threading
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 from gsxws.repairs import SymptomIssue
 
-from django.db import models
+from django.db import models, connection
+from django.db.models import Q
 from django.conf import settings
 from django.utils import timezone
+from django.dispatch import receiver
 from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import MaxLengthValidator
 
@@ -17,7 +25,7 @@ from servo import defaults
 from servo.lib.utils import cache_getset
 from servo.models.common import GsxAccount
 from servo.models import Queue, Order, Device, Product
-from servo.models.order import ServiceOrderItem
+from servo.models.order import ServiceOrderItem, OrderSearchIndex
 from servo.models.parts import ServicePart
 from servo.models.purchases import PurchaseOrder, PurchaseOrderItem
 
@@ -198,8 +206,22 @@ class Repair(models.Model):
 
     symptom_code = models.CharField(max_length=7, default='')
     issue_code = models.CharField(max_length=7, default='')
+
+    status_changed_at = models.DateTimeField(null=True, editable=False)
+    # when the status poller should next ask GSX about this repair
+    next_check_at = models.DateTimeField(null=True, editable=False)
+
     objects = ActiveManager()
 
+    # repairs are polled at a tenth of the time since their
+    # status last changed, within these limits
+    POLL_MIN = timedelta(minutes=5)
+    POLL_MAX = timedelta(hours=6)
+    # max number of concurrent GSX lookups per account
+    POLL_WORKERS = 4
+    # max number of GSX lookups per second per account
+    POLL_RATE = 5
+
     def is_submitted(self):
         return self.submitted_at is not None
 
@@ -528,6 +550,7 @@ class Repair(models.Model):
         """
         if not new_status == self.status:
             self.status = new_status
+            self.status_changed_at = timezone.now()
             self.save()
             self.order.notify("repair_status_changed", self.status, user)
 
@@ -541,16 +564,139 @@ class Repair(models.Model):
 
         return self.status
 
-    def get_details(self):
-        repair = self.get_gsx_repair()
-        details = repair.details()
+    def fetch_details(self):
+        """
+        Returns the GSX details of this repair.
+        Only talks to GSX so it's safe to call from worker threads.
+        """
+        details = self.get_gsx_repair().details()
 
         if isinstance(details.partsInfo, dict):
             details.partsInfo = [details.partsInfo]
 
+        return details
+
+    def get_details(self):
+        details = self.fetch_details()
         self.update_details(details)
         return details
 
+    def apply_details(self, details):
+        """
+        Saves the status and parts of this repair from GSX
+        if they have changed. Returns True if anything changed.
+        """
+        changed = self.update_details(details) > 0
+        status = details.repairStatus
+
+        if status and status != self.status:
+            self.set_status(status, self.created_by)
+            changed = True
+
+        return changed
+
+    def get_next_check(self, now=None):
+        """
+        Returns when GSX should next be asked about this repair.
+        Repairs that have changed recently are checked more often.
+        """
+        now = now or timezone.now()
+        since = self.status_changed_at or self.submitted_at or now
+        interval = min(max((now - since) / 10, self.POLL_MIN), self.POLL_MAX)
+        return now + interval
+
+    @classmethod
+    def poll(cls, workers=POLL_WORKERS, rate=POLL_RATE):
+        """
+        Updates the open GSX repairs that are due for a check.
+        Returns the (checked, changed, failed) counts.
+        """
+        now = timezone.now()
+        repairs = cls.objects.filter(completed_at=None).exclude(confirmation='')
+        repairs = repairs.filter(Q(next_check_at=None) | Q(next_check_at__lte=now))
+        repairs = repairs.select_related('gsx_account', 'created_by__location', 'order')
+
+        sessions = {}
+
+        # each repair is checked as the technician who created it,
+        # like it always was, so the repairs of an account are grouped
+        # by the GSX user ID and timezone that connect_gsx() would use
+        for r in repairs:
+            user = r.created_by
+            key = (r.gsx_account_id, user.gsx_userid or r.gsx_account.user_id,
+                   user.location.gsx_tz,)
+            sessions.setdefault(key, []).append(r)
+
+        counts = [0, 0, 0]
+
+        # gsxws has one session per process, so one session at a time
+        for session_repairs in sessions.values():
+            result = cls.poll_account(session_repairs, workers, rate)
+            counts = [a + b for a, b in zip(counts, result)]
+
+        return tuple(counts)
+
+    @classmethod
+    def poll_account(cls, repairs, workers, rate):
+        """
+        Fetches the details of repairs that share a GSX session
+        (account, user ID and timezone) concurrently and saves the changes
+        """
+        try:
+            repairs[0].connect_gsx()
+        except Exception as e:
+            logging.error('Failed to connect to GSX (%s)', e)
+            return len(repairs), 0, len(repairs)
+
+        lock = threading.Lock()
+        next_at = [0]
+
+        def run(repair):
+            with lock: # space the requests 1/rate seconds apart
+                now = time.time()
+                wait = next_at[0] - now
+                next_at[0] = max(now, next_at[0]) + 1.0 / rate
+
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                return (repair, repair.fetch_details(),)
+            except Exception as e:
+                return (repair, e,)
+
+        pool = ThreadPool(min(workers, len(repairs)))
+
+        try:
+            results = pool.map(run, repairs)
+        finally:
+            pool.close()
+
+        changed, failed = 0, 0
+
+        for repair, details in results:
+            if isinstance(details, Exception):
+                failed += 1
+                continue
+
+            try:
+                if repair.apply_details(details):
+                    changed += 1
+            except Exception as e:
+                logging.error('Failed to update repair %s (%s)', repair.confirmation, e)
+                failed += 1
+
+        now = timezone.now()
+        values = [(r.pk, r.get_next_check(now),) for r in repairs]
+
+        cursor = connection.cursor()
+        cursor.execute("""UPDATE servo_repair r SET next_check_at = v.next_check_at
+            FROM (VALUES %s) AS v (id, next_check_at) WHERE r.id = v.id""" %
+            ', '.join(['(%s, %s::timestamptz)'] * len(values)),
+            [v for row in values for v in row])
+
+        return len(repairs), changed, failed
+
     def get_return_label(self, part):
         self.get_details()
         part = self.servicepart_set.get(pk=part)
@@ -558,20 +704,28 @@ class Repair(models.Model):
 
     def update_details(self, details):
         """
-        Updates what local info we have about this particular GSX repair
+        Updates what local info we have about this particular GSX repair.
+        Returns the number of parts that changed.
         """
+        changed = 0
         part_list = list(self.servicepart_set.all().order_by('id'))
 
         for i, p in enumerate(details.partsInfo):
             try:
                 part = part_list[i]
+                old = part.get_gsx_details()
                 part.set_part_details(p)
-                part.save()
+                if part.get_gsx_details() != old:
+                    part.save()
+                    changed += 1
             except IndexError: # part added in GSX web ui...
                 self.add_gsx_part(p)
+                changed += 1
             except AttributeError: # some missing attribute in set_part_details()
                 pass
 
+        return changed
+
     def get_replacement_sn(self):
         """
         Try to guess replacement part's SN
@@ -689,3 +843,8 @@ class Repair(models.Model):
     class Meta:
         app_label = "servo"
         get_latest_by = "created_at"
+
+
+@receiver(post_save, sender=Repair)
+def trigger_repair_saved(sender, instance, **kwargs):
+    OrderSearchIndex.update_related([instance.order_id])
@@ -1,23 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import re
 import json
+import logging
+from django import template
 from django.db import models
-from django.core.cache import cache
 
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 
-from servo.models import Event, Queue
-
-
-class RuleManager:
-
-    def all(self):
-        f = open('local_rules.json', 'r')
-        return json.loads(f.read())
+from servo.models import Queue, Status, Note, Snapshot
 
 
 class ServoModel(models.Model):
@@ -27,9 +22,6 @@ class ServoModel(models.Model):
 
 
 class Rule(ServoModel):
-
-    objects = RuleManager()
-
     description = models.CharField(max_length=128, default=_('New Rule'))
     MATCH_CHOICES = (
         ('ANY', _('Any')),
@@ -70,10 +62,24 @@ class Rule(ServoModel):
     def get_admin_url(self):
         return reverse('rules-edit_rule', args=[self.pk])
 
+    def matches(self, order):
+        """
+        Checks the conditions of this compiled rule against order
+        """
+        results = [c.test(order) for c in self.conditions]
+
+        if self.match == 'ALL':
+            return all(results)
+
+        return any(results)
+
     def apply(self, event):
+        """
+        Performs the actions of this compiled rule.
+        Returns the number of messages queued.
+        """
         order = event.content_object
-        for a in self.action_set.all():
-            a.apply(order, event)
+        return sum([a.apply(order, event) or 0 for a in self.actions])
 
     def __unicode__(self):
         return self.description
@@ -82,8 +88,11 @@ class Rule(ServoModel):
 class Condition(ServoModel):
     rule = models.ForeignKey(Rule)
 
-    EVENT_MAP = {
-        'device_added': 'DEVICE',
+    # the event that can make a condition true
+    TRIGGERS = {
+        'QUEUE': 'set_queue',
+        'STATUS': 'set_status',
+        'DEVICE': 'device_added',
     }
 
     KEY_CHOICES = (
@@ -113,6 +122,52 @@ class Condition(ServoModel):
         d['value'] = self.value
         return d
 
+    def compile(self, titles):
+        """
+        Prepares this condition for matching events.
+        titles maps queue and status IDs to the event descriptions
+        """
+        self.action = self.TRIGGERS.get(self.key)
+        self.description = None
+
+        if self.key in ('QUEUE', 'STATUS',):
+            self.description = titles.get((self.key, self.value))
+        else:
+            value = re.escape(self.value)
+            if self.operator == '^%s$':
+                value = '^%s$' % value
+            self.pattern = re.compile(value, re.IGNORECASE | re.UNICODE)
+
+    def compare(self, value):
+        if self.operator in ('^%s$', '%s',):
+            return bool(self.pattern.search(value or ''))
+
+        try:
+            value, limit = float(value), float(self.value)
+        except (TypeError, ValueError):
+            return False
+
+        if self.operator == '%d < %d':
+            return value < limit
+
+        return value > limit
+
+    def test(self, order):
+        """
+        Checks this compiled condition against the current state of order
+        """
+        if self.key == 'QUEUE':
+            return str(order.queue_id) == self.value
+        if self.key == 'STATUS':
+            return order.status is not None and str(order.status.status_id) == self.value
+        if self.key == 'DEVICE':
+            devices = order.devices.values_list('description', flat=True)
+            return any([self.compare(d) for d in devices])
+        if self.key == 'CUSTOMER_NAME':
+            return self.compare(order.customer_name)
+
+        return False
+
     def __unicode__(self):
         return '%s %s %s' % (self.key, self.operator, self.value)
 
@@ -141,24 +196,139 @@ class Action(ServoModel):
         d['value'] = self.value
         return d
 
+    def compile(self):
+        if self.key in ('SEND_SMS', 'SEND_EMAIL',):
+            self.template = template.Template(self.value)
+
+    def render(self, order):
+        return self.template.render(template.Context({'order': order}))
+
     def apply(self, order, event):
+        """
+        Performs this compiled action on order.
+        Messages are only queued, the caller sends them.
+        Returns the number of messages queued.
+        """
+        user = event.triggered_by
+
+        if self.key == 'SEND_SMS':
+            try:
+                number = order.customer.get_standard_phone()
+            except Exception:
+                return # skip customers w/o valid phone numbers
+
+            note = Note(order=order, created_by=user, body=self.render(order))
+            note.save()
+
+            try:
+                note.send_sms(number, user, send=False)
+            except ValueError as e:
+                logging.error('Sending SMS to %s failed (%s)' % (number, e))
+                return
+
+            return 1
+
+        if self.key == 'SEND_EMAIL':
+            email = order.customer and order.customer.valid_email()
+
+            if not email:
+                return # skip customers w/o valid emails
+
+            note = Note(order=order, created_by=user, body=self.render(order))
+            note.recipient = email
+            note.render_subject({'note': note})
+            note.save()
+
+            try:
+                note.send_mail(user, send=False)
+            except ValueError as e:
+                logging.error('Sending email failed (%s)' % e)
+                return
+
+            return 1
+
+        if self.key == 'ADD_TAG':
+            order.add_tag(self.value, user)
+
+        if self.key == 'SET_PRIO':
+            order.priority = int(self.value)
+            order.save()
+
         if self.key == 'SET_QUEUE':
-            order.set_queue(self.value, event.triggered_by)
+            order.set_queue(self.value, user)
 
         if self.key == 'SET_USER':
-            order.set_user(self.value, event.triggered_by)
+            from servo.models import User
+            order.set_user(User.objects.get(pk=self.value), user)
 
     def __unicode__(self):
         return '%s %s' % (self.key, self.value)
 
 
-@receiver(post_save, sender=Event)
-def process_event(sender, instance, created, **kwargs):
-    try:
-        condition = Condition.EVENT_MAP[instance.action]
-        print condition
-        for r in Rule.objects.filter(condition__key=condition):
-            print 'APPLYING %s' % condition
-            r.apply(instance)
-    except KeyError:
-        return # no mapping for this event
+class RuleIndex(Snapshot):
+    """
+    The rules compiled into a dispatch table keyed by
+    (event action, event description). Rules whose conditions can't
+    be matched by the description alone are under (event action, None).
+    """
+    VERSION_KEY = 'rules-version'
+
+    def load(self):
+        titles = {}
+
+        for pk, title in Queue.objects.values_list('pk', 'title'):
+            titles[('QUEUE', str(pk))] = title
+        for pk, title in Status.objects.values_list('pk', 'title'):
+            titles[('STATUS', str(pk))] = title
+
+        index = {}
+        rules = Rule.objects.prefetch_related('condition_set', 'action_set')
+
+        for rule in rules:
+            rule.conditions = list(rule.condition_set.all())
+            rule.actions = list(rule.action_set.all())
+            keys = set()
+
+            for c in rule.conditions:
+                c.compile(titles)
+                if c.action:
+                    keys.add((c.action, c.description))
+
+            for a in rule.actions:
+                a.compile()
+
+            for k in keys:
+                index.setdefault(k, []).append(rule)
+
+        return index
+
+    def lookup(self, action, description):
+        """
+        Returns the rules that may apply to this event
+        """
+        index = self.get()
+        rules = index.get((action, description), []) + index.get((action, None), [])
+        # a rule may be under both keys
+        return list(dict([(r.pk, r) for r in rules]).values())
+
+
+rule_index = RuleIndex()
+
+
+@receiver(post_save, sender=Rule)
+@receiver(post_save, sender=Condition)
+@receiver(post_save, sender=Action)
+@receiver(post_delete, sender=Rule)
+@receiver(post_delete, sender=Condition)
+@receiver(post_delete, sender=Action)
+def trigger_rules_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        rule_index.invalidate()
+
+
+@receiver(post_save, sender=Queue)
+@receiver(post_save, sender=Status)
+def trigger_titles_changed(sender, instance, created, raw=False, **kwargs):
+    # the index is keyed by the titles
+    if not raw and not created:
+        rule_index.invalidate()
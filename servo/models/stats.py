@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from django.dispatch import receiver
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from servo.models import Event, Order, Invoice, PurchaseOrder
+
+
+class StatsRollup(models.Model):
+    """
+    Daily order activity totals per location, queue and user.
+    Kept up to date as orders change so that the stats
+    don't have to scan the order and event tables.
+    """
+    ORDERS_CREATED = 'created'
+    ORDERS_STARTED = 'started'
+    ORDERS_CLOSED = 'closed'      # total is the sum of turnaround seconds
+    STATUS_SET = 'status'         # key is the status title
+    INVOICED = 'invoiced'         # total is the sum of gross totals
+    PURCHASED = 'purchased'       # total is the sum of submitted POs
+
+    DIMENSIONS = ('location_id', 'queue_id', 'user_id', 'created_by_id',)
+
+    day = models.DateField()
+    metric = models.CharField(max_length=16)
+    key = models.CharField(max_length=255, default='')
+    # 0 means none, so that the rows stay unique
+    location_id = models.IntegerField(default=0)
+    queue_id = models.IntegerField(default=0)
+    user_id = models.IntegerField(default=0)
+    created_by_id = models.IntegerField(default=0)
+
+    count = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+
+    @classmethod
+    def get_day(cls, when):
+        return timezone.localtime(when, timezone.get_default_timezone()).date()
+
+    @classmethod
+    def add(cls, metric, when, total=0, key='', count=1, **dims):
+        """
+        Adds count and total to the rollup of this metric, day and dimensions
+        """
+        values = {'day': cls.get_day(when), 'metric': metric, 'key': key}
+
+        for k in cls.DIMENSIONS:
+            values[k] = dims.get(k) or 0
+
+        delta = {'count': F('count') + count, 'total': F('total') + total}
+
+        if cls.objects.filter(**values).update(**delta) > 0:
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(count=count, total=total, **values)
+        except IntegrityError:
+            # created by a concurrent request
+            cls.objects.filter(**values).update(**delta)
+
+    @classmethod
+    def apply(cls, old, new):
+        """
+        Moves the counts of an object from the old rollups to the new ones
+        """
+        for r in old:
+            if r not in new:
+                cls.add(r[0], r[1], -r[2], r[3], -1, **dict(r[4]))
+
+        for r in new:
+            if r not in old:
+                cls.add(r[0], r[1], r[2], r[3], 1, **dict(r[4]))
+
+    class Meta:
+        app_label = "servo"
+        unique_together = ('day', 'metric', 'key', 'location_id',
+                           'queue_id', 'user_id', 'created_by_id',)
+        index_together = ('metric', 'day',)
+
+
+def get_order_rollups(order):
+    """
+    Returns the (metric, when, total, key, dimensions) rows
+    that this order counts towards
+    """
+    if order.created_at is None:
+        return []
+
+    dims = (('location_id', order.location_id),
+            ('queue_id', order.queue_id),
+            ('user_id', order.user_id),
+            ('created_by_id', order.created_by_id),)
+
+    result = [(StatsRollup.ORDERS_CREATED, order.created_at, 0, '', dims,)]
+
+    if order.started_at:
+        result.append((StatsRollup.ORDERS_STARTED, order.started_at, 0, '', dims,))
+
+    if order.closed_at:
+        turnaround = (order.closed_at - order.created_at).total_seconds()
+        result.append((StatsRollup.ORDERS_CLOSED, order.closed_at, turnaround, '', dims,))
+
+    return result
+
+
+def get_invoice_rollups(invoice):
+    order = invoice.order
+    dims = (('location_id', invoice.location_id),
+            ('queue_id', order.queue_id),
+            ('user_id', order.user_id),
+            ('created_by_id', invoice.created_by_id),)
+
+    return [(StatsRollup.INVOICED, invoice.created_at, float(invoice.total_gross), '', dims,)]
+
+
+def get_purchase_order_rollups(po):
+    if po.submitted_at is None:
+        return []
+
+    order = po.sales_order
+    dims = (('location_id', po.location_id),
+            ('queue_id', order and order.queue_id),
+            ('user_id', order and order.user_id),
+            ('created_by_id', po.created_by_id),)
+
+    return [(StatsRollup.PURCHASED, po.submitted_at, po.sum(), '', dims,)]
+
+
+ROLLUPS = {
+    Order: get_order_rollups,
+    Invoice: get_invoice_rollups,
+    PurchaseOrder: get_purchase_order_rollups,
+}
+
+
+@receiver(pre_save, sender=Order)
+@receiver(pre_save, sender=Invoice)
+@receiver(pre_save, sender=PurchaseOrder)
+def trigger_rollup_snapshot(sender, instance, raw=False, **kwargs):
+    """
+    Remembers what the saved version of this object counted towards
+    """
+    if raw or instance.pk is None:
+        return
+
+    try:
+        old = sender.objects.get(pk=instance.pk)
+    except sender.DoesNotExist:
+        return
+
+    instance._stats_rollups = ROLLUPS[sender](old)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=Invoice)
+@receiver(post_save, sender=PurchaseOrder)
+def trigger_rollup_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    old = instance.__dict__.pop('_stats_rollups', [])
+    StatsRollup.apply(old, ROLLUPS[sender](instance))
+
+
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=Invoice)
+@receiver(post_delete, sender=PurchaseOrder)
+def trigger_rollup_deleted(sender, instance, **kwargs):
+    try:
+        StatsRollup.apply(ROLLUPS[sender](instance), [])
+    except Order.DoesNotExist:
+        pass # deleted along with its order
+
+
+@receiver(post_save, sender=Event)
+def trigger_status_event(sender, instance, created, raw=False, **kwargs):
+    if raw or not created or instance.action != 'set_status':
+        return
+
+    order = instance.content_object
+
+    if not isinstance(order, Order):
+        return
+
+    StatsRollup.add(StatsRollup.STATUS_SET,
+                    instance.triggered_at,
+                    key=instance.description,
+                    location_id=order.location_id,
+                    user_id=order.user_id,
+                    queue_id=order.queue_id,
+                    created_by_id=instance.triggered_by_id)
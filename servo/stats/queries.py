@@ -3,6 +3,14 @@
 import decimal
 from django.db import connection
 
+from servo.models import StatsRollup
+
+# what to aggregate from the daily rollups
+COUNT = 'SUM(count)'
+TOTAL = 'SUM(total)'
+# average hours from the sum of turnaround seconds
+TURNAROUND = 'SUM(total)/NULLIF(SUM(count), 0)/3600'
+
 
 class StatsManager:
     def __init__(self):
@@ -23,57 +31,41 @@ class StatsManager:
         users = User.object.filter(location=location)
 
 
-    def statuses_per_location(self, timescale, location, status, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, se.triggered_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order so, servo_event se
-            WHERE (se.triggered_at, se.triggered_at) OVERLAPS (%s, %s)
-            AND se.action = 'set_status'
-            AND se.object_id = so.id
-            AND so.location_id = %s
-            AND se.description = %s
-        GROUP BY p
-        ORDER BY p ASC"""
+    def _rollup(self, value, timescale, metric, start, end, where=(), **dims):
+        """
+        Sums the daily rollups of metric into timescale periods
+        """
+        where = ['metric = %s', 'day BETWEEN %s::date AND %s::date'] + list(where)
+        args = [timescale, metric, start, end]
 
-        return self._result([timescale, start, end, location, status])
+        for k, v in sorted(dims.items()):
+            where.append('%s = %%s' % k)
+            args.append(v)
 
-    def statuses_per_user(self, timescale, user, status, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, se.triggered_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order so, servo_event se
-            WHERE (se.triggered_at, se.triggered_at) OVERLAPS (%s, %s)
-            AND se.action = 'set_status'
-            AND se.object_id = so.id
-            AND so.user_id = %s
-            AND se.description = %s
+        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%%s, day::timestamp))*1000 as p,
+        %s AS v
+        FROM servo_statsrollup
+        WHERE %s
         GROUP BY p
-        ORDER BY p ASC"""
+        ORDER BY p ASC""" % (value, ' AND '.join(where))
 
-        return self._result([timescale, start, end, user, status])
+        return self._result(args)
 
-    def sales_invoices(self, timescale, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, so.created_at))*1000 as p,
-        SUM(total_gross) AS v
-        FROM servo_invoice si, servo_order so
-            WHERE (si.created_at, si.created_at) OVERLAPS (%s, %s)
-            AND si.order_id = so.id
-            AND so.queue_id = %s
-        GROUP BY p
-        ORDER BY p ASC"""
+    def statuses_per_location(self, timescale, location, status, start, end):
+        return self._rollup(COUNT, timescale, StatsRollup.STATUS_SET, start, end,
+                            key=status, location_id=location)
 
-        return self._result([timescale, start, end, queue])
+    def statuses_per_user(self, timescale, user, status, start, end):
+        return self._rollup(COUNT, timescale, StatsRollup.STATUS_SET, start, end,
+                            key=status, user_id=user)
 
-    def sales_purchases(self, timescale, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, po.created_at))*1000 as p,
-        SUM(total) AS v
-        FROM servo_purchaseorder po, servo_order so
-            WHERE (po.created_at, po.created_at) OVERLAPS (%s, %s)
-            AND po.sales_order_id = so.id
-            AND so.queue_id = %s
-        GROUP BY p
-        ORDER BY p ASC"""
+    def sales_invoices(self, timescale, queue, start, end):
+        return self._rollup(TOTAL, timescale, StatsRollup.INVOICED, start, end,
+                            queue_id=queue)
 
-        return self._result([timescale, start, end, queue])
+    def sales_purchases(self, timescale, queue, start, end):
+        return self._rollup(TOTAL, timescale, StatsRollup.PURCHASED, start, end,
+                            queue_id=queue)
 
     def sales_parts_per_labtier(self, start, end):
         self.sql = """SELECT labour_tier, count(*)
@@ -88,137 +80,144 @@ class StatsManager:
         return self._result([start, end])
 
     def order_runrate(self, timescale, location, user, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, started_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE user_id = %s
-            AND location_id = %s
-            AND (started_at, started_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, user, location, start, end])
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_STARTED, start, end,
+                            location_id=location, user_id=user)
 
     def turnaround_per_location(self, timescale, location, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-            EXTRACT(HOUR FROM AVG(closed_at - created_at)) as v
-        FROM servo_order
-        WHERE closed_at IS NOT NULL
-            AND location_id = %s
-            AND queue_id IS NOT NULL
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, location, start, end])
+        return self._rollup(TURNAROUND, timescale, StatsRollup.ORDERS_CLOSED, start, end,
+                            where=['queue_id <> 0'], location_id=location)
 
     def runrate_per_location(self, timescale, location, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND closed_at IS NOT NULL
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, location, start, end])
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CLOSED, start, end,
+                            location_id=location)
 
     def distribution_per_location(self, start, end):
         result = []
-        self.sql = """SELECT l.title, COUNT(*)
-        FROM servo_order o LEFT OUTER JOIN servo_location l on (o.location_id = l.id)
-        WHERE (o.created_at, o.created_at) OVERLAPS (%s, %s)
+        self.sql = """SELECT l.title, SUM(r.count)
+        FROM servo_statsrollup r LEFT OUTER JOIN servo_location l on (r.location_id = l.id)
+        WHERE r.metric = %s
+            AND r.day BETWEEN %s::date AND %s::date
         GROUP BY l.title"""
-        self.cursor.execute(self.sql, [start, end])
+        self.cursor.execute(self.sql, [StatsRollup.ORDERS_CREATED, start, end])
 
         for k, v in self.cursor.fetchall():
             result.append({'label': k, 'data': v})
 
         return result
 
-    def orders_created_by(self, timescale, location, user, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND created_by_id = %s
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
+    def distribution_per_queue(self, start, end):
+        self.sql = """SELECT q.title, SUM(r.count)
+        FROM servo_statsrollup r LEFT OUTER JOIN servo_queue q on (r.queue_id = q.id)
+        WHERE r.metric = %s
+            AND r.day BETWEEN %s::date AND %s::date
+        GROUP BY q.title"""
+        self.cursor.execute(self.sql, [StatsRollup.ORDERS_CREATED, start, end])
+        return self.cursor.fetchall()
+
+    def orders_per_user(self, location, user, start, end):
+        self.sql = """SELECT SUM(count)
+        FROM servo_statsrollup
+        WHERE metric = %s
+            AND location_id = %s
+            AND user_id = %s
+            AND day BETWEEN %s::date AND %s::date
+        HAVING SUM(count) > 0"""
+        self.cursor.execute(self.sql, [StatsRollup.ORDERS_CREATED, location, user, start, end])
+        return self.cursor.fetchall()
 
-        return self._result([timescale, location, user, start, end])
+    def orders_created_by(self, timescale, location, user, start, end):
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CREATED, start, end,
+                            location_id=location, created_by_id=user)
 
     def orders_created_at(self, timescale, location, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, location, start, end])
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CREATED, start, end,
+                            location_id=location)
 
     def orders_closed_at(self, timescale, location, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND (closed_at, closed_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, location, start, end])
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CLOSED, start, end,
+                            location_id=location)
 
     def orders_closed_in(self, timescale, location, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND queue_id = %s
-            AND (closed_at, closed_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CLOSED, start, end,
+                            location_id=location, queue_id=queue)
 
-        return self._result([timescale, location, queue, start, end])
-    
     def order_count(self, timescale, location, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-        COUNT(*) AS v
-        FROM servo_order
-        WHERE location_id = %s
-            AND queue_id = %s
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
-
-        return self._result([timescale, location, queue, start, end])
+        return self._rollup(COUNT, timescale, StatsRollup.ORDERS_CREATED, start, end,
+                            location_id=location, queue_id=queue)
 
     def order_turnaround(self, timescale, location, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-            EXTRACT(HOUR FROM AVG(closed_at - created_at)) as v
-        FROM servo_order
-        WHERE closed_at IS NOT NULL
-            AND location_id = %s
-            AND queue_id = %s
-            AND queue_id IS NOT NULL
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
+        return self._rollup(TURNAROUND, timescale, StatsRollup.ORDERS_CLOSED, start, end,
+                            where=['queue_id <> 0'], location_id=location, queue_id=queue)
 
-        return self._result([timescale, location, queue, start, end])
 
-    def order_turnaround(self, timescale, location, queue, start, end):
-        self.sql = """SELECT EXTRACT(EPOCH FROM date_trunc(%s, created_at))*1000 as p,
-            EXTRACT(HOUR FROM AVG(closed_at - created_at)) as v
-        FROM servo_order
-        WHERE closed_at IS NOT NULL
-            AND location_id = %s
-            AND queue_id = %s
-            AND queue_id IS NOT NULL
-            AND (created_at, created_at) OVERLAPS (%s, %s)
-        GROUP BY p
-        ORDER BY p ASC"""
+class InventoryReport(object):
+    """
+    Stocked amounts of products at each location.
+    The per-location columns are pivoted in the database.
+    """
+    def __init__(self, locations, category=None, below_minimum=False):
+        self.locations = list(locations)
+        self.category = category
+        self.below_minimum = below_minimum
+
+    def get_query(self):
+        from servo.models import Product
+
+        columns, args = [], []
+
+        for l in self.locations:
+            columns.append("""SUM(i.amount_stocked) FILTER (WHERE i.location_id = %s)""")
+            args.append(l.pk)
+
+        where = ['i.location_id = ANY(%s)']
+        args.append([l.pk for l in self.locations])
+
+        if self.category:
+            where.append("""p.id IN (SELECT pc.product_id
+                FROM %s pc, servo_productcategory c
+                WHERE pc.productcategory_id = c.id
+                    AND c.tree_id = %%s AND c.lft >= %%s AND c.rght <= %%s)"""
+                % Product.categories.through._meta.db_table)
+            args += [self.category.tree_id, self.category.lft, self.category.rght]
+
+        having = ''
+
+        if self.below_minimum:
+            having = 'HAVING SUM(i.amount_stocked) < SUM(i.amount_minimum)'
+
+        columns = ['p.id', 'p.code'] + columns + [
+            'SUM(i.amount_stocked)', 'SUM(i.amount_reserved)',
+            'SUM(i.amount_ordered)', 'SUM(i.amount_minimum)',
+        ]
+
+        sql = """SELECT %s
+        FROM servo_product p, servo_inventory i
+        WHERE i.product_id = p.id AND %s
+        GROUP BY p.id
+        %s
+        ORDER BY p.id ASC""" % (', '.join(columns), ' AND '.join(where), having)
+
+        return sql, args
+
+    def get_columns(self):
+        from servo.lib.export import Column
+
+        def col(title, i):
+            return Column(title, lambda r: r[i] or 0)
+
+        columns = [Column('ID', lambda r: r[0]), Column('CODE', lambda r: r[1])]
+        offset = len(columns)
+
+        for i, l in enumerate(self.locations):
+            columns.append(col(l.title, offset + i))
+
+        offset += len(self.locations)
+        titles = ('TOTAL', 'RESERVED', 'ORDERED', 'MINIMUM',)
+        columns += [col(t, offset + i) for i, t in enumerate(titles)]
+
+        return columns
 
-        return self._result([timescale, location, queue, start, end])
+    def get_export(self):
+        from servo.lib.export import Export, iterate_sql
+        sql, args = self.get_query()
+        return Export(self.get_columns(), iterate_sql(sql, args))
@@ -2,189 +2,236 @@
 
 from __future__ import absolute_import
 
-from email.parser import Parser
-
-from celery import shared_task
+from celery import shared_task, group
 
 from django.conf import settings
 from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import ugettext as _
 
-from servo.lib.utils import empty
-from servo.exceptions import ConfigurationError
-from servo.models import Configuration, User, Order, Note, Template
-
+from servo.models import (Event, Order, Note, GsxAccount,
+                          WarrantyCache, Message, OrderBatch,
+                          QueueStatus, Repair, Customer,)
+from servo.models.rules import rule_index
+from servo.messaging.imap import MailboxSync
 
-def get_rules():
-    """Get the rules from the JSON file and cache them.
-    Fail silently if not configured.
 
-    @FIXME: Need GUI for managing local_rules.json!
+def run_rules(event):
+    """
+    Applies the configured rules that match event.
+    Returns the number of rules applied.
     """
-    import json
+    applied, queued = 0, 0
+    rules = rule_index.lookup(event.action, event.description)
+    order = event.content_object
 
-    try:
-        fh = open("local_rules.json", "r")
-    except IOError:
-        return []
-        
-    rules = json.load(fh)
-    cache.set('rules', rules)
-    return rules
+    if not rules or not isinstance(order, Order):
+        return 0
+
+    with transaction.atomic():
+        for r in rules:
+            if r.matches(order):
+                queued += r.apply(event)
+                applied += 1
+
+    if queued > 0:
+        transaction.on_commit(lambda: send_messages.delay())
+
+    return applied
 
 
 @shared_task
-def apply_rules(event):
+def apply_rules(event_id):
+    """
+    Applies the configured rules to the Event that was triggered
     """
-    Applies configured rules
+    event = Event.objects.get(pk=event_id)
+    return '%d rules applied' % run_rules(event)
 
-    event is the Event object that was triggered
+
+@shared_task
+def batch_process(batch_id, data):
     """
-    counter = 0
-    rules = cache.get('rules', get_rules())
-    order = event.content_object
-    user  = event.triggered_by
-
-    for r in rules:
-        match = r.get('match', event.description)
-
-        if (r['event'] == event.action and match == event.description):
-            if isinstance(r['data'], dict):
-                tpl_id = r['data']['template']
-                r['data'] = Template.objects.get(pk=tpl_id).render(order)
-            else:
-                r['data'] = Template(content=r['data']).render(order)
-
-            if r['action'] == "set_queue":
-                order.set_queue(r['data'], user)
-
-            if r['action'] == "set_priority":
-                pass
-
-            if r['action'] == "send_email":
-                try:
-                    email = order.customer.valid_email()
-                except Exception:
-                    continue # skip customers w/o valid emails
-                
-                note = Note(order=order, created_by=user)
-                note.body = r['data']
-                note.recipient = email
-                note.render_subject({'note': note})
-                note.save()
+    /orders/batch
 
-                try:
-                    note.send_mail(user)
-                except ValueError as e:
-                    print('Sending email failed (%s)' % e)
+    Resolves the order codes and processes them in parallel chunks
+    """
+    batch = OrderBatch.objects.get(pk=batch_id)
+    codes = OrderBatch.get_codes(data['orders'])
+    chunks = batch.get_chunks(codes)
 
-            if r['action'] == "send_sms":
-                number = 0
+    if chunks:
+        group(process_batch_chunk.s(batch_id, data, c) for c in chunks).delay()
 
-                try:
-                    number = order.customer.get_standard_phone()
-                except Exception:
-                    continue # skip customers w/o valid phone numbers
+    return '%d orders in %d chunks' % (len(codes), len(chunks))
 
-                note = Note(order=order, created_by=user)
 
-                note.body = r['data']
+def process_batch_order(order, user, data, status):
+    """
+    Applies the batch to order.
+    Returns the errors of the messages that couldn't be sent, which
+    don't undo the status and queue changes.
+    """
+    errors = []
+
+    if data['status'] and order.queue:
+        if status is None:
+            raise ValueError(_('Status not available in queue %s') % order.queue.title)
+        order.set_status(status, user)
+
+    if data['queue']:
+        order.set_queue(data['queue'], user)
+
+    customer = order.customer
+    missing = _('Customer contact information missing')
+
+    if len(data['sms']) > 0:
+        try:
+            with transaction.atomic():
+                if customer is None or not customer.phone:
+                    raise ValueError(missing)
+                number = customer.get_standard_phone()
+                note = Note(order=order, created_by=user, body=data['sms'])
+                note.render_body({'order': order})
                 note.save()
+                note.send_sms(number, user, send=False)
+        except Exception as e:
+            errors.append(unicode(e))
 
-                try:
-                    note.send_sms(number, user)
-                except ValueError as e:
-                    print('Sending SMS to %s failed (%s)' % (number, e))
+    if len(data['email']) > 0:
+        try:
+            with transaction.atomic():
+                if customer is None or not customer.email:
+                    raise ValueError(missing)
+                note = Note(order=order, created_by=user, body=data['email'])
+                note.sender = user.email
+                note.recipient = customer.email
+                note.render_subject({'note': note})
+                note.render_body({'order': order})
+                note.save()
+                note.send_mail(user, send=False)
+        except Exception as e:
+            errors.append(unicode(e))
 
-            counter += 1
+    if len(data['note']) > 0:
+        note = Note(order=order, created_by=user, body=data['note'])
+        note.render_body({'order': order})
+        note.save()
 
-    return '%d/%d rules processed' % (counter, len(rules))
+    return errors
 
 
 @shared_task
-def batch_process(user, data):
+def process_batch_chunk(batch_id, data, order_ids):
     """
-    /orders/batch
+    Processes one chunk of a batch and adds the results to it
     """
-    processed = 0
-    orders = data['orders'].strip().split("\r\n")
-    
-    for o in orders:
+    processed, errors = 0, {}
+    batch = OrderBatch.objects.select_related('created_by').get(pk=batch_id)
+    user = batch.created_by
+
+    orders = Order.objects.filter(pk__in=order_ids)
+    orders = list(orders.select_related('queue', 'customer', 'location'))
+    missing = set(order_ids) - set([o.pk for o in orders])
+    statuses = {}
+
+    if data['status']:
+        queue_ids = set([o.queue_id for o in orders if o.queue_id])
+        qs = QueueStatus.objects.filter(status=data['status'], queue__in=queue_ids)
+        statuses = dict([(s.queue_id, s) for s in qs.select_related('status')])
+
+    for pk in missing:
+        # deleted after the batch was started
+        errors[str(pk)] = _('Order not found')
+
+    for order in orders:
         try:
-            order = Order.objects.get(code=o)
+            with transaction.atomic():
+                failed = process_batch_order(order, user, data, statuses.get(order.queue_id))
+            processed += 1
         except Exception as e:
-            continue
-
-        if data['status'] and order.queue:
-            status = order.queue.queuestatus_set.get(status_id=data['status'])
-            order.set_status(status, user)
-        
-        if data['queue']:
-            order.set_queue(data['queue'], user)
-
-        if len(data['sms']) > 0:
-            try:
-                number = order.customer.get_standard_phone()
-                note = Note(order=order, created_by=user, body=data['sms'])
-                note.render_body({'order': order})
-                note.save()
+            failed = [unicode(e)]
 
-                try:
-                    note.send_sms(number, user)
-                except Exception as e:
-                    note.delete()
-                    print("Failed to send SMS to: %s" % number)
+        if failed:
+            errors[order.code] = u'; '.join(failed)
 
-            except AttributeError as e: # customer has no phone number
-                continue
+    batch.add_results(processed, errors, len(order_ids) - processed)
 
-        if len(data['email']) > 0:
-            note = Note(order=order, created_by=user, body=data['email'])
-            note.sender = user.email
+    if data['sms'] or data['email']:
+        send_messages.delay()
 
-            try:
-                note.recipient = order.customer.email
-                note.render_subject({'note': note})
-                note.render_body({'order': order})
-                note.save()
-                note.send_mail(user)
-            except Exception as e:
-                # customer has no email address or some other error...
-                pass
+    return '%d/%d orders processed' % (processed, len(order_ids))
+
+
+@shared_task
+def refresh_warranty(sn, ship_to):
+    """
+    Refreshes a stale warranty cache entry
+    """
+    GsxAccount.fallback()
+    entry = WarrantyCache.get_entry(sn)
+    entry.refresh(ship_to, *entry.get_stale_parts())
+    entry.save()
+
+    return '%s warranty details updated' % sn
+
+
+@shared_task
+def update_customer_names(customer_id):
+    """
+    Renames the contacts of a renamed customer and their orders
+    """
+    customers, orders = Customer.update_fullnames(customer_id)
+    return '%d customers and %d orders renamed' % (customers, orders)
 
-        if len(data['note']) > 0:
-            note = Note(order=order, created_by=user, body=data['note'])
-            note.render_body({'order': order})
-            note.save()
 
-        processed += 1
+@shared_task
+def send_messages():
+    """
+    Sends queued emails and SMS messages
+    """
+    # only one worker at a time so that the rate limits hold
+    if not cache.add('send-messages', True, 300):
+        return 'Already sending messages'
 
-    return '%d/%d orders processed' % (processed, len(orders))
+    count = 0
+
+    try:
+        # the wake-ups of messages queued meanwhile return early
+        # while we hold the lock, so keep going until the outbox is empty
+        while Message.get_queued().exists():
+            count += Message.send_queued()
+            cache.set('send-messages', True, 300)
+    finally:
+        cache.delete('send-messages')
+
+    return '%d messages sent' % count
+
+
+@shared_task
+def update_repairs():
+    """
+    Updates the open GSX repairs that are due for a check
+    """
+    if not cache.add('update-repairs', True, 600):
+        return 'Already updating repairs'
+
+    try:
+        counts = Repair.poll()
+    finally:
+        cache.delete('update-repairs')
+
+    return '%d repairs checked, %d changed, %d failed' % counts
 
 
 @shared_task
 def check_mail():
-    """Checks IMAP box for incoming mail"""
-    uid = Configuration.conf('imap_act')
-
-    if empty(uid):
-        raise ConfigurationError('Incoming message user not configured')
-
-    counter = 0
-    user = User.objects.get(pk=uid)
-    server = Configuration.get_imap_server()
-    typ, data = server.search(None, "UnSeen")
-
-    for num in data[0].split():
-        #logging.debug("** Processing message %s" % num)
-        typ, data = server.fetch(num, "(RFC822)")
-        # parsestr() seems to return an email.message?
-        msg = Parser().parsestr(data[0][1])
-        Note.from_email(msg, user)
-        #server.copy(num, 'servo')
-        server.store(num, '+FLAGS', '\\Seen')
-        counter += 1
-
-    server.close()
-    server.logout()
+    """Reads the new messages of the IMAP box"""
+    sync = MailboxSync.connect()
+
+    try:
+        counter = sync.sync()
+    finally:
+        sync.close()
 
     return '%d messages processed' % counter
@@ -14,7 +14,8 @@ from django.utils.translation import ugettext as _
 from django.template.defaultfilters import date
 from django.contrib.humanize.templatetags.humanize import naturaltime
 
-from servo.models.common import Configuration
+from servo.lib import search
+from servo.models.common import Configuration, InboxItem
 
 register = template.Library()
 
@@ -25,22 +26,19 @@ def gsx_diags_ts(value):
 
 
 @register.filter
-def unread_notifications(queryset):
-    queryset = queryset.filter(action='set_status', handled_at=None)
-    return queryset.order_by('-handled_at')
+def unread_notifications(user):
+    return InboxItem.get_unread(user, 'set_status')
 
 
 @register.filter
-def unread_messages(queryset):
-    queryset = queryset.filter(action='note_added', handled_at=None)
-    return queryset.order_by('-handled_at')
+def unread_messages(user):
+    return InboxItem.get_unread(user, 'note_added')
 
 
 @register.filter
 def count_or_empty(queryset):
-    if queryset.count() > 0:
-        return queryset.count()
-    return ''
+    count = queryset.count()
+    return count if count > 0 else ''
 
 
 @register.filter
@@ -130,6 +128,16 @@ def paginator_page(request, page):
     return query.urlencode()
 
 
+@register.simple_tag
+def cursor_page(request, direction, cursor):
+    query = request.GET.copy()
+    for k in ('page', 'after', 'before',):
+        if k in query.keys():
+            del query[k]
+    query[direction] = cursor
+    return query.urlencode()
+
+
 @register.filter
 def markdown(text):
     import markdown
@@ -137,6 +145,11 @@ def markdown(text):
     return safestring.mark_safe(result)
 
 
+@register.filter
+def headline(text):
+    return safestring.mark_safe(search.highlight(text))
+
+
 @register.filter
 def concat(str1, str2):
     return str(str1) + str(str2)
@@ -149,7 +162,7 @@ def addspace(s):
 
 @register.filter
 def device_accessories(device, order):
-    return device.get_accessories(order)
+    return order.get_device_accessories(device)
 
 
 @register.filter
@@ -1,38 +1,408 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from decimal import Decimal
+from datetime import timedelta
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.http import HttpRequest
 from django.core.urlresolvers import resolve
-from django.test.simple import DjangoTestSuiteRunner
 
 from servo.views import checkin
+from servo.tasks import process_batch_order, update_customer_names
+from servo.lib import dedupe, search
+from servo.lib.utils import KeysetPage
+from servo.lib.export import Column, Export, TSVWriter
+from servo.messaging.imap import MAX_ATTEMPTS, MailboxSync
+from servo.models import WarrantyCache, OrderBatch, ConfigSnapshot
+from servo.models.rules import Condition
+from servo.models import Configuration, Location, User
+from servo.models.order import Order, OrderCounter, OrderSearchIndex
+from servo.models.customer import Customer
+from servo.models.note import MailboxState, Message, Note
+from servo.models.parts import ComptiaCode, symptom_codes
+from servo.models.repair import ChecklistItem, Repair
+from servo.models.product import Inventory, PriceEngine, Product
 
 
-class NoDbTestRunner(DjangoTestSuiteRunner):
-    """ A test runner to test without database creation """
-
-    def setup_databases(self, **kwargs):
-        """ Override the database creation defined in parent class """
-        pass
-
-    def teardown_databases(self, old_config, **kwargs):
-        """ Override the database teardown defined in parent class """
-        pass
+def create_user():
+    location = Location.objects.create(title='Test')
+    return User.objects.create(username='tester', location=location)
 
 
 class ApiTest(TestCase):
     pass
 
+
+class KeysetPageTest(TestCase):
+    def setUp(self):
+        self.page = KeysetPage.__new__(KeysetPage)
+        self.page.keys = ('-priority', 'order_id',)
+
+    def test_cursor_decoding(self):
+        self.assertEqual(self.page.decode('2.1234'), [2, 1234])
+        self.assertIsNone(self.page.decode('2'))
+        self.assertIsNone(self.page.decode('x.1'))
+        self.assertIsNone(self.page.decode(None))
+
+    def test_seek_after(self):
+        q = str(self.page.seek([2, 1234]))
+        self.assertIn("'priority__lt', 2", q)
+        self.assertIn("'order_id__gt', 1234", q)
+
+    def test_seek_before(self):
+        q = str(self.page.seek([2, 1234], backwards=True))
+        self.assertIn("'priority__gt', 2", q)
+        self.assertIn("'order_id__lt', 1234", q)
+
     
+class ExportTest(TestCase):
+    def test_tsv_rows(self):
+        columns = (Column('ID', 'real'), Column('TEXT', lambda x: u'a\tb'),)
+        export = Export(columns, iter([1, 2]))
+        rows = list(TSVWriter().write(export))
+        self.assertEqual(rows, ['ID\tTEXT\n', '1\ta b\n', '2\ta b\n'])
+
+
+class WarrantyCacheTest(TestCase):
+    def test_new_entry_is_stale(self):
+        entry = WarrantyCache(sn='C02ABCDEFGH')
+        self.assertEqual(entry.get_stale_parts(), (True, True,))
+        self.assertFalse(entry.is_usable())
+
+    def test_activation_expires_first(self):
+        checked_at = timezone.now() - timedelta(hours=2)
+        entry = WarrantyCache(sn='C02ABCDEFGH',
+                              coverage={'is_ios': True},
+                              coverage_checked_at=checked_at,
+                              activation_checked_at=checked_at)
+        self.assertEqual(entry.get_stale_parts(), (False, True,))
+        self.assertTrue(entry.is_usable())
+
+    def test_no_activation_for_macs(self):
+        entry = WarrantyCache(sn='C02ABCDEFGH',
+                              coverage={'is_ios': False},
+                              coverage_checked_at=timezone.now())
+        self.assertTrue(entry.is_fresh())
+
+
+class OrderBatchTest(TestCase):
+    def test_codes_are_unique(self):
+        codes = OrderBatch.get_codes("1234\r\n5678\r\n\r\n1234 ")
+        self.assertEqual(codes, ['1234', '5678'])
+
+    def test_progress(self):
+        batch = OrderBatch(total=4, processed=2, failed=1)
+        self.assertEqual(batch.get_progress(), 75)
+        self.assertFalse(batch.is_finished())
+
+    def test_walk_in_order(self):
+        user = create_user()
+        order = Order.objects.create(created_by=user)
+        Configuration.objects.create(key='default_subject', value='Order update')
+        data = {'status': None, 'queue': None, 'sms': 'Hello', 'email': '', 'note': 'Checked'}
+
+        errors = process_batch_order(order, user, data, None)
+        self.assertEqual(errors, [u'Customer contact information missing'])
+        self.assertEqual(order.note_set.count(), 1)
+
+
+class ConfigSnapshotTest(TestCase):
+    def test_reloads_after_invalidate(self):
+        snapshot = ConfigSnapshot()
+        snapshot.load = lambda: {'key': 'value'}
+        self.assertEqual(snapshot.get()['key'], 'value')
+
+        snapshot.load = lambda: {'key': 'changed'}
+        self.assertEqual(snapshot.get()['key'], 'value')
+
+        snapshot.invalidate()
+        self.assertEqual(snapshot.get()['key'], 'changed')
+
+
+class ConditionTest(TestCase):
+    def test_equals(self):
+        c = Condition(key='CUSTOMER_NAME', operator='^%s$', value='Jane Doe')
+        c.compile({})
+        self.assertIsNone(c.action)
+        self.assertTrue(c.compare('jane doe'))
+        self.assertFalse(c.compare('Jane Doe Jr.'))
+
+    def test_status_trigger(self):
+        c = Condition(key='STATUS', value='3')
+        c.compile({('STATUS', '3'): 'Waiting for parts'})
+        self.assertEqual(c.action, 'set_status')
+        self.assertEqual(c.description, 'Waiting for parts')
+
+
+class OrderCounterTest(TestCase):
+    def test_keys_skip_empty(self):
+        keys = OrderCounter.get_keys(1, queue_id=2, location_id=3, tag_ids=[4])
+        self.assertEqual(keys, [('queue', 2, 1), ('location', 3, 1), ('tag', 4, 1)])
+
+
+class ComptiaCatalogTest(TestCase):
+    def test_choices(self):
+        ComptiaCode.refresh({'B': [('B36', 'Button - Home'), ('B08', 'Cellular')]})
+        choices = symptom_codes('B')
+        self.assertEqual(choices[0], ('B08', 'B08 - Cellular ',))
+        self.assertEqual(len(choices), 2)
+        self.assertEqual(symptom_codes('X'), ())
+
+
+class PriceEngineTest(TestCase):
+    def test_margin_tiers(self):
+        engine = PriceEngine({'pct_margin': '0-100=40;101-500=30', 'pct_vat': '24'})
+        self.assertEqual(engine.get_margin(Decimal(50)), Decimal(40))
+        self.assertEqual(engine.get_margin(Decimal(200)), Decimal(30))
+        self.assertEqual(engine.get_margin(Decimal(1000)), Decimal(30))
+
+    def test_price(self):
+        engine = PriceEngine({'pct_margin': '20', 'pct_vat': '24', 'shipping_cost': '10'})
+        self.assertEqual(engine.get_price(80), (Decimal(20), Decimal(110), Decimal(137),))
+
+
+class PriceChangesTest(TestCase):
+    def test_only_differences(self):
+        old = Product(code='661-0001', title='Part', price_sales_stock=Decimal('110.00'))
+        new = Product(code='661-0001', title='Part', price_sales_stock=Decimal('110'))
+        self.assertEqual(old.get_price_changes(new), {})
+
+        new.price_sales_stock = Decimal('120')
+        changes = old.get_price_changes(new)
+        self.assertEqual(changes.keys(), ['price_sales_stock'])
+
+
+class RepairPollTest(TestCase):
+    def test_next_check(self):
+        now = timezone.now()
+        repair = Repair(submitted_at=now - timedelta(minutes=30))
+        self.assertEqual(repair.get_next_check(now), now + Repair.POLL_MIN)
+
+        repair.status_changed_at = now - timedelta(days=30)
+        self.assertEqual(repair.get_next_check(now), now + Repair.POLL_MAX)
+
+        repair.status_changed_at = now - timedelta(hours=10)
+        self.assertEqual(repair.get_next_check(now), now + timedelta(hours=1))
+
+
+class OrderDetailTest(TestCase):
+    def setUp(self):
+        user = create_user()
+        self.order = Order.objects.create(created_by=user)
+
+    def test_query_budget(self):
+        with CaptureQueriesContext(connection) as queries:
+            order = Order.get_detail(self.order.pk)
+        self.assertLessEqual(len(queries), Order.DETAIL_QUERIES)
+
+        with self.assertNumQueries(0):
+            order.net_total()
+            order.get_parts()
+            order.has_devices()
+            order.get_repairs()
+            order.can_dispatch
+            order.is_item_complete(ChecklistItem(pk=1))
+            list(order.notes())
+
+
+class OrderTotalsTest(TestCase):
+    def test_totals_follow_items(self):
+        user = create_user()
+        order = Order.objects.create(created_by=user)
+        product = Product.objects.create(code='661-0001', title='Part',
+                                         pct_vat=Decimal('24'),
+                                         price_purchase_stock=Decimal('50'),
+                                         price_sales_stock=Decimal('124'))
+
+        item = order.add_product(product, 2, user)
+        self.assertEqual(order.gross_total(), Decimal('248'))
+        self.assertEqual(order.net_total(), Decimal('200'))
+        self.assertEqual(order.total_tax(), Decimal('48'))
+        self.assertEqual(order.total_margin(), Decimal('100'))
+
+        order.remove_product(item, user)
+        self.assertEqual(Order.objects.get(pk=order.pk).gross_total(), 0)
+
+    def test_totals_above_item_prices(self):
+        user = create_user()
+        order = Order.objects.create(created_by=user)
+        product = Product.objects.create(code='661-0004', title='Display',
+                                         price_sales_stock=Decimal('900000'))
+
+        order.add_product(product, 2, user)
+        self.assertEqual(order.gross_total(), Decimal('1800000'))
+
+
+class InventoryTest(TestCase):
+    def test_record_many(self):
+        location = Location.objects.create(title='Test')
+        product = Product.objects.create(code='661-0002', title='Part')
+        Inventory.objects.create(product=product, location=location,
+                                 amount_stocked=5, amount_reserved=2)
+
+        missing = Product.objects.create(code='661-0003', title='Other part')
+
+        with self.assertRaises(ValueError):
+            Inventory.record_many(location, 'sell', {missing: (-1, 0, -1)})
+
+        movements = Inventory.record_many(location, 'sell', {product: (-3, 0, -3)})
+        self.assertEqual(movements[0].reserved, -2)
+
+        inventory = Inventory.objects.get(product=product, location=location)
+        self.assertEqual((inventory.amount_stocked, inventory.amount_reserved), (2, 0))
+        self.assertEqual(Product.objects.get(pk=product.pk).total_amount, 2)
+
+
+class SearchTest(TestCase):
+    def test_terms(self):
+        self.assertEqual(search.get_terms(u'Logic board, 13"'), u'Logic:* & board:* & 13:*')
+        self.assertEqual(search.highlight(u'<b>[[[board]]]'), u'&lt;b&gt;<strong>board</strong>')
+
+    def test_search(self):
+        product = Product.objects.create(code='661-1234', title='Logic board')
+        found = search.search(Product.objects.all(), 'logic')
+        self.assertEqual(list(found), [product])
+        found = search.search(Product.objects.all(), '1-123')
+        self.assertEqual(list(found), [product])
+        self.assertEqual(search.search(Product.objects.all(), '...').count(), 0)
+
+
+class MessageTest(TestCase):
+    def test_reports_are_kept(self):
+        user = create_user()
+        note = Note.objects.create(created_by=user, subject='Hello', body='Hello')
+        msg = Message.objects.create(note=note, created_by=user, recipient='5551234',
+                                     method='SMS', status='QUEUED', body='Hello')
+
+        # the delivery report came in before the sender marked it sent
+        Message.objects.filter(pk=msg.pk).update(status='DELIVERED')
+        msg.set_sent()
+        self.assertEqual(Message.objects.get(pk=msg.pk).status, 'DELIVERED')
+        self.assertNotIn(msg, Message.get_queued())
+
+
+class CustomerNamesTest(TestCase):
+    def test_rename_company(self):
+        company = Customer.objects.create(name='Acme', is_company=True)
+        contact = Customer.objects.create(name='John Doe', parent=company)
+        user = create_user()
+        order = Order.objects.create(created_by=user, customer=contact)
+        self.assertEqual(Customer.objects.get(pk=contact.pk).fullname, 'John Doe - Acme')
+
+        company.name = 'Acme Inc'
+        company.save()
+        self.assertEqual(Customer.objects.get(pk=contact.pk).fullname, 'John Doe - Acme Inc')
+        self.assertEqual(Order.objects.get(pk=order.pk).customer_name, 'John Doe - Acme Inc')
+
+    def test_rename_in_background(self):
+        company = Customer.objects.create(name='Acme', is_company=True)
+        contact = Customer.objects.create(name='John Doe', parent=company)
+        user = create_user()
+        order = Order.objects.create(created_by=user, customer=company)
+
+        company.name = 'Acme Inc'
+        company.RENAME_SYNC_LIMIT = 0
+        company.save()
+        self.assertEqual(Customer.objects.get(pk=company.pk).fullname, 'Acme Inc')
+        self.assertEqual(Customer.objects.get(pk=contact.pk).fullname, 'John Doe - Acme')
+
+        update_customer_names(company.pk)
+        self.assertEqual(Customer.objects.get(pk=contact.pk).fullname, 'John Doe - Acme Inc')
+        self.assertEqual(Order.objects.get(pk=order.pk).customer_name, 'Acme Inc')
+
+
+class CustomerReindexTest(TestCase):
+    def test_new_phone_is_indexed(self):
+        customer = Customer.objects.create(name='John Doe', phone='555 1234')
+        user = create_user()
+        order = Order.objects.create(created_by=user, customer=customer)
+
+        customer.phone = '555 9876'
+        customer.save()
+        index = OrderSearchIndex.objects.get(pk=order.pk)
+        self.assertEqual(index.customer_text, 'john doe 555 9876')
+
+
+class DedupeTest(TestCase):
+    def test_normalize(self):
+        self.assertEqual(dedupe.normalize_phone('040 123 4567', 'FI'), '+358401234567')
+        self.assertEqual(dedupe.normalize_email(' John@Example.COM '), 'john@example.com')
+        self.assertEqual(dedupe.normalize_name(u'Doe, Jöhn'), u'doe john')
+        self.assertEqual(dedupe.group_pairs([(2, 3), (1, 2), (5, 4)]), {2: 1, 3: 1, 5: 4})
+
+    def test_merge(self):
+        a = Customer.objects.create(name='John Doe', email='john@example.com')
+        b = Customer.objects.create(name='Doe John', email='JOHN@example.com')
+        user = create_user()
+        order = Order.objects.create(created_by=user, customer=b)
+
+        found = [(x, y) for x, y, score in Customer.find_duplicates()
+                 if score >= dedupe.MIN_SCORE]
+        self.assertEqual(found, [(a.pk, b.pk)])
+
+        self.assertEqual(Customer.merge_many(dedupe.group_pairs(found)), 1)
+        self.assertEqual(Order.objects.get(pk=order.pk).customer, a)
+        self.assertFalse(Customer.objects.filter(pk=b.pk).exists())
+
+
+class FakeImapServer(object):
+    def __init__(self, messages):
+        self.messages = messages
+        self.seen = []
+
+    def response(self, code):
+        return 'OK', [1]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            return 'OK', [' '.join([str(u) for u in sorted(self.messages)])]
+        if command == 'STORE':
+            self.seen += [int(u) for u in args[0].split(',')]
+            return 'OK', []
+        uids = [int(u) for u in args[0].split(',')]
+        if 'RFC822.SIZE' in args[1]:
+            return 'OK', ['%d (UID %d RFC822.SIZE 100)' % (u, u) for u in uids]
+        return 'OK', [('%d (UID %d BODY[] {100}' % (u, u), self.messages[u])
+                      for u in uids if u in self.messages]
+
+
+class MailboxSyncTest(TestCase):
+    def setUp(self):
+        self.user = create_user()
+
+    def test_skips_saved_messages(self):
+        Note.objects.create(created_by=self.user, subject='Hello',
+                            body='Hello', message_id='<1@example.com>')
+        raw = 'Message-ID: <1@example.com>\nFrom: a@example.com\nSubject: Hello\n\nHello'
+        server = FakeImapServer({1: raw})
+
+        self.assertEqual(MailboxSync(server, self.user).sync(), 0)
+        self.assertEqual(server.seen, [1])
+        self.assertEqual(Note.objects.count(), 1)
+
+    def test_failed_retries_are_capped(self):
+        state = MailboxState.objects.create(mailbox='test', last_uid=10)
+        sync = MailboxSync(FakeImapServer({}), self.user)
+
+        sync.set_failed(state, 5)
+        self.assertEqual(sync.get_new_uids(state), [5])
+
+        for i in range(MAX_ATTEMPTS - 1):
+            sync.set_failed(state, 5)
+        self.assertEqual(sync.get_new_uids(state), [])
+
+
 class CheckinTest(TestCase):
     def test_checkin_url_resolves(self):
         found = resolve('/checkin/')
-        self.assertEqual(found.func, checkin.home)
+        self.assertEqual(found.func, checkin.index)
 
     def test_homepage_error_without_cookies(self):
         request = HttpRequest()
-        response = checkin.home(request)
+        response = checkin.index(request)
         self.assertTrue(response.content.startswith("<!DOCTYPE html>"), response.content)
         self.assertIn('<title>An error occurred', response.content)
         self.assertTrue(response.content.endswith('</html>'))
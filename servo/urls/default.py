@@ -30,6 +30,7 @@ urlpatterns = [
 
     url(r'^barcode/([\w\-]+)/$', show_barcode, name='barcodes-view'),
     url(r'^files/(?P<pk>\d+)/view/$', files.view_file, name="files-view_file"),
+    url(r'^files/(?P<pk>\d+)/thumbnail/$', files.view_thumbnail, name="files-view_thumbnail"),
     url(r'^files/(?P<path>.+)/$', files.get_file, name="files-get_file"),
 
     url(r'^login/$', account.login, name="accounts-login"),
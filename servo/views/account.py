@@ -360,8 +360,8 @@ def clear_notifications(request):
     from datetime import datetime
     ts = [int(x) for x in request.GET.get('t').split('/')]
     ts = datetime(*ts, tzinfo=timezone.get_current_timezone())
-    notif = request.user.notifications.filter(handled_at=None)
-    notif.filter(triggered_at__lt=ts).update(handled_at=timezone.now())
+    notif = request.user.inbox.filter(is_read=False)
+    notif.filter(event__triggered_at__lt=ts).update(is_read=True)
     messages.success(request, _('All notifications cleared'))
     return redirect(request.META['HTTP_REFERER'])
 
@@ -411,7 +411,8 @@ def stats(request):
 def updates(request):
     title = _('Updates')
     kind = request.GET.get('kind', 'note_added')
-    events = request.user.notifications.filter(action=kind)
+    events = request.user.inbox.filter(action=kind).order_by('-event_id')
+    events = events.select_related('event', 'event__triggered_by')
     page = request.GET.get("page")
     events = paginate(events, page, 100)
 
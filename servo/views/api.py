@@ -194,7 +194,6 @@ def create_order(request):
         content = ContentFile(content, filename)
         attachment = Attachment(content=content, content_object=note)
         attachment.save()
-        attachment.content.save(filename, content)
         note.attachments.add(attachment)
 
     if data.get('device'):
@@ -272,21 +271,28 @@ def messages(request):
     if gw == 'jazz':
         statusmap = SMSJazzProvider.STATUSES
 
-    status = statusmap[request.GET['status']]
-    m.status = status[0]
-    m.error = status[1]
+    status, error = statusmap[request.GET['status']]
+    values = {'status': status, 'error': error}
 
-    if m.status == 'DELIVERED':
-        m.received_at = timezone.now()
+    if status == 'DELIVERED':
+        values['received_at'] = timezone.now()
 
-    if m.status == 'FAILED':
+    # reports only move sent messages forward, never back into the
+    # outbox or over a final report that has already come in
+    if status == 'SENT':
+        return HttpResponse('OK')
+
+    sent = Message.objects.filter(pk=m.pk, status__in=Message.IN_TRANSIT)
+
+    if not sent.exclude(status=status).update(**values):
+        return HttpResponse('OK')
+
+    if status == 'FAILED':
         if m.note.order:
             uid = Configuration.conf('imap_act')
             if uid:
                 user = User.objects.get(pk=uid)
-                m.note.order.notify('sms_failed', m.error, user)
-
-    m.save()
+                m.note.order.notify('sms_failed', error, user)
 
     return HttpResponse('OK')
 
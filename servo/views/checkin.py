@@ -90,7 +90,7 @@ def get_remote_device(request, sn):
 
     get_gsx_connection(request)
 
-    return Device.from_gsx(sn)
+    return Device.from_gsx(sn, stale=True)
 
 
 def get_local_device(request, sn):
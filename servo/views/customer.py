@@ -12,6 +12,9 @@ from django.contrib.auth.decorators import permission_required
 from django.shortcuts import render, redirect, get_object_or_404
 
 from servo.lib.utils import paginate
+from servo.lib.search import search
+from servo.lib.dedupe import normalize_email
+from servo.lib.export import iterate, Column, Export, send_export
 
 from servo.models.note import Note
 from servo.models.order import Order
@@ -241,7 +244,9 @@ def merge(request, pk, target=None):
     Re-links everything from customer PK to TARGET:
     - orders
     - devices
+    - notes
     - invoices
+    - contacts
     Deletes the source customer
     """
     customer = get_object_or_404(Customer, pk=pk)
@@ -253,13 +258,14 @@ def merge(request, pk, target=None):
         return render(request, 'customers/results-merge.html', locals())
 
     if pk and target:
-        target_customer = Customer.objects.get(pk=target)
-        target_customer.orders.add(*customer.orders.all())
-        target_customer.devices.add(*customer.devices.all())
-        target_customer.note_set.add(*customer.note_set.all())
-        target_customer.invoice_set.add(*customer.invoice_set.all())
-        target_customer.save()
-        customer.delete()
+        target_customer = get_object_or_404(Customer, pk=target)
+
+        try:
+            Customer.merge_many({customer.pk: target_customer.pk})
+        except ValueError as e:
+            messages.error(request, e)
+            return redirect(customer)
+
         messages.success(request, _('Customer records merged succesfully'))
         return redirect(target_customer)
 
@@ -306,14 +312,14 @@ def filter(request):
     if request.method == "GET":
         results = list()
         query = request.GET.get("query")
-        customers = Customer.objects.filter(fullname__icontains=query)
+        customers = search(Customer.objects.all(), query)
 
         for c in customers:
             results.append(u"%s <%s>" % (c.name, c.email))
             results.append(u"%s <%s>" % (c.name, c.phone))
     else:
         query = request.POST.get("name")
-        results = Customer.objects.filter(fullname__icontains=query)
+        results = search(Customer.objects.all(), query)
         data = {'results': results, 'id': request.POST['id']}
 
         return render(request, "customers/search-results.html", data)
@@ -333,6 +339,7 @@ def find(request):
 
         if form.is_valid():
             d = form.cleaned_data
+            name = d.pop('name__icontains')
             checkin_start = d.pop('checked_in_start')
             checkin_end = d.pop('checked_in_end')
 
@@ -341,7 +348,12 @@ def find(request):
                                                   checkin_end.isoformat()]
 
             results = Customer.objects.filter(**d).distinct()
+
+            if name:
+                results = search(results, name)
+
             request.session['customer_query'] = d
+            request.session['customer_search'] = name
     else:
         form = CustomerSearchForm()
 
@@ -353,7 +365,7 @@ def find(request):
     return render(request, "customers/find.html", locals())
 
 
-def download(request, format='csv', group='all'):
+def download(request, format='txt', group='all'):
     """
     Downloads all customers or search results
     """
@@ -361,29 +373,29 @@ def download(request, format='csv', group='all'):
     results = Customer.objects.all()
     query = request.session.get('customer_query')
 
-    response = HttpResponse(content_type="text/plain; charset=utf-8")
-    response['Content-Disposition'] = 'attachment; filename="%s.txt"' % filename
-    response.write(u"ID\tNAME\tEMAIL\tPHONE\tADDRESS\tPOSTAL CODE\tCITY\tCOUNTRY\tNOTES\n")
-
     if group != 'all':
         results = results.filter(groups__slug=group)
 
     if query:
         results = Customer.objects.filter(**query).distinct()
 
-    for c in results:
-        row = u"%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (c.pk,
-                                                         c.name,
-                                                         c.email,
-                                                         c.phone,
-                                                         c.street_address,
-                                                         c.zip_code,
-                                                         c.city,
-                                                         c.country,
-                                                         c.notes,)
-        response.write(row)
+        if request.session.get('customer_search'):
+            results = search(results, request.session['customer_search'])
+
+    columns = (
+        Column('ID', 'pk'),
+        Column('NAME', 'name'),
+        Column('EMAIL', 'email'),
+        Column('PHONE', 'phone'),
+        Column('ADDRESS', 'street_address'),
+        Column('POSTAL CODE', 'zip_code'),
+        Column('CITY', 'city'),
+        Column('COUNTRY', 'country'),
+        Column('NOTES', 'notes'),
+    )
 
-    return response
+    export = Export(columns, iterate(results))
+    return send_export(export, filename, request.GET.get('format', format))
 
 
 def create_message(request, pk):
@@ -405,17 +417,32 @@ def upload(request, group='all'):
             return redirect(index)
 
         i, df = 0, form.cleaned_data['datafile'].read()
+        rows = [force_decode(l).strip().split("\t") for l in df.split("\r")]
+
+        if [r for r in rows if len(r) < 5]:
+            messages.error(request, _("Invalid upload data"))
+            return redirect(index)
+
+        # the existing addresses are looked up all at once
+        existing = set()
+
+        if form.cleaned_data.get('skip_dups'):
+            emails = set([normalize_email(r[1]) for r in rows]) - set([''])
+            existing = Customer.objects.filter(email_normalized__in=emails)
+            existing = set(existing.values_list('email_normalized', flat=True))
 
-        for l in df.split("\r"):
-            row = force_decode(l).strip().split("\t")
+        customer_group = None
 
-            if len(row) < 5:
-                messages.error(request, _("Invalid upload data"))
-                return redirect(index)
+        if group != 'all':
+            customer_group = CustomerGroup.objects.get(slug=group)
 
+        for row in rows:
             if form.cleaned_data.get('skip_dups'):
-                if Customer.objects.filter(email=row[1]).exists():
+                email = normalize_email(row[1])
+                if email in existing:
                     continue
+                if email:
+                    existing.add(email)
 
             c = Customer(name=row[0], email=row[1])
             c.street_address = row[2]
@@ -424,9 +451,8 @@ def upload(request, group='all'):
             c.notes = row[5]
             c.save()
 
-            if group != 'all':
-                g = CustomerGroup.objects.get(slug=group)
-                c.groups.add(g)
+            if customer_group:
+                c.groups.add(customer_group)
 
             i += 1
 
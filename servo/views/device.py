@@ -13,6 +13,7 @@ from django.template.defaultfilters import slugify
 from django.views.decorators.cache import cache_page
 
 from servo.lib.utils import paginate
+from servo.lib.search import search
 from servo.models import (Device, Order, Product, GsxAccount,
                          ServiceOrderItem, Customer,)
 from servo.forms.devices import DeviceForm, DeviceUploadForm, DeviceSearchForm
@@ -186,7 +187,7 @@ def find(request):
             if fdata.get("warranty_status"):
                 results = results.filter(warranty_status__in=fdata['warranty_status'])
             if fdata.get("description"):
-                results = results.filter(description__icontains=fdata['description'])
+                results = search(results, fdata['description'])
             if fdata.get("sn"):
                 results = results.filter(sn__icontains=fdata['sn'])
             if fdata.get("date_start"):
@@ -304,18 +305,17 @@ def upload_devices(request):
             if sheet.row[0][0] == 'SN':
                 del(sheet.row[0]) # skip header row
 
+            rows = [row for row in sheet if len(row[0])] # skip empty rows
+
             if form.cleaned_data.get('do_warranty_check'):
                 gsx_account = GsxAccount.default(request.user)
+                devices = Device.from_gsx_many([row[0] for row in rows])
 
-            for row in sheet:
-                if not len(row[0]):
-                    continue # skip empty rows
-
+            for row in rows:
                 if gsx_account:
-                    try:
-                        device = Device.from_gsx(row[0])
-                    except Exception as e:
-                        messages.error(request, e)
+                    device = devices[row[0].strip().upper()]
+                    if isinstance(device, Exception):
+                        messages.error(request, device)
                         break
                 else:
                     device = Device.objects.get_or_create(sn=row[0])[0]
@@ -347,7 +347,7 @@ def update_gsx_details(request, pk):
     device = get_object_or_404(Device, pk=pk)
     try:
         GsxAccount.default(request.user)
-        device.update_gsx_details()
+        device.update_gsx_details(cached=False)
         messages.success(request, _("Warranty status updated successfully"))
     except Exception as e:
         messages.error(request, e)
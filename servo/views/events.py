@@ -4,7 +4,7 @@ from django.utils import timezone
 from django.shortcuts import redirect
 from django.utils.translation import ugettext as _
 
-from servo.models.common import Event
+from servo.models.common import Event, InboxItem
 
 
 def acknowledge(request, pk):
@@ -12,6 +12,8 @@ def acknowledge(request, pk):
     e.handled_at = timezone.now()
     e.save()
 
+    InboxItem.objects.filter(user=request.user, event=e).update(is_read=True)
+
     referer = request.META.get('HTTP_REFERER')
 
     if request.GET.get('return') == '0'and referer:
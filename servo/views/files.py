@@ -3,14 +3,37 @@
 import os
 import mimetypes
 from django.conf import settings
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, FileResponse, Http404
+from django.shortcuts import get_object_or_404
 
 from servo.models.common import Attachment
 
 
 def view_file(request, pk):
-    doc = Attachment.objects.get(pk=pk)
-    return HttpResponse(doc.content.read(), content_type=doc.mime_type)
+    doc = get_object_or_404(Attachment, pk=pk)
+    # FieldFile.open() doesn't return the file in this Django version
+    doc.content.open('rb')
+    response = FileResponse(doc.content, content_type=doc.mime_type)
+    filename = unicode(doc).replace('"', '').encode('utf-8')
+    response['Content-Disposition'] = 'inline; filename="%s"' % filename
+    return response
+
+
+def view_thumbnail(request, pk, size=256):
+    doc = get_object_or_404(Attachment, pk=pk)
+
+    if not doc.is_image():
+        raise Http404
+
+    try:
+        path = doc.get_thumbnail(int(size))
+    except IOError:
+        raise Http404 # not an image PIL can read
+
+    response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+    # the thumbnail of an attachment never changes
+    response['Cache-Control'] = 'private, max-age=%d' % (60*60*24*30)
+    return response
 
 
 def get_file(request, path):
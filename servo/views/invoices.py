@@ -99,6 +99,8 @@ def create_invoice(request, order_id=None, numbers=None):
     Dispatches Sales Order
     """
     order = get_object_or_404(Order, pk=order_id)
+    # the margin follows the current purchase prices
+    order.update_totals()
     title = _(u'Dispatch Order %s') % order.code
     products = order.products.filter(dispatched=False)
 
@@ -19,6 +19,7 @@ from reportlab.graphics.shapes import Drawing
 from reportlab.graphics.barcode import createBarcodeDrawing
 
 from servo.lib.utils import paginate
+from servo.lib.search import search
 from servo.models import (Order, Template, Tag, Customer, Note,
                          Attachment, Escalation, Article,)
 from servo.forms import NoteForm, NoteSearchForm, EscalationForm
@@ -363,7 +364,7 @@ def find(request):
         results = Note.objects.all()
 
         if fdata.get('body'):
-            results = results.filter(body__icontains=fdata['body'])
+            results = search(results, fdata['body'])
         if fdata.get('recipient'):
             results = results.filter(recipient__icontains=fdata['recipient'])
         if fdata.get('sender'):
@@ -3,9 +3,9 @@
 import json
 
 from gsxws.core import GsxError
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from django.http import QueryDict
+from django.http import QueryDict, Http404
 
 from django.db.models import Q
 from django.utils import timezone
@@ -23,7 +23,8 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import permission_required
 
-from servo.lib.utils import paginate
+from servo.lib.utils import keyset_paginate
+from servo.lib.export import iterate, Column, Export, send_export
 
 from servo.models.order import *
 from servo.forms.orders import *
@@ -53,105 +54,123 @@ def prepare_list_view(request, args):
     if request.session.get("return_to"):
         del(request.session['return_to'])
 
+    # All the filtering is done against the denormalized search index
+    # so that we never have to join (and DISTINCT) the M2M tables
+    index = OrderSearchIndex.objects.all()
+
     if request.user.customer:
-        orders = Order.objects.filter(customer=request.user.customer)
+        index = index.filter(customer_id=request.user.customer_id)
     else:
-        orders = Order.objects.filter(location__in=request.user.locations.all())
+        locations = request.user.locations.values_list('pk', flat=True)
+        index = index.filter(location_id__in=list(locations))
 
     if args.get("state"):
-        orders = orders.filter(state__in=args.getlist("state"))
+        index = index.filter(state__in=args.getlist("state"))
 
     start_date = args.get("start_date")
     if start_date:
         end_date = args.get('end_date') or timezone.now()
-        orders = orders.filter(created_at__range=[start_date, end_date])
+        index = index.filter(created_at__range=[start_date, end_date])
 
     if args.get("status_older_than"):
         days = int(args.get("status_older_than"))
-        limit = datetime.now() - timedelta(days=days)
-        orders = orders.filter(status_started_at__lt=limit)
+        limit = timezone.now() - timedelta(days=days)
+        index = index.filter(status_started_at__lt=limit)
 
     if args.get("assigned_to"):
         users = args.getlist("assigned_to")
-        orders = orders.filter(user__in=users)
+        index = index.filter(user_id__in=users)
 
     if args.get("followed_by"):
-        users = args.getlist("followed_by")
-        orders = orders.filter(followed_by__in=users)
+        users = [int(u) for u in args.getlist("followed_by")]
+        index = index.filter(follower_ids__overlap=users)
 
     if args.get("created_by"):
         users = args.getlist("created_by")
-        orders = orders.filter(created_by__in=users)
+        index = index.filter(created_by_id__in=users)
 
     if args.get("customer"):
-        customer = int(args['customer'][0])
+        customer = int(args.get("customer"))
         if customer == 0:
-            orders = orders.filter(customer__pk=None)
+            index = index.filter(customer_id=None)
         else:
-            orders = orders.filter(customer__tree_id=customer)
+            index = index.filter(customer_tree_id=customer)
 
     if args.get("spec"):
-        spec = args['spec'][0]
-        if spec is "None":
-            orders = orders.filter(devices=None)
+        spec = args.get("spec")
+        if spec == "None":
+            index = index.filter(device_ids=[])
         else:
-            orders = orders.filter(devices__slug=spec)
+            index = index.filter(device_slugs__contains=[spec])
 
     if args.get("device"):
-        orders = orders.filter(devices__pk=args['device'])
+        index = index.filter(device_ids__contains=[int(args.get("device"))])
 
     if args.get("queue"):
         queue = args.getlist("queue")
-        orders = orders.filter(queue__in=queue)
+        index = index.filter(queue_id__in=queue)
 
     if args.get("checkin_location"):
         ci_location = args.getlist("checkin_location")
-        orders = orders.filter(checkin_location__in=ci_location)
+        index = index.filter(checkin_location_id__in=ci_location)
 
     if args.get("location"):
         location = args.getlist("location")
-        orders = orders.filter(location__in=location)
+        index = index.filter(location_id__in=location)
 
     if args.get("label"):
-        orders = orders.filter(tags__in=args.getlist("label"))
+        labels = [int(l) for l in args.getlist("label")]
+        index = index.filter(tag_ids__overlap=labels)
 
     if args.get("status"):
         status = args.getlist("status")
 
-        if args['status'][0] == 'None':
-            orders = orders.filter(status__pk=None)
+        if 'None' in status:
+            index = index.filter(status_id=None)
         else:
-            orders = orders.filter(status__status__in=status)
+            index = index.filter(status_id__in=status)
 
     if args.get("color"):
         color = args.getlist("color")
         now = timezone.now()
 
         if "grey" in color:
-            orders = orders.filter(status=None)
+            index = index.filter(status_id=None)
         if "green" in color:
-            orders = orders.filter(status_limit_green__gte=now)
+            index = index.filter(status_limit_green__gte=now)
         if "yellow" in color:
-            orders = orders.filter(status_limit_yellow__gte=now,
-                                   status_limit_green__lte=now)
+            index = index.filter(status_limit_yellow__gte=now,
+                                 status_limit_green__lte=now)
         if "red" in color:
-            orders = orders.filter(status_limit_yellow__lte=now)
-
-    page = request.GET.get("page")
+            index = index.filter(status_limit_yellow__lte=now)
 
     data['form'] = form
-    data['queryset'] = orders
-    data['orders'] = paginate(orders.distinct(), page, 100)
-    data['subtitle'] = _("%d search results") % orders.count()
+    data['queryset'] = Order.objects.filter(pk__in=index.values('pk'))
+    data['orders'] = paginate_index(index, request.GET)
+    data['subtitle'] = _("%d search results") % index.count()
 
     return data
 
 
+def paginate_index(index, args, count=100):
+    """
+    Returns a keyset-paginated page of orders matching
+    this OrderSearchIndex queryset
+    """
+    index = index.select_related('order', 'order__user')
+    page = keyset_paginate(index, args, count, ('-priority', 'order_id',))
+    page.object_list = [i.order for i in page.rows]
+    return page
+
+
 def prepare_detail_view(request, pk):
     """
     Prepares the view for whenever we're dealing with a specific order
     """
-    order = get_object_or_404(Order, pk=pk)
+    try:
+        order = Order.get_detail(pk)
+    except Order.DoesNotExist:
+        raise Http404
 
     request.session['current_order_id'] = None
     request.session['current_order_code'] = None
@@ -160,7 +179,7 @@ def prepare_detail_view(request, pk):
     title = _(u'Order %s') % order.code
     priorities = Queue.PRIORITIES
     followers = order.followed_by.all()
-    locations = Location.objects.filter(enabled=True)
+    locations = list(Location.objects.filter(enabled=True))
     queues = request.user.queues.all()
     users = order.get_available_users(request.user)
 
@@ -176,7 +195,8 @@ def prepare_detail_view(request, pk):
 
     if order.queue is not None:
         checklists = Checklist.objects.filter(queues=order.queue)
-        statuses = order.queue.queuestatus_set.all()
+        checklists = checklists.prefetch_related('checklistitem_set')
+        statuses = order.queue.queuestatus_set.select_related('status')
 
     if order.is_editable:
         request.session['current_order_id'] = order.pk
@@ -903,33 +923,34 @@ def batch_process(request):
         form = BatchProcessForm(request.POST)
         if form.is_valid():
             from servo.tasks import batch_process
-            batch_process.delay(request.user, form.cleaned_data)
+            batch = OrderBatch.objects.create(created_by=request.user)
+            batch_process.delay(batch.pk, form.cleaned_data)
             messages.success(request, _('Request accepted for batch processing'))
+            return redirect('orders-batch_process')
+
+    batches = OrderBatch.objects.filter(created_by=request.user)[:10]
 
     return render(request, "orders/batch_process.html", locals())
 
 
 def download_results(request):
-    import csv
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="orders.csv"'
-
-    writer = csv.writer(response)
-    header = [
-        'CODE',
-        'CUSTOMER',
-        'CREATED_AT',
-        'ASSIGNED_TO',
-        'CHECKED_IN',
-        'LOCATION'
-    ]
-    writer.writerow(header)
-
-    for o in request.session['order_queryset']:
-        row = [o.code, o.customer, o.created_at, 
-            o.user, o.checkin_location, o.location]
-        coded = [unicode(s).encode('utf-8') for s in row]
-
-        writer.writerow(coded)
-
-    return response
+    """
+    Downloads the results of the current order search
+    """
+    args = QueryDict('', mutable=True)
+    args.update(request.session.get('order_search_filter', {}))
+    data = prepare_list_view(request, args)
+
+    orders = data['queryset'].select_related('customer', 'user',
+                                             'checkin_location', 'location')
+    columns = (
+        Column('CODE', 'code'),
+        Column('CUSTOMER', 'customer'),
+        Column('CREATED_AT', 'created_at'),
+        Column('ASSIGNED_TO', 'user'),
+        Column('CHECKED_IN', 'checkin_location'),
+        Column('LOCATION', 'location'),
+    )
+
+    export = Export(columns, iterate(orders))
+    return send_export(export, 'orders', request.GET.get('format', 'csv'))
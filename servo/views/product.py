@@ -2,7 +2,6 @@
 
 from decimal import *
 
-from django.db.models import Q
 from django.db import IntegrityError
 
 from django.contrib import messages
@@ -14,7 +13,10 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.decorators import permission_required
 from django.shortcuts import render, redirect, get_object_or_404
 
-from servo.lib.utils import paginate, send_csv
+from servo.lib.utils import paginate
+from servo.lib.search import search
+from servo.lib.export import iterate, Column, Export, send_export
+from servo.stats.queries import InventoryReport
 from servo.models import (Attachment, TaggedItem,
                           Product, ProductCategory,
                           Inventory, Location, inventory_totals,
@@ -126,53 +128,21 @@ def upload_gsx_parts(request, group=None):
 def get_inventory_report(request):
     """
     Returns stocked amount of products at each location
+    ?category=<slug>&location=<pk>&location=<pk>&low=1
     """
-    import re
-    from django.db import connection
-    cursor = connection.cursor()
-    location_map = {}
-
-    for l in Location.objects.filter(enabled=True):
-         location_map[str(l.pk)] = l.title
-
-    # @TODO this should be rewritten as a pivot query
-    # but this will have to do for now. This is still much
-    # faster than using the ORM.
-    query = """SELECT p.id, p.code, l.id, i.amount_stocked 
-    FROM servo_product p, servo_inventory i, servo_location l
-        WHERE p.id = i.product_id AND l.id = i.location_id
-        ORDER BY p.id ASC"""
-    cursor.execute(query)
-
-    response = HttpResponse(content_type="text/plain; charset=utf-8")
-    filename = 'servo_inventory_report.txt'
-    #response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-    header = ['ID', 'CODE'] + location_map.values()
-    response.write("\t".join(header) + "\n")
-    inventory, codemap = {}, {}
-
-    for k in cursor.fetchall():
-        product_id = unicode(k[0])
-        codemap[product_id] = k[1] # map product IDs to product codes
-        inv_slot = {k[2]: k[3]}
+    category = None
+    locations = Location.objects.filter(enabled=True)
 
-        try:
-            inventory[product_id].append(inv_slot)
-        except KeyError:
-            inventory[product_id] = [inv_slot]
+    if request.GET.get('location'):
+        locations = locations.filter(pk__in=request.GET.getlist('location'))
 
-    for k, v in inventory.iteritems():
-        inventory_cols = []
-        for i, x in location_map.iteritems():
-            for p in v:
-                amount = p.get(i, '0') # fill empty inventory slots with zeros
-                inventory_cols.append(amount)
+    if request.GET.get('category'):
+        category = get_object_or_404(ProductCategory, slug=request.GET['category'])
 
-        code = unicode(codemap[k])
-        row = [k, code] + inventory_cols
-        response.write("\t".join(row) + "\n")
+    report = InventoryReport(locations, category, bool(request.GET.get('low')))
+    export = report.get_export()
 
-    return response
+    return send_export(export, 'servo_inventory_report', request.GET.get('format', 'txt'))
 
 
 @permission_required("servo.change_product")
@@ -181,7 +151,6 @@ def download_products(request, group="all"):
     Downloads entire product DB or just ones belonging to a group
     """
     filename = "products"
-    data = u"ID\tCODE\tTITLE\tPURCHASE_PRICE\tSALES_PRICE\tSTOCKED\n"
 
     if group == "all":
         products = Product.objects.all()
@@ -192,13 +161,17 @@ def download_products(request, group="all"):
 
     # @FIXME: Add total stocked amount to product
     # currently the last column is a placeholder for stock counts in inventory uploads
-    for p in products:
-        row = [unicode(i) for i in (p.pk, p.code, p.title, 
-                                    p.price_purchase_stock,
-                                    p.price_sales_stock, 0)]
-        data += "\t".join(row) + "\n"
+    columns = (
+        Column('ID', 'pk'),
+        Column('CODE', 'code'),
+        Column('TITLE', 'title'),
+        Column('PURCHASE_PRICE', 'price_purchase_stock'),
+        Column('SALES_PRICE', 'price_sales_stock'),
+        Column('STOCKED', lambda p: 0),
+    )
 
-    return send_csv(data, filename)
+    export = Export(columns, iterate(products))
+    return send_export(export, filename, request.GET.get('format', 'txt'))
 
 
 @permission_required("servo.change_product")
@@ -256,7 +229,7 @@ def upload_products(request, group=None):
                 inventory, created = Inventory.objects.get_or_create(
                     product=product, location=location
                 )
-                inventory.amount_stocked = cols[5]
+                inventory.amount_stocked = int(cols[5])
                 inventory.save()
                 i += 1
 
@@ -461,10 +434,7 @@ def choose_product(request, order_id, product_id=None, target_url="orders-add_pr
         query = request.POST.get('q')
 
         if len(query) > 2:
-            products = Product.objects.filter(
-                Q(code__icontains=query) | Q(title__icontains=query)
-            )
-            data['products'] = products
+            data['products'] = search(Product.objects.all(), query)
 
         return render(request, 'products/choose-list.html', data)
 
@@ -32,7 +32,7 @@ def edit_rule(request, pk=None):
             rule = Rule()
 
         rule.description = request.POST.get('description')
-        #rule.match = request.POST.get('description')
+        rule.match = request.POST.get('match', 'ANY')
         rule.save()
 
         rule.condition_set.all().delete()
@@ -56,7 +56,9 @@ def edit_rule(request, pk=None):
             action.value = values[k]
             action.save()
 
-            
+        messages.success(request, _('Rule saved'))
+        return redirect(rule.get_admin_url())
+
     return render(request, "rules/form.html", locals())
 
 
@@ -13,9 +13,12 @@ from django.utils.translation import ugettext as _
 from django.http import QueryDict, HttpResponseRedirect
 
 from servo.lib.utils import paginate
-from servo.models import (Note, Device, Product, 
+from servo.lib.search import search
+from servo.views.order import paginate_index
+from servo.models import (Note, Device, Product, PriceEngine,
                          GsxAccount, PurchaseOrder, Order,
-                         ServiceOrderItem, Customer, ProductCategory,)
+                         ServiceOrderItem, Customer, ProductCategory,
+                         OrderSearchIndex,)
 
 
 def search_gsx(request, what, param, query):
@@ -66,10 +69,10 @@ def get_gsx_search_results(request, what, param, query):
         # Update wty info if device has been serviced before
         try:
             device = Device.objects.get(sn__exact=query)
-            device.update_gsx_details()
+            device.update_gsx_details(stale=True)
         except Exception:
             try:
-                device = Device.from_gsx(query, user=request.user)
+                device = Device.from_gsx(query, user=request.user, stale=True)
             except Exception as e:
                 return render(request, error_template, {'message': e})
 
@@ -108,8 +111,7 @@ def get_gsx_search_results(request, what, param, query):
         if param == "productName":
             product = gsxws.Product(productName=query)
             parts = product.parts()
-            for p in parts:
-                results.append(Product.from_gsx(p))
+            results += PriceEngine.current().price_parts(parts)
 
     if what == "repairs":
         # Looking for GSX repairs
@@ -148,9 +150,7 @@ def products(request):
     query = request.GET.get("q")
     request.session['search_query'] = query
 
-    results = Product.objects.filter(
-        Q(code__icontains=query) | Q(title__icontains=query) | Q(eee_code__icontains=query)
-    )
+    results = search(Product.objects.all(), query)
 
     page = request.GET.get("page")
     products = paginate(results, page, 50)
@@ -180,21 +180,18 @@ def orders(request):
     except Order.DoesNotExist:
         pass
 
-    orders = Order.objects.filter(
-        Q(code=query) | Q(devices__sn__contains=query) |
-        Q(customer__fullname__icontains=query) |
-        Q(customer__phone__contains=query) |
-        Q(repair__confirmation=query) |
-        Q(repair__reference=query)
+    index = OrderSearchIndex.objects.filter(
+        Q(device_text__contains=query.lower()) |
+        Q(customer_text__contains=query.lower()) |
+        Q(repair_refs__contains=[query])
     )
 
     data = {
         'title': _('Orders'),
-        'subtitle': _(u'%d results for "%s"') % (orders.count(), query)
+        'subtitle': _(u'%d results for "%s"') % (index.count(), query)
     }
 
-    page = request.GET.get('page')
-    data['orders'] = paginate(orders.distinct(), page, 100)
+    data['orders'] = paginate_index(index, request.GET)
 
     return render(request, "orders/index.html", data)
 
@@ -207,9 +204,7 @@ def customers(request):
     kind = request.GET.get('kind')
     request.session['search_query'] = query
 
-    customers = Customer.objects.filter(
-        Q(fullname__icontains=query) | Q(email__icontains=query) | Q(phone__contains=query)
-    )
+    customers = search(Customer.objects.all(), query)
 
     if kind == 'company':
         customers = customers.filter(is_company=True)
@@ -235,9 +230,7 @@ def devices(request):
     if valid_arg in ('serialNumber', 'alternateDeviceId',):
         return redirect(search_gsx, "warranty", valid_arg, query)
 
-    devices = Device.objects.filter(
-        Q(sn__icontains=query) | Q(description__icontains=query)
-    )
+    devices = search(Device.objects.all(), query)
 
     title = _(u'Devices matching "%s"') % query
 
@@ -251,7 +244,7 @@ def notes(request):
     query = request.GET.get("q")
     request.session['search_query'] = query
 
-    results = Note.objects.filter(body__icontains=query).order_by('-created_at')
+    results = search(Note.objects.all(), query)
     title = _(u'%d search results for "%s"') % (results.count(), query,)
     notes = paginate(results, request.GET.get('page'), 10)
 
@@ -93,14 +93,13 @@ def list_incoming(request, shipment=None, status=""):
     data = prep_list_view(request)
 
     if request.POST.getlist("id"):
-        count = len(request.POST.getlist("id"))
-        for i in request.POST.getlist("id"):
-            item = PurchaseOrderItem.objects.get(pk=i)
-            try:
-                item.receive(request.user)
-            except ValueError as e:
-                messages.error(request, e)
-                return redirect(list_incoming)
+        items = PurchaseOrderItem.objects.filter(pk__in=request.POST.getlist("id"))
+
+        try:
+            count = PurchaseOrderItem.receive_items(items, request.user)
+        except ValueError as e:
+            messages.error(request, e)
+            return redirect(list_incoming)
 
         messages.success(request, _("%d products received") % count)
 
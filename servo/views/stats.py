@@ -84,7 +84,6 @@ def index(request):
 def data(request, query):
     result  = []
     stats   = StatsManager()
-    cursor  = connection.cursor()
     report, what = query.split('/')
 
     locations   = request.user.locations
@@ -239,25 +238,15 @@ def data(request, query):
             result.append({'label': i.title, 'data': data})
 
     if what == "queues":
-        cursor.execute("""SELECT q.title, COUNT(*)
-            FROM servo_order o LEFT OUTER JOIN servo_queue q on (o.queue_id = q.id)
-            WHERE (o.created_at, o.created_at) OVERLAPS (%s, %s)
-            GROUP BY q.title""", [start_date, end_date])
-
-        for k, v in cursor.fetchall():
+        for k, v in stats.distribution_per_queue(start_date, end_date):
             k = k or _('No Queue')
             result.append({'label': k, 'data': v})
 
     if what == "techs":
         for i in users.filter(is_active=True):
-            cursor.execute("""SELECT COUNT(*) as p
-                FROM servo_order o
-                WHERE user_id = %s
-                    AND location_id = %s
-                    AND (created_at, created_at) OVERLAPS (%s, %s)
-                GROUP BY user_id""", [i.pk, location_id, start_date, end_date])
-
-            for v in cursor.fetchall():
+            data = stats.orders_per_user(location_id, i.pk, start_date, end_date)
+
+            for v in data:
                 result.append({'label': i.username, 'data': v})
 
     return HttpResponse(json.dumps(result))
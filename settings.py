@@ -195,8 +195,6 @@ IGNORABLE_404_URLS = [
     re.compile(r'favicon\.ico')
 ]
 
-TEST_RUNNER = 'servo.tests.NoDbTestRunner'
-
 EMAIL_HOST = 'mail.servoapp.com'
 EMAIL_HOST_PASSWORD = ''
 EMAIL_HOST_USER = ''
@@ -227,13 +225,14 @@ CELERYBEAT_SCHEDULE = {
         'task': 'servo.tasks.check_mail',
         'schedule': timedelta(seconds=300),
     },
+    'send_messages': {
+        'task': 'servo.tasks.send_messages',
+        'schedule': timedelta(seconds=60),
+    },
+    'update_repairs': {
+        'task': 'servo.tasks.update_repairs',
+        'schedule': timedelta(seconds=300),
+    },
 }
 
 from local_settings import *
-
-CACHES['comptia'] = {
-    'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-    'LOCATION': '127.0.0.1:11211',
-    'TIMEOUT': 60*60*24,
-    'KEY_PREFIX': 'comptia_'
-}